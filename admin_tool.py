@@ -0,0 +1,167 @@
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import lambda_dao
+import lambda_scenario
+import lambda_usage
+from lambda_backoff import AdaptiveBackoff, Checkpoint, call_with_backoff
+
+# INFOレベル以上のログメッセージを拾うように設定
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+# 変換: 最初のフェーズに戻して新しいゲームにする
+def transform_reset(item, options):
+    scenario = lambda_scenario.get_scenario(item.get('ScenarioId'))
+    changes = {
+        'CurrentPhase': scenario['machine']['initial_phase'],
+        'count': 0,
+        'limit': 0,
+        'SessionId': lambda_dao.new_session_id()
+    }
+    # トークン数と費用も新しいゲームの分から数え直す
+    changes.update({name: 0 for name in item if lambda_usage.is_usage_attribute(name)})
+    return changes
+
+
+# 変換: カウンターだけ0に戻す
+def transform_zero_counters(item, options):
+    if item.get('count', 0) == 0 and item.get('limit', 0) == 0:
+        return None
+    return {'count': 0, 'limit': 0}
+
+
+# 変換: 属性を追加する（--overwriteが無ければ既にある属性はそのまま）
+def transform_set(item, options):
+    changes = {}
+    for name, value in options['set'].items():
+        if options['overwrite'] or name not in item:
+            changes[name] = value
+    return changes or None
+
+
+TRANSFORMS = {
+    'reset': transform_reset,
+    'zero-counters': transform_zero_counters,
+    'set': transform_set
+}
+
+
+# 1つのセグメントを最後まで処理する
+def process_segment(segment, args, options, checkpoint, backoff, totals, totals_lock):
+    saved = checkpoint.get(segment)
+    if saved == 'done':
+        return
+    start_key = saved
+    transform = TRANSFORMS[args.transform]
+    counts = {'scanned': 0, 'changed': 0, 'failed': 0}
+
+    while True:
+        response = call_with_backoff(backoff, lambda_dao.scan_users_page, segment, args.segments, start_key, args.page_size)
+        items = response.get('Items', [])
+        counts['scanned'] += len(items)
+
+        changed = []
+        for item in items:
+            changes = transform(item, options)
+            if changes:
+                changed.append((item, changes))
+        counts['changed'] += len(changed)
+
+        if args.dry_run:
+            for item, changes in changed[:3]:
+                logger.info(f"[dry-run] segment {segment}: {item['user_id']} -> {changes}")
+        elif args.mode == 'batch':
+            # イベントの合間の一括変更用。丸ごと書き換えるので稼働中は使わない
+            call_with_backoff(backoff, lambda_dao.batch_put_users, [{**item, **changes} for item, changes in changed])
+        else:
+            for item, changes in changed:
+                try:
+                    call_with_backoff(backoff, lambda_dao.update_user_attributes, item['user_id'], changes)
+                except lambda_dao.DynamoDBError as e:
+                    # 途中で削除されたユーザーなどはスキップ
+                    logger.error(f"Failed to update {item['user_id']}: {e.code}")
+                    counts['failed'] += 1
+
+        start_key = response.get('LastEvaluatedKey')
+        if not args.dry_run:
+            checkpoint.save(segment, start_key or 'done')
+        if start_key is None:
+            break
+
+    with totals_lock:
+        for name, value in counts.items():
+            totals[name] += value
+    logger.info(f"Segment {segment} finished: {counts}")
+
+
+# --set name=value を解釈する（値はJSONとして読めればその型、読めなければ文字列）
+def parse_set_options(pairs):
+    values = {}
+    for pair in pairs:
+        name, _, raw = pair.partition('=')
+        try:
+            value = json.loads(raw, parse_float=Decimal)
+        except ValueError:
+            value = raw
+        values[name] = value
+    return values
+
+
+# コマンドラインから実行する
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk-transform user_info with a parallel segmented scan.')
+    parser.add_argument('transform', choices=sorted(TRANSFORMS), help='transform to apply to every user')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='attribute to add (for the set transform)')
+    parser.add_argument('--overwrite', action='store_true', help='overwrite attributes that already exist (set transform)')
+    parser.add_argument('--segments', type=int, default=8, help='number of scan segments')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker threads (default: segments)')
+    parser.add_argument('--page-size', type=int, default=None, help='items per scan page')
+    parser.add_argument('--mode', choices=['update', 'batch'], default='update',
+                        help='update: conditional UpdateItem per user / batch: BatchWriteItem of whole items')
+    parser.add_argument('--checkpoint', default=None, help='file to save progress to and resume from')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would change')
+    args = parser.parse_args(argv)
+
+    if args.transform == 'set' and not args.set:
+        parser.error('the set transform requires at least one --set NAME=VALUE')
+
+    logging.basicConfig(level=logging.INFO)
+    options = {'set': parse_set_options(args.set), 'overwrite': args.overwrite}
+    checkpoint = Checkpoint(args.checkpoint)
+    # セグメント数が違うと読み込み位置が意味を持たないので再開できない
+    if checkpoint.state.get('segments', args.segments) != args.segments:
+        parser.error(f"checkpoint was written with --segments {checkpoint.state['segments']}")
+    if not args.dry_run:
+        checkpoint.save('segments', args.segments)
+    backoff = AdaptiveBackoff()
+    totals = {'scanned': 0, 'changed': 0, 'failed': 0}
+    totals_lock = threading.Lock()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers or args.segments) as executor:
+        futures = [
+            executor.submit(process_segment, segment, args, options, checkpoint, backoff, totals, totals_lock)
+            for segment in range(args.segments)
+        ]
+        errors = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Segment failed: {e}")
+                errors += 1
+
+    logger.info(f"Finished in {time.monotonic() - started:.1f}s: {totals}, failed segments: {errors}")
+    return 1 if errors or totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
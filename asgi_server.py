@@ -0,0 +1,143 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import lambda_deadline
+import lambda_function
+
+# INFOレベル以上のログメッセージを拾うように設定
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# サーバーの設定を環境変数から取得
+SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.getenv('SERVER_PORT', '8080'))
+# ワーカープロセス数（プロセスごとにコネクションプールなどを持つ）
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', '1'))
+# DynamoDBやOpenAIのブロッキング呼び出しを流すスレッド数（プロセスごと）
+SERVER_EXECUTOR_WORKERS = int(os.getenv('SERVER_EXECUTOR_WORKERS', '64'))
+# 停止時に処理中のリクエストを待つ秒数
+SERVER_SHUTDOWN_TIMEOUT = int(os.getenv('SERVER_SHUTDOWN_TIMEOUT', '30'))
+# LINEのWebhookを受け付けるパス
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/callback')
+
+# プロセス内で使い回すスレッドプールと状態
+_executor = None
+_shutting_down = False
+
+
+# スレッドプールを作成する（lifespanが無いサーバーでも動くよう遅延作成）
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=SERVER_EXECUTOR_WORKERS, thread_name_prefix='handler')
+    return _executor
+
+
+# リクエストボディを全部読み込む
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+# レスポンスを返す
+async def send_response(send, status, body):
+    payload = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode('ascii'))
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+# 起動と停止の処理
+async def handle_lifespan(receive, send):
+    global _executor, _shutting_down
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            get_executor()
+            logger.info(f"Server started with {SERVER_EXECUTOR_WORKERS} executor threads and {lambda_deadline.GPT_EXECUTOR_WORKERS} GPT threads.")
+            # ターンごとにGPTを呼ぶので、GPTのスレッドが少ないと空き待ちの間に返信の締め切りを過ぎる
+            if lambda_deadline.GPT_EXECUTOR_WORKERS < SERVER_EXECUTOR_WORKERS:
+                logger.warning("GPT_EXECUTOR_WORKERS is smaller than SERVER_EXECUTOR_WORKERS; GPT calls will queue and turns may send holding replies.")
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # 新しいWebhookは受け付けず、処理中のターンは最後まで返信させる
+            _shutting_down = True
+            if _executor is not None:
+                await asyncio.get_running_loop().run_in_executor(None, _executor.shutdown, True)
+                _executor = None
+            logger.info("Server stopped.")
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+# LINE Messaging APIからのWebhookを処理する
+async def handle_webhook(scope, receive, send):
+    if _shutting_down:
+        return await send_response(send, 503, json.dumps('Server is shutting down.'))
+
+    body = await read_body(receive)
+    if body is None:
+        return
+
+    # ASGIのヘッダーは小文字のバイト列なので、lambda_handlerと同じ形の辞書にする
+    headers = {key.decode('latin-1'): value.decode('latin-1') for key, value in scope['headers']}
+    event = {'headers': headers, 'body': body.decode('utf-8')}
+
+    # ハンドラーはブロッキングなのでスレッドプールで実行する
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(get_executor(), lambda_function.lambda_handler, event, None)
+    except Exception as e:
+        logger.error(f"An unexpected error occurred in handle_webhook: {e}")
+        return await send_response(send, 500, json.dumps('Internal Server Error'))
+    await send_response(send, result['statusCode'], result['body'])
+
+
+# ASGIアプリケーション本体
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await handle_lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    path = scope['path']
+    method = scope['method']
+    if path == WEBHOOK_PATH and method == 'POST':
+        return await handle_webhook(scope, receive, send)
+    # コンテナのヘルスチェック用
+    if path == '/health' and method == 'GET':
+        return await send_response(send, 200, json.dumps('ok'))
+    return await send_response(send, 404, json.dumps('Not Found'))
+
+
+# uvicornでサーバーを起動する
+def main():
+    import uvicorn
+
+    uvicorn.run(
+        'asgi_server:app',
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        workers=SERVER_WORKERS,
+        lifespan='on',
+        timeout_graceful_shutdown=SERVER_SHUTDOWN_TIMEOUT
+    )
+
+
+if __name__ == '__main__':
+    main()
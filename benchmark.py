@@ -0,0 +1,279 @@
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import local_stack
+
+# lambda_handler を代役のLINE、OpenAI、DynamoDBに繋いで、1ターンごとの時間を測る
+# 結果はJSONに保存して、コミット間で比べられるようにする
+#   python benchmark.py --players 50 --concurrency 8 --output bench/HEAD.json
+#   python benchmark.py --players 50 --compare bench/main.json
+
+# 1人のプレイヤーが送るメッセージ（既定シナリオを最後まで進める）
+JOURNEY = [
+    'あなたは誰ですか？',
+    '昨日の夜は何をしていましたか？',
+    '先生、では質問しますね',
+    'リビングを調べたい',
+    '被害者とはどういう関係でしたか？',
+    'キッチンを調べたい',
+    '書斎の机を調べたい',
+    '推理を発表したい',
+    '犯人は成田さきです。契約書を破り捨てたことを隠すために、消えるボールペンで書いた字をアイロンで温めて消しました。',
+    '終了したい',
+    'ありがとうございました'
+]
+
+
+# フェーズごとの1ターンの呼び出し回数の上限（lambda_io.totals() の項目）
+# JOURNEY で測った1ターンの最大の回数にしてある（温まったコンテナのターンは user_info を読まないので、読み込みはもっと少ない）
+# --think-time が USER_CACHE_TTL_SECONDS より長いと、user_info を読み直すターンが上限を超える
+# 最大の回数が普段より多い理由:
+#   読み込み: フェーズのプロンプトはプロセスで最初の1回だけDynamoDBから読む。新しいユーザーの最初のターンは user_info を読む
+#   書き込み: 新しいユーザーの最初のターンは登録を書く。会話履歴を残すフェーズは状態の更新と履歴の2回
+#   OpenAI: investigation で関数を呼んだターンは、返答の本文を作るために2回目を呼ぶ
+#   LINE: 返信の締め切りを過ぎて定型文を先に返したターンは、本回答のpushが増える
+DEFAULT_BUDGETS = {
+    '*': {'line': 2},
+    # 会話履歴 + プロンプト（最初の1回） + 新しいユーザーの user_info、登録 + 状態の更新
+    'intro': {'dynamodb_reads': 3, 'dynamodb_writes': 2, 'openai': 1},
+    # 会話履歴 + プロンプト（最初の1回）、状態の更新 + 会話履歴、関数の呼び出し + 2回目
+    'investigation': {'dynamodb_reads': 2, 'dynamodb_writes': 2, 'openai': 2},
+    # プロンプト（最初の1回。会話履歴は読まない）、状態の更新 + 会話履歴
+    'reasoning': {'dynamodb_reads': 1, 'dynamodb_writes': 2, 'openai': 1},
+    # 定型文だけ（状態の更新のみ）
+    'outro': {'dynamodb_reads': 0, 'dynamodb_writes': 1, 'openai': 0},
+    'end': {'dynamodb_reads': 0, 'dynamodb_writes': 1, 'openai': 0}
+}
+
+
+# 並べ替えた値から百分位を取る（最近傍順位）
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 3),
+        'p50': round(percentile(values, 0.50), 3),
+        'p95': round(percentile(values, 0.95), 3),
+        'p99': round(percentile(values, 0.99), 3),
+        'max': round(values[-1], 3)
+    }
+
+
+# 計測ファイル（METRICS_MODE=file のEMF）から、フェーズごとの処理時間と内訳を集める
+def read_metrics(path):
+    turns = []
+    if not os.path.exists(path):
+        return turns
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            document = json.loads(line)
+            metrics = document['_aws']['CloudWatchMetrics'][0]
+            stages = {}
+            calls = {}
+            for metric in metrics['Metrics']:
+                value = document[metric['Name']]
+                value = sum(value) if isinstance(value, list) else value
+                if metric['Unit'] == 'Milliseconds':
+                    stages[metric['Name']] = value
+                elif metric['Name'].startswith('io.'):
+                    calls[metric['Name'][len('io.'):]] = value
+            turns.append({'phase': document.get('Phase', 'unknown'), 'stages': stages, 'calls': calls})
+    return turns
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# 1人分のメッセージを順に送る
+def play(lambda_function, line, player_id, journey, think_time, results, lock):
+    for text in journey:
+        event, reply_token = local_stack.webhook_event(player_id, text)
+        started = time.perf_counter()
+        error = None
+        try:
+            response = lambda_function.lambda_handler(event, None)
+            if response['statusCode'] != 200:
+                error = f"status {response['statusCode']}"
+        except Exception as e:
+            error = repr(e)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        # 返信もpushも無ければ無言のターン
+        if error is None and not line.sent_for(reply_token, player_id):
+            error = 'no reply'
+        with lock:
+            results.append({'player': player_id, 'text': text, 'ms': elapsed_ms, 'error': error})
+        if think_time:
+            time.sleep(think_time)
+
+
+def run(args):
+    metrics_file = os.path.join(tempfile.mkdtemp(prefix='bench-'), 'metrics.jsonl')
+    local_stack.prepare_environment(
+        METRICS_MODE='file',
+        METRICS_FILE=metrics_file,
+        THROTTLE_ENABLED='true' if args.throttle else 'false',
+        IO_BUDGET_MODE='assert'
+    )
+    import lambda_function
+    import lambda_io
+    import lambda_user_cache
+
+    if args.budgets:
+        lambda_io.load_budgets(args.budgets)
+    else:
+        lambda_io.set_budgets(DEFAULT_BUDGETS)
+    lambda_io.reset_violations()
+
+    rng = random.Random(args.seed)
+    stack = local_stack.install(
+        dynamodb=local_stack.LocalDynamoDB(local_stack.Latency.parse(args.dynamodb_latency, rng), args.dynamodb_throttle_rate),
+        line=local_stack.LocalLineBotApi(local_stack.Latency.parse(args.line_latency, rng)),
+        chat=local_stack.chat_completion(local_stack.Latency.parse(args.openai_latency, rng), rng, args.openai_recording)
+    )
+    # lambda_function は読み込み時にINFOにするので、読み込んだ後に合わせる
+    logging.getLogger().setLevel(args.log_level)
+
+    results = []
+    lock = threading.Lock()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(play, lambda_function, stack['line'], f'Ubench{index:06d}', JOURNEY, args.think_time, results, lock)
+            for index in range(args.players)
+        ]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    turns = read_metrics(metrics_file)
+    by_phase = {}
+    stages = {}
+    calls = {}
+    for turn in turns:
+        by_phase.setdefault(turn['phase'], []).append(turn['stages'].get('handle_message', 0.0))
+        for name, value in turn['stages'].items():
+            stages.setdefault(turn['phase'], {}).setdefault(name, []).append(value)
+        for name, value in turn['calls'].items():
+            calls.setdefault(turn['phase'], {}).setdefault(name, []).append(value)
+
+    errors = [result for result in results if result['error']]
+    violations = lambda_io.budget_violations()
+    return {
+        'revision': args.label or git_revision(),
+        'timestamp': int(time.time()),
+        'config': {
+            'players': args.players,
+            'concurrency': args.concurrency,
+            'openai_latency': args.openai_latency,
+            'dynamodb_latency': args.dynamodb_latency,
+            'line_latency': args.line_latency,
+            'dynamodb_throttle_rate': args.dynamodb_throttle_rate,
+            'think_time': args.think_time,
+            'throttle': args.throttle,
+            'openai_recording': args.openai_recording,
+            'seed': args.seed
+        },
+        'turns': len(results),
+        'errors': len(errors),
+        'error_samples': errors[:5],
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_turns_per_second': round(len(results) / elapsed, 3) if elapsed else None,
+        'latency_ms': summarize([result['ms'] for result in results]),
+        'latency_ms_by_phase': {phase: summarize(values) for phase, values in sorted(by_phase.items())},
+        'stages_ms_by_phase': {
+            phase: {name: summarize(values) for name, values in sorted(phase_stages.items())}
+            for phase, phase_stages in sorted(stages.items())
+        },
+        'io_per_turn_by_phase': {
+            phase: {name: {'mean': round(sum(values) / len(values), 3), 'max': max(values)} for name, values in sorted(phase_calls.items())}
+            for phase, phase_calls in sorted(calls.items())
+        },
+        'budget_violations': len(violations),
+        'budget_violation_samples': violations[:5],
+        'calls': {
+            'dynamodb': dict(stack['dynamodb'].calls),
+            'line': dict(stack['line'].calls),
+            'openai': stack['openai'].calls
+        },
+        'openai_recording': getattr(stack['openai'], 'stats', None),
+        'user_cache': lambda_user_cache.stats()
+    }
+
+
+# 前の結果とp50 / p95を比べて表示する
+def compare(previous, current):
+    lines = [f"{'phase':<16}{'p50 before':>12}{'p50 after':>12}{'p95 before':>12}{'p95 after':>12}"]
+    phases = sorted(set(previous['latency_ms_by_phase']) | set(current['latency_ms_by_phase']))
+    for phase in phases:
+        before = previous['latency_ms_by_phase'].get(phase, {})
+        after = current['latency_ms_by_phase'].get(phase, {})
+        lines.append(
+            f"{phase:<16}{before.get('p50', '-'):>12}{after.get('p50', '-'):>12}"
+            f"{before.get('p95', '-'):>12}{after.get('p95', '-'):>12}"
+        )
+    lines.append(
+        f"throughput: {previous['throughput_turns_per_second']} -> {current['throughput_turns_per_second']} turns/s"
+    )
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark lambda_handler end to end against local LINE, OpenAI and DynamoDB stand-ins.')
+    parser.add_argument('--players', type=int, default=20, help='number of players to run through the whole game')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of players handled at the same time')
+    parser.add_argument('--openai-latency', default='800:3000', help='OpenAI latency in ms as median:p99')
+    parser.add_argument('--dynamodb-latency', default='5:25', help='DynamoDB latency in ms as median:p99')
+    parser.add_argument('--line-latency', default='40:150', help='LINE API latency in ms as median:p99')
+    parser.add_argument('--dynamodb-throttle-rate', type=float, default=0.0, help='fraction of DynamoDB calls the stand-in rejects as throttled')
+    parser.add_argument('--think-time', type=float, default=0.0, help='seconds a player waits between messages')
+    parser.add_argument('--throttle', action='store_true', help='keep the per-user throttle enabled')
+    parser.add_argument('--openai-recording', default=None, help='serve OpenAI responses recorded in this file (others fall back to the rule-based fake)')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the latency distributions')
+    parser.add_argument('--label', default=None, help='label stored with the results (default: git revision)')
+    parser.add_argument('--output', default=None, help='file to save the results to as JSON')
+    parser.add_argument('--compare', default=None, help='previous results JSON to compare against')
+    parser.add_argument('--budgets', default=None, help='JSON file of per-phase I/O budgets (default: DEFAULT_BUDGETS)')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the bot while benchmarking')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print(compare(json.load(f), result))
+    return 1 if result['errors'] or result['budget_violations'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
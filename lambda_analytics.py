@@ -0,0 +1,262 @@
+import argparse
+import json
+import logging
+import sys
+
+import lambda_reasoning
+import lambda_scenario
+
+logger = logging.getLogger()
+
+# lambda_export で書き出した会話（Parquet）を読み込んで、どこで離脱しているか、
+# 推理までに何ターン調べているか、どの場所を調べたゲームが正解しやすいかをまとめる
+# 行ごとのPythonのループは使わず、列（カテゴリの番号）の配列演算で集計するので、数千万ターンでも数秒で終わる
+# （推理の採点だけは文章ごとに行うが、同じ文章は1回だけ採点する）
+
+# 集計に使う列（message は推理のターンだけ別に読む）
+COLUMNS = ['user_id', 'session_id', 'ts', 'phase', 'location']
+
+
+# 書き出し先（s3://bucket/prefix またはディレクトリ）のParquetを読む
+# since / until は YYYY-MM-DD（dt のパーティションで絞るので、範囲外のファイルは読まない）
+def _dataset(path):
+    import pyarrow.dataset as ds
+
+    return ds.dataset(path, format='parquet', partitioning='hive')
+
+
+def _date_filter(since=None, until=None):
+    import pyarrow.dataset as ds
+
+    condition = None
+    if since:
+        condition = ds.field('dt') >= since
+    if until:
+        upper = ds.field('dt') <= until
+        condition = upper if condition is None else condition & upper
+    return condition
+
+
+# ターンを読み込む（ID・フェーズ・場所はpandasのカテゴリになる）
+def load_turns(path, since=None, until=None):
+    import numpy as np
+    import pandas as pd
+
+    table = _dataset(path).to_table(columns=COLUMNS, filter=_date_filter(since, until))
+    turns = table.to_pandas()
+    turns['session_id'] = turns['session_id'].cat.add_categories('').fillna('')
+    # ゲームの番号（user_id と SessionId の組ごと。カテゴリの番号を組み合わせて振り直す）
+    users = turns['user_id'].cat.codes.to_numpy().astype(np.int64)
+    sessions = turns['session_id'].cat.codes.to_numpy()
+    turns['game'] = pd.factorize(users * len(turns['session_id'].cat.categories) + sessions)[0]
+    logger.info(f"Loaded {len(turns)} turns of {turns['game'].max() + 1 if len(turns) else 0} games from {path}")
+    return turns
+
+
+# 推理のフェーズのターンだけ、文章も含めて読む
+def load_ending_turns(path, phases, since=None, until=None):
+    import pyarrow.dataset as ds
+
+    condition = ds.field('phase').isin(list(phases))
+    dates = _date_filter(since, until)
+    if dates is not None:
+        condition = condition & dates
+    turns = _dataset(path).to_table(columns=COLUMNS + ['message'], filter=condition).to_pandas()
+    turns['session_id'] = turns['session_id'].cat.add_categories('').fillna('')
+    return turns
+
+
+# 各ターンのフェーズをシナリオでの順番（0から）にした配列（シナリオに無いフェーズは-1）
+def _phase_ranks(turns, phase_order):
+    import numpy as np
+
+    rank_of = {name: rank for rank, name in enumerate(phase_order)}
+    categories = turns['phase'].cat.categories
+    lookup = np.array([rank_of.get(name, -1) for name in categories] + [-1], dtype=np.int16)
+    # 欠けている値（フェーズを記録する前の行）のコードは-1なので、末尾の-1を引く
+    return lookup[turns['phase'].cat.codes.to_numpy()]
+
+
+# ゲーム × フェーズのターン数の表（np.bincount 1回で数える）
+def game_phase_table(turns, phase_order):
+    import numpy as np
+
+    games = turns['game'].to_numpy()
+    count = int(games.max()) + 1 if len(games) else 0
+    ranks = _phase_ranks(turns, phase_order)
+    valid = ranks >= 0
+    cells = games[valid].astype(np.int64) * len(phase_order) + ranks[valid]
+    return np.bincount(cells, minlength=count * len(phase_order)).reshape(count, len(phase_order))
+
+
+# ゲームごとの到達した一番先のフェーズ（-1は記録が無い）と、推理したかどうか
+def game_progress(table, phase_order, ending_phases):
+    import numpy as np
+
+    talked = table > 0
+    furthest = np.where(talked.any(axis=1), len(phase_order) - 1 - np.argmax(talked[:, ::-1], axis=1), -1)
+    ending_ranks = [phase_order.index(name) for name in ending_phases if name in phase_order]
+    ended = talked[:, ending_ranks].any(axis=1) if ending_ranks else np.zeros(len(table), dtype=bool)
+    return furthest, ended
+
+
+# フェーズごとに、そこまで進んだゲームの数と、そこで止まったゲームの数
+def phase_funnel(table, phase_order, ending_phases):
+    import numpy as np
+
+    furthest, ended = game_progress(table, phase_order, ending_phases)
+    total = len(furthest)
+    funnel = []
+    for rank, name in enumerate(phase_order):
+        reached = int(np.count_nonzero(furthest >= rank))
+        stopped = int(np.count_nonzero((furthest == rank) & ~ended))
+        funnel.append({
+            'phase': name,
+            'reached': reached,
+            'reached_ratio': round(reached / total, 4) if total else 0.0,
+            'stopped': stopped
+        })
+    return {'games': total, 'ended': int(np.count_nonzero(ended)), 'phases': funnel}
+
+
+def _distribution(values):
+    import numpy as np
+
+    if len(values) == 0:
+        return {'games': 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        'games': int(len(values)),
+        'mean': round(float(np.mean(values)), 2),
+        'p50': float(p50),
+        'p90': float(p90),
+        'p99': float(p99),
+        'max': int(np.max(values))
+    }
+
+
+# フェーズごとのターン数の分布（そのフェーズで話したゲームだけ）
+# before_ending は推理まで進んだゲームの、推理の前のフェーズでのターン数
+def turn_counts(table, phase_order, ending_phases):
+    _, ended = game_progress(table, phase_order, ending_phases)
+    ending_ranks = [phase_order.index(name) for name in ending_phases if name in phase_order]
+    first_ending = min(ending_ranks) if ending_ranks else len(phase_order)
+    result = {}
+    for rank, name in enumerate(phase_order):
+        column = table[:, rank]
+        result[name] = _distribution(column[column > 0])
+        if rank < first_ending and ended.any():
+            result[name]['before_ending'] = _distribution(column[ended])
+    return result
+
+
+# 推理のターンを採点し直して、ゲームごとの結果（最後の推理）を返す
+# 同じ文章は1回だけ採点する
+def ending_outcomes(ending_turns, scenario):
+    import numpy as np
+    import pandas as pd
+
+    if len(ending_turns) == 0:
+        return pd.DataFrame({'user_id': [], 'session_id': [], 'score': [], 'passed': []})
+    last = ending_turns.sort_values('ts').drop_duplicates(['user_id', 'session_id'], keep='last')
+    codes, texts = pd.factorize(last['message'].fillna(''))
+    results = [lambda_reasoning.score(scenario['reasoning'], text) for text in texts]
+    scores = np.array([result['score'] for result in results], dtype=float)
+    passed = np.array([result['passed'] for result in results], dtype=bool)
+    return pd.DataFrame({
+        'user_id': last['user_id'].astype(str).to_numpy(),
+        'session_id': last['session_id'].astype(str).to_numpy(),
+        'score': scores[codes],
+        'passed': passed[codes]
+    })
+
+
+# ゲーム × 場所の「調べたか」の表（ゲームの番号、場所名、真偽の2次元配列）
+def location_visits(turns):
+    import numpy as np
+
+    visited = turns['location'].cat.codes.to_numpy() >= 0
+    locations = list(turns['location'].cat.categories)
+    games = turns['game'].to_numpy()
+    count = int(games.max()) + 1 if len(games) else 0
+    matrix = np.zeros((count, len(locations)), dtype=bool)
+    matrix[games[visited], turns['location'].cat.codes.to_numpy()[visited]] = True
+    return matrix, locations
+
+
+# 場所ごとの、調べたゲームの数と、調べたゲームのうち正解した割合（lift は全体の正解率との差）
+# co_visits は2つの場所を両方調べたゲームの数
+def location_report(turns, outcomes):
+    import numpy as np
+    import pandas as pd
+
+    matrix, locations = location_visits(turns)
+    keys = turns[['user_id', 'session_id', 'game']].drop_duplicates('game')
+    keys = keys.assign(user_id=keys['user_id'].astype(str), session_id=keys['session_id'].astype(str))
+    joined = keys.merge(outcomes, on=['user_id', 'session_id'], how='left')
+    graded = np.zeros(len(matrix), dtype=bool)
+    correct = np.zeros(len(matrix), dtype=bool)
+    graded[joined['game'].to_numpy()] = joined['passed'].notna().to_numpy()
+    correct[joined['game'].to_numpy()] = joined['passed'].fillna(False).astype(bool).to_numpy()
+
+    counts = matrix.astype(np.int64)
+    visits = counts.sum(axis=0)
+    graded_visits = counts[graded].sum(axis=0)
+    correct_visits = counts[correct].sum(axis=0)
+    overall = correct.sum() / graded.sum() if graded.any() else 0.0
+    rows = []
+    for index, name in enumerate(locations):
+        rate = correct_visits[index] / graded_visits[index] if graded_visits[index] else 0.0
+        rows.append({
+            'location': name,
+            'games': int(visits[index]),
+            'ended_games': int(graded_visits[index]),
+            'correct_rate': round(float(rate), 4),
+            'lift': round(float(rate - overall), 4)
+        })
+    rows.sort(key=lambda row: row['lift'], reverse=True)
+    co_visits = pd.DataFrame(counts.T @ counts, index=locations, columns=locations)
+    return {'overall_correct_rate': round(float(overall), 4), 'locations': rows}, co_visits
+
+
+# 全部まとめる
+def build_report(path, scenario, since=None, until=None):
+    phases = scenario['machine']['phases']
+    # 会話履歴が残るのは save_history のフェーズだけ（intro などで止まったゲームは user_info の CurrentPhase で見る）
+    phase_order = [name for name, phase in phases.items() if phase['save_history']]
+    ending_phases = [name for name, phase in phases.items() if phase['ending']]
+
+    turns = load_turns(path, since, until)
+    table = game_phase_table(turns, phase_order)
+    outcomes = ending_outcomes(load_ending_turns(path, ending_phases, since, until), scenario)
+    locations, co_visits = location_report(turns, outcomes)
+    return {
+        'turns': int(len(turns)),
+        'funnel': phase_funnel(table, phase_order, ending_phases),
+        'turn_counts': turn_counts(table, phase_order, ending_phases),
+        'endings': {
+            'games': int(len(outcomes)),
+            'correct': int(outcomes['passed'].sum()),
+            'score': _distribution(outcomes['score'].to_numpy())
+        },
+        'locations': locations,
+        'co_visits': {name: {other: int(value) for other, value in row.items() if value} for name, row in co_visits.iterrows()}
+    }
+
+
+# コマンドラインから集計する
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Funnel, turn-count, location and ending analytics over exported turns.')
+    parser.add_argument('path', help='export target (s3://bucket/prefix or a local directory)')
+    parser.add_argument('--scenario', default=None, help='scenario pack the games were played with (default: DEFAULT_SCENARIO_ID)')
+    parser.add_argument('--since', default=None, help='first date to include (YYYY-MM-DD)')
+    parser.add_argument('--until', default=None, help='last date to include (YYYY-MM-DD)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    scenario = lambda_scenario.load_scenario(args.scenario or lambda_scenario.DEFAULT_SCENARIO_ID)
+    print(json.dumps(build_report(args.path, scenario, args.since, args.until), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
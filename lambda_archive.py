@@ -0,0 +1,183 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+from decimal import Decimal
+
+import lambda_dao
+
+# INFOレベル以上のログメッセージを拾うように設定
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# アーカイブの保存先。s3://bucket/prefix ならS3、それ以外はローカルのディレクトリ（空なら無効）
+ARCHIVE_TARGET = os.getenv('ARCHIVE_TARGET', '')
+# endになった時にそのゲームの会話履歴をアーカイブするか
+ARCHIVE_ON_END = os.getenv('ARCHIVE_ON_END', 'false').lower() == 'true'
+# endになった時に非同期で呼ぶ、archive_handler を動かすLambdaの関数名（空ならスケジュール実行に任せる）
+ARCHIVE_FUNCTION_NAME = os.getenv('ARCHIVE_FUNCTION_NAME', '')
+# 削除の速度の上限（1秒あたりの件数）
+ARCHIVE_MAX_DELETES_PER_SECOND = int(os.getenv('ARCHIVE_MAX_DELETES_PER_SECOND', '50'))
+
+
+# DynamoDBの数値（Decimal）をJSONにする
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+# アーカイブのファイル名（ユーザーごと、ゲームごと）
+def archive_key(user_id, session_id):
+    return f"{user_id}/{session_id or 'legacy'}.jsonl.gz"
+
+
+# 圧縮したJSONLを保存先に書き込む
+def write_archive(target, key, payload, content_type='application/x-ndjson'):
+    if target.startswith('s3://'):
+        import boto3
+
+        bucket, _, prefix = target[len('s3://'):].partition('/')
+        object_key = f"{prefix.rstrip('/')}/{key}" if prefix else key
+        boto3.client('s3').put_object(
+            Bucket=bucket,
+            Key=object_key,
+            Body=payload,
+            ContentType=content_type,
+            ContentEncoding='gzip'
+        )
+        return f's3://{bucket}/{object_key}'
+
+    path = os.path.join(target, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 書きかけのファイルが残らないように一時ファイルから置き換える
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp_path, path)
+    return path
+
+
+# 1つのゲームの会話履歴をアーカイブして、ホットなテーブルから削除する
+# user: user_infoのアイテム（1行目に記録する）
+# 返り値: {'location': 保存先, 'turns': 件数, 'deleted': 削除件数}
+def archive_session(user, target=None, delete_user=False, dry_run=False):
+    target = target or ARCHIVE_TARGET
+    if not target:
+        raise ValueError('ARCHIVE_TARGET is not set.')
+    user_id = user['user_id']
+    session_id = user.get('SessionId')
+
+    # 全部読み終わって保存できるまでは何も消さない
+    turns = list(lambda_dao.iter_talk_history(user_id, session_id))
+    # アーカイブ済み（履歴が残っていない）なら前のアーカイブを上書きしない
+    if not turns:
+        if delete_user and session_id is not None and not dry_run:
+            _delete_user(user_id, session_id)
+        return {'location': None, 'turns': 0, 'deleted': 0}
+    lines = [json.dumps({'type': 'user', **user}, ensure_ascii=False, default=_json_default)]
+    lines.extend(json.dumps({'type': 'turn', **turn}, ensure_ascii=False, default=_json_default) for turn in turns)
+    payload = gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+
+    if dry_run:
+        logger.info(f"[dry-run] Would archive {len(turns)} turns of {user_id} session {session_id} ({len(payload)} bytes).")
+        return {'location': None, 'turns': len(turns), 'deleted': 0}
+
+    location = write_archive(target, archive_key(user_id, session_id), payload)
+    deleted = lambda_dao.batch_delete_talk_history(turns, ARCHIVE_MAX_DELETES_PER_SECOND)
+    if delete_user and session_id is not None:
+        _delete_user(user_id, session_id)
+    logger.info(f"Archived {len(turns)} turns of {user_id} session {session_id} to {location}.")
+    return {'location': location, 'turns': len(turns), 'deleted': deleted}
+
+
+# アーカイブしたゲームのユーザー情報を消す（別のゲームが始まっていたら残す）
+def _delete_user(user_id, session_id):
+    try:
+        lambda_dao.delete_user_info(user_id, session_id)
+    except lambda_dao.DynamoDBConditionError:
+        logger.info(f"Kept user_info of {user_id}: a new game has started since session {session_id}.")
+
+
+_lambda_client = None
+
+
+def _get_lambda_client():
+    global _lambda_client
+    if _lambda_client is None:
+        import boto3
+
+        _lambda_client = boto3.client('lambda')
+    return _lambda_client
+
+
+# endに移った時に呼ぶ（ARCHIVE_ON_ENDが有効な時だけ。失敗してもゲームには影響させない）
+# S3への書き込みと削除はターンの中では行わず、archive_handler のLambdaを非同期に呼んで任せる
+# 呼べなかったゲームも、スケジュール実行の archive_handler がendのユーザーをまとめてアーカイブする
+def archive_on_end(user):
+    if not ARCHIVE_ON_END or not ARCHIVE_FUNCTION_NAME:
+        return None
+    try:
+        payload = json.dumps({'user': user}, ensure_ascii=False, default=_json_default)
+        return _get_lambda_client().invoke(
+            FunctionName=ARCHIVE_FUNCTION_NAME,
+            InvocationType='Event',
+            Payload=payload.encode('utf-8')
+        )
+    except Exception as e:
+        logger.error(f"Failed to request archiving of {user.get('user_id')}: {e}")
+        return None
+
+
+# endのユーザーをまとめてアーカイブする（バッチ処理）
+def archive_finished(target=None, delete_users=False, dry_run=False, limit=None):
+    summary = {'sessions': 0, 'turns': 0, 'deleted': 0, 'errors': 0}
+    for user in lambda_dao.scan_users_in_phase('end'):
+        if limit is not None and summary['sessions'] >= limit:
+            break
+        try:
+            result = archive_session(user, target, delete_user=delete_users, dry_run=dry_run)
+        except Exception as e:
+            logger.error(f"Failed to archive session of {user.get('user_id')}: {e}")
+            summary['errors'] += 1
+            continue
+        summary['sessions'] += 1
+        summary['turns'] += result['turns']
+        summary['deleted'] += result['deleted']
+    logger.info(f"Archive summary: {summary}")
+    return summary
+
+
+# スケジュール実行用のLambdaハンドラー（EventBridgeなどから呼ぶ）
+# archive_on_end から {'user': user_infoのアイテム} で呼ばれた時は、そのゲームだけをアーカイブする
+def archive_handler(event, context):
+    event = event or {}
+    if 'user' in event:
+        return archive_session(event['user'], event.get('target'))
+    return archive_finished(
+        target=event.get('target'),
+        delete_users=event.get('delete_users', False),
+        dry_run=event.get('dry_run', False),
+        limit=event.get('limit')
+    )
+
+
+# コマンドラインから実行する
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Archive finished games out of the hot DynamoDB tables.')
+    parser.add_argument('--target', default=ARCHIVE_TARGET, help='s3://bucket/prefix or a local directory')
+    parser.add_argument('--delete-users', action='store_true', help='also delete the archived user_info items')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be archived')
+    parser.add_argument('--limit', type=int, default=None, help='maximum number of sessions to archive')
+    args = parser.parse_args(argv)
+    if not args.target:
+        parser.error('--target or ARCHIVE_TARGET is required')
+    logging.basicConfig(level=logging.INFO)
+    summary = archive_finished(args.target, args.delete_users, args.dry_run, args.limit)
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+import json
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import lambda_dao
+
+# テーブル全体を読み書きするバッチ（admin_tool / lambda_export）で使う、スロットリングされた時の待ち方と再開位置の保存
+
+# スロットリングとみなすエラーコード
+THROTTLE_ERROR_CODES = (
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded'
+)
+# 1回の呼び出しの再試行回数
+MAX_RETRIES = 8
+
+
+# スロットリングされたら全ワーカーの間隔を広げ、成功が続いたら縮める
+class AdaptiveBackoff:
+    def __init__(self, max_delay=5.0):
+        self.delay = 0.0
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+
+    def throttled(self):
+        with self.lock:
+            self.delay = min(self.max_delay, max(0.05, self.delay * 2))
+
+    def succeeded(self):
+        with self.lock:
+            self.delay = self.delay * 0.9 if self.delay > 0.01 else 0.0
+
+    def wait(self):
+        delay = self.delay
+        if delay > 0:
+            # 全ワーカーが同時に再開しないように揺らす
+            time.sleep(delay * random.uniform(0.5, 1.5))
+
+
+# スロットリングなら待って再試行する
+def call_with_backoff(backoff, func, *args):
+    for attempt in range(MAX_RETRIES):
+        backoff.wait()
+        try:
+            result = func(*args)
+            backoff.succeeded()
+            return result
+        except (ClientError, lambda_dao.DynamoDBThrottledError) as e:
+            # DAOの関数は再試行しきれなかったスロットリングを DynamoDBThrottledError で知らせる
+            code = e.code if isinstance(e, lambda_dao.DynamoDBError) else e.response['Error']['Code']
+            if code not in THROTTLE_ERROR_CODES or attempt == MAX_RETRIES - 1:
+                raise
+            backoff.throttled()
+            time.sleep(min(backoff.max_delay, 0.05 * 2 ** attempt) * random.random())
+
+
+# 途中から再開できるように、セグメントごとの読み込み位置を保存する
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.state = json.load(f)
+
+    def get(self, segment):
+        return self.state.get(str(segment))
+
+    def save(self, key, value):
+        if not self.path:
+            return
+        with self.lock:
+            self.state[str(key)] = value
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, default=str)
+            os.replace(tmp_path, self.path)
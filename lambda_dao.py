@@ -1,172 +1,547 @@
 import json
+import logging
+import os
+import random
+import time
+import uuid
 import boto3
-from botocore.exceptions import ClientError
-from boto3.dynamodb.conditions import Key
+import lambda_deadline
+import lambda_io
+import lambda_metrics
+import lambda_user_cache
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeDeserializer
+from datetime import datetime, timezone
+from functools import wraps
 
 # dynamodb
-dynamodb = boto3.resource('dynamodb')
+# 常駐サーバーで並行実行する時はコネクションプールを広げる
+# 再試行は handle_dynamodb_exception で行うので、SDKの再試行は重ねない（回数と待ち時間を予算の中で数えるため）
+dynamodb = boto3.resource(
+    'dynamodb',
+    config=Config(
+        max_pool_connections=int(os.getenv('DYNAMODB_MAX_POOL_CONNECTIONS', '10')),
+        retries={'mode': 'standard', 'total_max_attempts': int(os.getenv('DYNAMODB_SDK_MAX_ATTEMPTS', '1'))}
+    )
+)
 talk_history = dynamodb.Table('talk_history')
 user_table = dynamodb.Table('user_info')
+# ターンごとのイベントログ（パーティションキー session_key、ソートキー event_key）
+TURN_EVENTS_TABLE = os.getenv('TURN_EVENTS_TABLE', 'turn_events')
+turn_events = dynamodb.Table(TURN_EVENTS_TABLE)
+
+# フェーズごとにユーザーを引くためのGSI（パーティションキー CurrentPhase、ソートキー LastActivity）
+PHASE_INDEX_NAME = os.getenv('PHASE_INDEX_NAME', 'CurrentPhase-LastActivity-index')
+
+# 再試行の回数（最初の1回を含む）と、1回の操作で再試行に使える時間（ミリ秒。ターンの締め切りが先ならそちら）
+DYNAMODB_MAX_ATTEMPTS = int(os.getenv('DYNAMODB_MAX_ATTEMPTS', '4'))
+DYNAMODB_RETRY_BUDGET_MS = int(os.getenv('DYNAMODB_RETRY_BUDGET_MS', '1500'))
+# 待ち時間の基準と上限（ミリ秒。base * 2^n までの一様な揺らぎ）
+DYNAMODB_BACKOFF_BASE_MS = int(os.getenv('DYNAMODB_BACKOFF_BASE_MS', '25'))
+DYNAMODB_BACKOFF_MAX_MS = int(os.getenv('DYNAMODB_BACKOFF_MAX_MS', '500'))
+
+# スロットリングとみなすエラーコード（リクエストは処理されていないので、どの操作も再試行できる）
+THROTTLE_ERROR_CODES = frozenset((
+    'ProvisionedThroughputExceededException',
+    'ThrottlingException',
+    'RequestLimitExceeded'
+))
+# 一時的なエラー（処理されたかどうか分からないので、何度書いても同じになる操作だけ再試行する）
+TRANSIENT_ERROR_CODES = frozenset((
+    'InternalServerError',
+    'ServiceUnavailable',
+    'TransactionConflictException'
+))
+TRANSIENT_EXCEPTIONS = (ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError)
+
+logger = logging.getLogger()
+
+
+# DynamoDBの操作が失敗した（Noneの「見つからない」と区別するため、失敗は例外で知らせる）
+class DynamoDBError(Exception):
+    def __init__(self, operation, code, message, attempts=1):
+        super().__init__(f"{operation} failed with {code}: {message}")
+        self.operation = operation
+        self.code = code
+        self.attempts = attempts
+
+
+# スロットリングが再試行の予算の中で収まらなかった
+class DynamoDBThrottledError(DynamoDBError):
+    pass
+
+
+# 一時的なエラーや通信のエラーが続いた（または再試行できない操作で起きた）
+class DynamoDBUnavailableError(DynamoDBError):
+    pass
+
+
+# 条件付きの書き込みの条件に合わなかった
+class DynamoDBConditionError(DynamoDBError):
+    pass
+
+
+# 読んだ時（またはキャッシュ）より後に、他のターンがユーザー情報を書いていた
+# item は今のユーザー情報（消えていたらNone）。キャッシュは書き換え済みなので、ターンをやり直せば新しい状態で読める
+class StaleUserError(DynamoDBConditionError):
+    def __init__(self, operation, user_id, item):
+        super().__init__(operation, 'ConditionalCheckFailedException', f"user_info of {user_id} was changed by another turn")
+        self.user_id = user_id
+        self.item = item
+
+
+def _error_code(e):
+    if isinstance(e, ClientError):
+        return e.response['Error']['Code']
+    return type(e).__name__
 
-def handle_dynamodb_exception(action, parameters):
+
+def _error_class(code, e):
+    if code in THROTTLE_ERROR_CODES:
+        return DynamoDBThrottledError
+    if code in TRANSIENT_ERROR_CODES or isinstance(e, TRANSIENT_EXCEPTIONS):
+        return DynamoDBUnavailableError
+    if code == 'ConditionalCheckFailedException':
+        return DynamoDBConditionError
+    return DynamoDBError
+
+
+# 1回の操作を呼ぶ。スロットリングと一時的なエラーは、揺らぎを入れた指数的な間隔で予算の中で再試行する
+# 呼び出し回数（lambda_io）は再試行を含めて1回と数え、再試行とスロットリングの回数、待った時間は計測値に出す
+# idempotent=False の操作（ADDで数える更新）は、処理されたか分からないエラーでは再試行しない
+def call_with_retry(operation, func, *args, idempotent=True, **kwargs):
+    deadline = time.monotonic() + min(DYNAMODB_RETRY_BUDGET_MS / 1000, lambda_deadline.hard_remaining())
+    attempt = 0
+    with lambda_io.span('dynamodb', operation):
+        while True:
+            attempt += 1
+            try:
+                return func(*args, **kwargs)
+            except (ClientError, BotoCoreError) as e:
+                code = _error_code(e)
+                error_class = _error_class(code, e)
+                if error_class is DynamoDBThrottledError:
+                    lambda_metrics.record(f'dynamodb.{operation}.throttles', 1, 'Count')
+                retryable = error_class is DynamoDBThrottledError or (error_class is DynamoDBUnavailableError and idempotent)
+                # 全ワーカーが同時に再開しないように、上限までの一様な揺らぎ（full jitter）
+                delay = random.uniform(0, min(DYNAMODB_BACKOFF_MAX_MS, DYNAMODB_BACKOFF_BASE_MS * 2 ** (attempt - 1))) / 1000
+                if not retryable or attempt >= DYNAMODB_MAX_ATTEMPTS or time.monotonic() + delay > deadline:
+                    lambda_metrics.record(f'dynamodb.{operation}.errors', 1, 'Count')
+                    message = e.response['Error'].get('Message', '') if isinstance(e, ClientError) else str(e)
+                    raise error_class(operation, code, message, attempt) from e
+                lambda_metrics.record(f'dynamodb.{operation}.retries', 1, 'Count')
+                lambda_metrics.record(f'dynamodb.{operation}.backoff_ms', delay * 1000, 'Milliseconds')
+                time.sleep(delay)
+
+
+# DAOの関数を再試行つきで呼び、失敗したらログに出して型付きの例外を投げる
+# 関数の中の呼び出しごと再試行するので、関数は何度呼んでも同じ結果になるように書く（そうでなければ idempotent=False）
+# operation は計測値の名前（既定は関数名）
+def handle_dynamodb_exception(action, parameters, idempotent=True, operation=None):
     def decorator(func):
+        @wraps(func)
         def wrapper(*args, **kwargs):
             try:
-                return func(*args, **kwargs)
-            except ClientError as e:
+                return call_with_retry(operation or func.__name__, func, *args, idempotent=idempotent, **kwargs)
+            except DynamoDBConditionError:
+                # 条件に合わないのは想定内なので呼び出し元に任せる
+                raise
+            except DynamoDBError as e:
                 logger.error(f"An error occurred while trying to {action} in DynamoDB.")
-                logger.error(f"Error message: {e.response['Error']['Message']}")
-                logger.error(f"Error code: {e.response['Error']['Code']}")
-                logger.error(f"Parameters: {parameters}")
-                return None
-            except Exception as e:
-                logger.error(f"An unknown error occurred while trying to {action} in DynamoDB.")
-                logger.error(f"Error: {e}")
+                logger.error(f"Error message: {e}")
+                logger.error(f"Error code: {e.code} after {e.attempts} attempt(s)")
                 logger.error(f"Parameters: {parameters}")
-                return None
+                raise
         return wrapper
     return decorator
 
+# user_infoの書き込みの条件（読んだ時の Version のままなら書く。0は Version を持たない以前からのユーザー）
+def _version_condition(expected_version, names, values):
+    names['#version'] = 'Version'
+    if not expected_version:
+        names['#user_id'] = 'user_id'
+        return 'attribute_exists(#user_id) AND attribute_not_exists(#version)'
+    values[':expected_version'] = expected_version
+    return '#version = :expected_version'
+
+# 条件に合わなかった書き込みのエラーを StaleUserError にする（ALL_OLD で返ってきた今のユーザー情報でキャッシュを書き換える）
+def _stale_user_error(operation, user_id, e):
+    old = e.response.get('Item')
+    item = {name: TypeDeserializer().deserialize(value) for name, value in old.items()} if old else None
+    if item is None:
+        lambda_user_cache.invalidate(user_id)
+    else:
+        lambda_user_cache.put(item)
+    return StaleUserError(operation, user_id, item)
+
+def _is_condition_failure(e):
+    return e.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
 # user情報を返す、なければNone
-@handle_dynamodb_exception('get_user_info', 'user_id parameter')
+# 温まったコンテナで覚えていればDynamoDBを読まない（書き込みは Version を条件にするので、古ければ書く時に分かる）
 def get_user_info(user_id):
-    response =  user_table.get_item(Key={'user_id': user_id})
+    item = lambda_user_cache.get(user_id)
+    if item is None:
+        item = _read_user_info(user_id)
+        lambda_user_cache.put(item)
+    return item
+
+@handle_dynamodb_exception('get_user_info', 'user_id parameter', operation='get_user_info')
+def _read_user_info(user_id):
+    response =  user_table.get_item(Key={'user_id': user_id}, ReturnConsumedCapacity='TOTAL')
+    lambda_metrics.record_capacity('get_user_info', response)
     # 'Item'キーがない場合、Noneを返す
     return response.get('Item', None)
 
-# 新しいユーザーを登録する
+# 新しいユーザーを登録する（Version は1から。渡した item にも入る）
+# 同時に他のターンが登録していたら StaleUserError
 @handle_dynamodb_exception('put_user_info', 'user_item parameter should be a dictionary containing user_id, limit, count, and CurrentPhase keys.')
 def put_user_info(item):
-    return user_table.put_item(Item=item)
+    item.setdefault('Version', 1)
+    try:
+        response = user_table.put_item(
+            Item=item,
+            ConditionExpression='attribute_not_exists(#user_id)',
+            ExpressionAttributeNames={'#user_id': 'user_id'},
+            ReturnValuesOnConditionCheckFailure='ALL_OLD',
+            ReturnConsumedCapacity='TOTAL'
+        )
+    except ClientError as e:
+        if not _is_condition_failure(e):
+            raise
+        raise _stale_user_error('put_user_info', item['user_id'], e) from e
+    lambda_metrics.record_capacity('put_user_info', response)
+    lambda_user_cache.put(item)
+    return response
+
+# 新しいゲームのセッションIDを作る（時刻順に並ぶようにする）
+def new_session_id():
+    return datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S') + '-' + uuid.uuid4().hex[:8]
+
+# 会話履歴のソートキー（セッションIDを先頭に付けて、今のゲームの履歴だけを読めるようにする）
+# SessionIdの無い以前からのユーザーは時刻だけ（以前の形式）
+def history_sort_key(session_id, timestamp):
+    if session_id is None:
+        return timestamp
+    return f'{session_id}#{timestamp}'
 
 # 会話履歴を返す
-@handle_dynamodb_exception('get_talk_history', 'user_id and count parameters')
-def get_talk_history(user_id):
-    return talk_history.query(
-        KeyConditionExpression=Key('user_id').eq(user_id),
-        # 最新ｘ件を取得
-        Limit = 15
+# session_idがあればそのゲームの履歴だけを読む（無ければ以前の形式のキーとしてパーティション全体）
+@handle_dynamodb_exception('get_talk_history', 'user_id, session_id and count parameters')
+def get_talk_history(user_id, session_id=None, count=15):
+    condition = Key('user_id').eq(user_id)
+    if session_id is not None:
+        condition = condition & Key('date').begins_with(f'{session_id}#')
+    response = talk_history.query(
+        KeyConditionExpression=condition,
+        # 最新ｘ件を取得（新しい順に読んでから古い順に並べ直す）
+        ScanIndexForward=False,
+        Limit = count,
+        ReturnConsumedCapacity='TOTAL'
     )
+    lambda_metrics.record_capacity('get_talk_history', response)
+    response['Items'] = list(reversed(response.get('Items', [])))
+    return response
+
+# 会話履歴を全部読む（ページごとに順に返すジェネレーター。アーカイブ用）
+# エラーはそのまま呼び出し元に投げる（途中で失敗したら削除させないため）
+def iter_talk_history(user_id, session_id=None):
+    condition = Key('user_id').eq(user_id)
+    if session_id is not None:
+        condition = condition & Key('date').begins_with(f'{session_id}#')
+    kwargs = {'KeyConditionExpression': condition, 'ReturnConsumedCapacity': 'TOTAL'}
+    while True:
+        response = call_with_retry('iter_talk_history', talk_history.query, **kwargs)
+        lambda_metrics.record_capacity('iter_talk_history', response)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+# 会話履歴をまとめて削除する（BatchWriteItemは25件ずつ、1秒あたりの件数を超えないように待つ）
+# 失敗したら全体をやり直す（削除済みのキーを消し直しても同じ）
+def batch_delete_talk_history(keys, max_per_second=None):
+    keys = list(keys)
+
+    def delete_all():
+        deleted = 0
+        started = time.monotonic()
+        with talk_history.batch_writer() as batch:
+            for key in keys:
+                batch.delete_item(Key={'user_id': key['user_id'], 'date': key['date']})
+                deleted += 1
+                if max_per_second and deleted % 25 == 0:
+                    # 書き込みキャパシティを使い切らないように速度を抑える
+                    wait = deleted / max_per_second - (time.monotonic() - started)
+                    if wait > 0:
+                        time.sleep(wait)
+        return deleted
+
+    return call_with_retry('batch_delete_talk_history', delete_all)
 
 # 新しい会話履歴を登録する
 @handle_dynamodb_exception('put_talk_history', 'talk_history parameter')
 def put_talk_history(item):
-    return talk_history.put_item(Item=item)
+    response = talk_history.put_item(Item=item, ReturnConsumedCapacity='TOTAL')
+    lambda_metrics.record_capacity('put_talk_history', response)
+    return response
 
-# countをインクリメント(+1)して数値を返す
-@handle_dynamodb_exception('increment_count', 'user_id, DynamoDB update operation, checking Attributes in response')
-def increment_count(user_id):
+# 1ターン分のイベントをまとめて書き込む（BatchWriteItemで25件ずつ）
+# 書けなかった分（UnprocessedItems）はスロットリングとして call_with_retry で送り直し、再試行しきれなければ DynamoDBThrottledError
+def put_turn_events(items):
+    for start in range(0, len(items), 25):
+        pending = {TURN_EVENTS_TABLE: [{'PutRequest': {'Item': item}} for item in items[start:start + 25]]}
 
-    response = user_table.update_item(
-        Key={'user_id': user_id},
-        UpdateExpression='ADD #count :inc',
-        ExpressionAttributeNames={'#count': 'count'},
-        ExpressionAttributeValues={':inc': 1},
-        ReturnValues="UPDATED_NEW")
-    
-    # 'Attributes'キーが存在し、その中に'count'キーが存在することを確認
-    if 'Attributes' in response and 'count' in response['Attributes']:
-        return response['Attributes']['count']
-    else:
-        logger.error(f"Error: Failed to update count for user_id {user_id}. Attributes or count missing in response.")
-        return None
+        def write_batch():
+            nonlocal pending
+            response = dynamodb.batch_write_item(RequestItems=pending, ReturnConsumedCapacity='TOTAL')
+            lambda_metrics.record_capacity('put_turn_events', response)
+            unprocessed = response.get('UnprocessedItems')
+            if unprocessed:
+                # 次の再試行では書けなかった分だけを送る
+                pending = unprocessed
+                count = sum(len(requests) for requests in unprocessed.values())
+                raise ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': f'{count} unprocessed turn events'}}, 'BatchWriteItem')
 
-# limitをインクリメント(+1)して数値を返す
-@handle_dynamodb_exception('increment_limit', 'user_id, DynamoDB update operation, checking Attributes in response')
-def increment_limit(user_id):
+        call_with_retry('put_turn_events', write_batch)
+    return len(items)
 
-    response = user_table.update_item(
-        Key={'user_id': user_id},
-        UpdateExpression='ADD #limit :inc',
-        ExpressionAttributeNames={'#limit': 'limit'},
-        ExpressionAttributeValues={':inc': 1},
-        ReturnValues="UPDATED_NEW")
-    
-    # 'Attributes'キーが存在し、その中に'limit'キーが存在することを確認
-    if 'Attributes' in response and 'limit' in response['Attributes']:
-        return response['Attributes']['limit']
-    else:
-        logger.error(f"Error: Failed to update limit for user_id {user_id}. Attributes or limit missing in response.")
-        return None
-        
-        
+# ゲームのイベントを番号順に全部読む（ページごとに順に返すジェネレーター。再生用）
+# エラーはそのまま呼び出し元に投げる
+def iter_turn_events(session_key, after_seq=None):
+    condition = Key('session_key').eq(session_key)
+    if after_seq is not None:
+        condition = condition & Key('event_key').gt(f'{after_seq:010d}#~')
+    kwargs = {'KeyConditionExpression': condition, 'ReturnConsumedCapacity': 'TOTAL'}
+    while True:
+        response = call_with_retry('iter_turn_events', turn_events.query, **kwargs)
+        lambda_metrics.record_capacity('iter_turn_events', response)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
 # フェーズに応じたプロンプトを取得
 @handle_dynamodb_exception('Failed to get prompt for phase', 'Phase parameter: {phase}')
 def get_prompt_for_phase(current_phase):
     # DynamoDB クライアントを初期化（この部分は環境に依存）
     table = dynamodb.Table('Prompts')
-    try:
-        # フェーズに対応するプロンプトを取得
-        response = table.get_item(
-            Key={
-                'Phase': current_phase
-            }
-        )
-        # プロンプトが存在するか確認
-        if 'Item' in response and 'Prompt' in response['Item']:
-            return response['Item']['Prompt']
-        else:
-            # 対応するプロンプトが存在しない場合の処理
-            logger.error(f"No prompt found for the phase: {current_phase}")
-            return None
-    except Exception as e:
-        logger.error(f"An error occurred while fetching prompt for phase {current_phase}: {e}")
+    # フェーズに対応するプロンプトを取得（エラーはhandle_dynamodb_exceptionで再試行する）
+    response = table.get_item(
+        Key={
+            'Phase': current_phase
+        },
+        ReturnConsumedCapacity='TOTAL'
+    )
+    lambda_metrics.record_capacity('get_prompt_for_phase', response)
+    # プロンプトが存在するか確認
+    if 'Item' in response and 'Prompt' in response['Item']:
+        return response['Item']['Prompt']
+    else:
+        # 対応するプロンプトが存在しない場合の処理
+        logger.error(f"No prompt found for the phase: {current_phase}")
         return None
    
 
-phase_order = [
-    "intro",
-    "investigation",
-    "reasoning",
-    "outro"
-]
+# カウンターの加算とフェーズの切り替えを1回の更新でまとめて行い、更新後のユーザー情報を返す
+# attributesには一緒に書き込む属性（SessionIdなど）、removeには消す属性を渡す
+# expected_versionを渡すと、読んだ時の Version のままの時だけ書く（他のターンが先に書いていたら StaleUserError）
+@handle_dynamodb_exception('update user state', "user_id, increments: dict of counter name to amount, next_phase: phase name or None, attributes: dict, remove: list, expected_version", idempotent=False)
+def update_user_state(user_id, increments, next_phase=None, attributes=None, remove=None, expected_version=None):
+    names = {}
+    values = {}
+    add_clauses = []
+    set_clauses = []
+    remove_clauses = []
+    for i, (counter, amount) in enumerate(increments.items()):
+        names[f'#c{i}'] = counter
+        values[f':c{i}'] = amount
+        add_clauses.append(f'#c{i} :c{i}')
+    if next_phase is not None:
+        names['#phase'] = 'CurrentPhase'
+        values[':next_phase'] = next_phase
+        set_clauses.append('#phase = :next_phase')
+    for i, (name, value) in enumerate((attributes or {}).items()):
+        names[f'#a{i}'] = name
+        values[f':a{i}'] = value
+        set_clauses.append(f'#a{i} = :a{i}')
+    for i, name in enumerate(remove or []):
+        names[f'#r{i}'] = name
+        remove_clauses.append(f'#r{i}')
+
+    # 何も変わらないなら書き込まない
+    if not add_clauses and not set_clauses and not remove_clauses:
+        return None
+
+    # 書くたびに Version を1つ進める（他のコンテナのキャッシュが古くなったことが書き込みの条件で分かる）
+    names['#version'] = 'Version'
+    values[':version_inc'] = 1
+    add_clauses.append('#version :version_inc')
+    kwargs = {}
+    if expected_version is not None:
+        kwargs['ConditionExpression'] = _version_condition(expected_version, names, values)
+        kwargs['ReturnValuesOnConditionCheckFailure'] = 'ALL_OLD'
+
+    expression = ['ADD ' + ', '.join(add_clauses)]
+    if set_clauses:
+        expression.append('SET ' + ', '.join(set_clauses))
+    if remove_clauses:
+        expression.append('REMOVE ' + ', '.join(remove_clauses))
 
-# フェーズを切り替える関数
-@handle_dynamodb_exception('update user phase', "user_id: {user_id}, current_phase: {current_phase}, next_phase: {next_phase}")
-def update_user_phase(user_id, current_phase):
     try:
-        # 現在のフェーズから次のフェーズを取得
-        next_phase_index = phase_order.index(current_phase) + 1
-        if next_phase_index >= len(phase_order):
-            logger.error(f"Error: No next phase after {current_phase} for user_id {user_id}")
+        response = user_table.update_item(
+            Key={'user_id': user_id},
+            UpdateExpression=' '.join(expression),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues="ALL_NEW",
+            **kwargs,
+            ReturnConsumedCapacity='TOTAL'
+        )
+    except ClientError as e:
+        if expected_version is None or not _is_condition_failure(e):
+            raise
+        raise _stale_user_error('update_user_state', user_id, e) from e
+    lambda_metrics.record_capacity('update_user_state', response)
+    lambda_user_cache.put(response.get('Attributes'))
+    return response.get('Attributes')
+
+# 連投制限用に、1分ごとの窓でChatGPTに渡したメッセージを数える（コンテナをまたいだ上限用）
+# 同じ窓なら+1、新しい窓なら1からやり直して、今の窓の数を返す
+# ゲームの状態ではないので Version は進めない（ターンの状態の書き込みとぶつからないように）
+@handle_dynamodb_exception('increment throttle window', "user_id, window: minutes since epoch", idempotent=False)
+def increment_throttle_window(user_id, window):
+    try:
+        response = user_table.update_item(
+            Key={'user_id': user_id},
+            UpdateExpression='ADD #count :one',
+            ConditionExpression='#window = :window',
+            ExpressionAttributeNames={'#count': 'ThrottleCount', '#window': 'ThrottleWindow'},
+            ExpressionAttributeValues={':one': 1, ':window': window},
+            ReturnValues='UPDATED_NEW',
+            ReturnConsumedCapacity='TOTAL'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # 窓が変わった（または初めて）
+        try:
+            response = user_table.update_item(
+                Key={'user_id': user_id},
+                UpdateExpression='SET #count = :one, #window = :window',
+                ConditionExpression='attribute_not_exists(#window) OR #window < :window',
+                ExpressionAttributeNames={'#count': 'ThrottleCount', '#window': 'ThrottleWindow'},
+                ExpressionAttributeValues={':one': 1, ':window': window},
+                ReturnValues='UPDATED_NEW',
+                ReturnConsumedCapacity='TOTAL'
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            # 同時に他のコンテナが新しい窓を始めた。数えられなかった時は制限しない
             return None
-        next_phase = phase_order[next_phase_index]
-    except ValueError:
-        logger.error(f"Error: Invalid current_phase {current_phase} for user_id {user_id}")
-        return None
+    lambda_metrics.record_capacity('increment_throttle_window', response)
+    return int(response['Attributes']['ThrottleCount'])
 
-    # ユーザーのCurrentPhaseを更新
-    response = user_table.update_item(
+# ユーザー情報を削除する（アーカイブ済みのゲームのみ。別のゲームが始まっていたら消さない）
+@handle_dynamodb_exception('delete_user_info', "user_id, expected_session_id")
+def delete_user_info(user_id, expected_session_id):
+    lambda_user_cache.invalidate(user_id)
+    response = user_table.delete_item(
         Key={'user_id': user_id},
-        UpdateExpression='SET #phase = :next_phase',
-        ExpressionAttributeNames={'#phase': 'CurrentPhase'},
-        ExpressionAttributeValues={':next_phase': next_phase},
-        ReturnValues="UPDATED_NEW"
+        ConditionExpression='#session = :session AND #phase = :end',
+        ExpressionAttributeNames={'#session': 'SessionId', '#phase': 'CurrentPhase'},
+        ExpressionAttributeValues={':session': expected_session_id, ':end': 'end'},
+        ReturnConsumedCapacity='TOTAL'
     )
-    
-    if 'Attributes' in response:
-        return response['Attributes']
-    else:
-        # このエラーメッセージはhandle_dynamodb_exceptionによってログに記録されます。
-        return None
+    lambda_metrics.record_capacity('delete_user_info', response)
+    return response
+
+# 特定のフェーズのユーザーを全部読む（ページごとに順に返すジェネレーター。バッチ処理用）
+def scan_users_in_phase(phase):
+    kwargs = {
+        'FilterExpression': Attr('CurrentPhase').eq(phase),
+        'ReturnConsumedCapacity': 'TOTAL'
+    }
+    while True:
+        response = call_with_retry('scan_users_in_phase', user_table.scan, **kwargs)
+        lambda_metrics.record_capacity('scan_users_in_phase', response)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+# フェーズごとのユーザーを読む（CurrentPhaseとLastActivityのGSIを使う。ページごとに順に返すジェネレーター）
+# inactive_secondsを渡すと、その秒数より長く発言していないユーザーだけ
+# LastActivityの無いユーザー（終わったゲームなど）はインデックスに載らない
+def query_phase_cohort(phase, inactive_seconds=None, page_size=100):
+    condition = Key('CurrentPhase').eq(phase)
+    if inactive_seconds is not None:
+        condition = condition & Key('LastActivity').lt(int(time.time()) - inactive_seconds)
+    kwargs = {
+        'IndexName': PHASE_INDEX_NAME,
+        'KeyConditionExpression': condition,
+        'Limit': page_size,
+        'ReturnConsumedCapacity': 'TOTAL'
+    }
+    while True:
+        response = call_with_retry('query_phase_cohort', user_table.query, **kwargs)
+        lambda_metrics.record_capacity('query_phase_cohort', response)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+# user_infoを分割スキャンの1ページ分だけ読む（管理ツール用。エラーは呼び出し元で再試行する）
+def scan_users_page(segment, total_segments, start_key=None, page_size=None):
+    kwargs = {'Segment': segment, 'TotalSegments': total_segments, 'ReturnConsumedCapacity': 'TOTAL'}
+    if start_key is not None:
+        kwargs['ExclusiveStartKey'] = start_key
+    if page_size is not None:
+        kwargs['Limit'] = page_size
+    response = call_with_retry('scan_users_page', user_table.scan, **kwargs)
+    lambda_metrics.record_capacity('scan_users_page', response)
+    return response
 
-# 終了するための関数
-@handle_dynamodb_exception('update user phase', "user_id: {user_id}, current_phase: {current_phase}, next_phase: {next_phase}")
-def update_user_phase_end(user_id):
-    next_phase = "end"
+# talk_historyを分割スキャンの1ページ分だけ読む（書き出し用。エラーは呼び出し元で再試行する）
+def scan_talk_history_page(segment, total_segments, start_key=None, page_size=None):
+    kwargs = {'Segment': segment, 'TotalSegments': total_segments, 'ReturnConsumedCapacity': 'TOTAL'}
+    if start_key is not None:
+        kwargs['ExclusiveStartKey'] = start_key
+    if page_size is not None:
+        kwargs['Limit'] = page_size
+    response = call_with_retry('scan_talk_history_page', talk_history.scan, **kwargs)
+    lambda_metrics.record_capacity('scan_talk_history_page', response)
+    return response
 
-    # ユーザーのCurrentPhaseを更新
-    response = user_table.update_item(
+# ユーザーの属性を書き換える（管理ツール用。消えたユーザーを作り直さないよう存在を条件にする）
+def update_user_attributes(user_id, values):
+    names = {f'#a{i}': name for i, name in enumerate(values)}
+    expression_values = {f':a{i}': value for i, value in enumerate(values.values())}
+    response = call_with_retry(
+        'update_user_attributes',
+        user_table.update_item,
         Key={'user_id': user_id},
-        UpdateExpression='SET #phase = :next_phase',
-        ExpressionAttributeNames={'#phase': 'CurrentPhase'},
-        ExpressionAttributeValues={':next_phase': next_phase},
-        ReturnValues="UPDATED_NEW"
+        UpdateExpression='SET ' + ', '.join(f'#a{i} = :a{i}' for i in range(len(values))) + ' ADD #version :one',
+        ConditionExpression='attribute_exists(user_id)',
+        ExpressionAttributeNames={**names, '#version': 'Version'},
+        ExpressionAttributeValues={**expression_values, ':one': 1},
+        ReturnConsumedCapacity='TOTAL'
     )
-    
-    if 'Attributes' in response:
-        return response['Attributes']
-    else:
-        # このエラーメッセージはhandle_dynamodb_exceptionによってログに記録されます。
-        return None
+    lambda_metrics.record_capacity('update_user_attributes', response)
+    lambda_user_cache.invalidate(user_id)
+    return response
+
+# ユーザー情報をまとめて書き込む（管理ツール用。BatchWriteItemで25件ずつ）
+# Version を進めるので、Lambdaのキャッシュに残っている古い情報では書き込めなくなる
+def batch_put_users(items):
+    def put_all():
+        with user_table.batch_writer() as batch:
+            for item in items:
+                batch.put_item(Item={**item, 'Version': int(item.get('Version', 0)) + 1})
+                lambda_user_cache.invalidate(item['user_id'])
+        return len(items)
+
+    return call_with_retry('batch_put_users', put_all)
@@ -0,0 +1,119 @@
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger()
+
+# 返信までに待てる時間（ミリ秒）。これを過ぎたら定型文で先に返信する
+TURN_REPLY_BUDGET_MS = int(os.getenv('TURN_REPLY_BUDGET_MS', '8000'))
+# リプライトークンの有効期間（ミリ秒）
+REPLY_TOKEN_LIFETIME_MS = int(os.getenv('REPLY_TOKEN_LIFETIME_MS', '60000'))
+# Lambdaの残り時間から差し引く余裕（ミリ秒）。返信や履歴の保存に使う
+DEADLINE_SAFETY_MARGIN_MS = int(os.getenv('DEADLINE_SAFETY_MARGIN_MS', '1500'))
+# Lambda以外（contextが無い時）に本回答を待つ最大時間（ミリ秒）
+TURN_HARD_BUDGET_MS = int(os.getenv('TURN_HARD_BUDGET_MS', '60000'))
+
+# GPTの呼び出しを流すスレッド数
+# 常駐サーバーではハンドラーのスレッド（SERVER_EXECUTOR_WORKERS）がそれぞれGPTを呼ぶので、これより少ないと
+# 呼び出しがスレッドの空き待ちで並び、待っただけで定型文を返すことになる。指定が無ければハンドラーのスレッドと同じ数にする
+GPT_EXECUTOR_WORKERS = int(os.getenv('GPT_EXECUTOR_WORKERS') or os.getenv('SERVER_EXECUTOR_WORKERS', '64'))
+_executor = ThreadPoolExecutor(max_workers=GPT_EXECUTOR_WORKERS, thread_name_prefix='gpt')
+
+# 1回のWebhookのLambdaのcontextと受け取った時刻（Webhookの全部のイベントで共通）
+_invocation = contextvars.ContextVar('deadline_invocation', default=None)
+# 1ターン（イベント1つ）分の締め切りと、定型文を先に返したかどうか
+_turn = contextvars.ContextVar('deadline_turn', default=None)
+
+
+# 締め切りを決める
+# received: Webhookを受け取った時刻（リプライトークンの有効期間はそこから数える）
+def _deadlines(context=None, received=None):
+    now = time.monotonic()
+    if received is None:
+        received = now
+    # 本回答の締め切り: Lambdaの残り時間（無ければ固定の予算）
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        hard_ms = context.get_remaining_time_in_millis() - DEADLINE_SAFETY_MARGIN_MS
+    else:
+        hard_ms = TURN_HARD_BUDGET_MS
+    hard_deadline = now + max(0, hard_ms) / 1000
+    # 返信の締め切り: このターンの応答時間の予算とリプライトークンの有効期間の早い方
+    reply_deadline = min(
+        now + TURN_REPLY_BUDGET_MS / 1000,
+        received + (REPLY_TOKEN_LIFETIME_MS - DEADLINE_SAFETY_MARGIN_MS) / 1000,
+        hard_deadline
+    )
+    return {
+        'reply_deadline': max(now, reply_deadline),
+        'hard_deadline': hard_deadline,
+        'holding_sent': False
+    }
+
+
+# Webhookを受け取った時に呼ぶ（ターンの締め切りはイベントごとに start_turn で決める）
+def start_invocation(context=None):
+    _invocation.set({'context': context, 'received': time.monotonic()})
+    _turn.set(None)
+
+
+# ターン（イベント1つ）の締め切りを決める
+# 1回のWebhookに複数のイベントが入っていても、前のイベントの締め切りや定型文の有無は引き継がない
+def start_turn(context=None):
+    invocation = _invocation.get() or {}
+    _turn.set(_deadlines(context or invocation.get('context'), invocation.get('received')))
+
+
+# 現在のターンの状態
+# start_turnが呼ばれていなければ（バッチやコマンドライン）、呼び出しごとに固定の予算で締め切りを決める
+# （覚えておくと、プロセスが長く動いた後は締め切りを過ぎたままになる）
+def _current():
+    turn = _turn.get()
+    if turn is None:
+        return _deadlines()
+    return turn
+
+
+# 返信の締め切りまでの残り秒数
+def reply_remaining():
+    return max(0.0, _current()['reply_deadline'] - time.monotonic())
+
+
+# 本回答の締め切りまでの残り秒数
+def hard_remaining():
+    return max(0.0, _current()['hard_deadline'] - time.monotonic())
+
+
+# 定型文を先に返したかどうか（返した後はpushで送る）
+def holding_sent():
+    return _current()['holding_sent']
+
+
+# 締め切り付きで関数を実行する
+# 返信の締め切りを過ぎたらon_timeoutで定型文を返し、本回答の締め切りまで待ち続ける
+# 本回答の締め切りも過ぎたらNoneを返す
+def run(func, *args, on_timeout=None, **kwargs):
+    turn = _current()
+    # 計測値などのコンテキストを引き継いで別スレッドで実行
+    ctx = contextvars.copy_context()
+    future = _executor.submit(ctx.run, func, *args, **kwargs)
+
+    if not turn['holding_sent']:
+        try:
+            return future.result(timeout=reply_remaining())
+        except FutureTimeoutError:
+            logger.info(f"Reply deadline exceeded in {getattr(func, '__name__', func)}; sending holding reply.")
+            turn['holding_sent'] = True
+            if on_timeout is not None:
+                on_timeout()
+
+    try:
+        return future.result(timeout=hard_remaining())
+    except FutureTimeoutError:
+        # まだ始まっていなければ取り消す（通信中のものは止められないので結果を捨てる）
+        # GPTの呼び出しは request_timeout を本回答の締め切りまでにしているので、その頃には終わってスレッドが空く
+        future.cancel()
+        logger.error(f"Hard deadline exceeded in {getattr(func, '__name__', func)}.")
+        return None
@@ -0,0 +1,156 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import lambda_dao
+
+logger = logging.getLogger()
+
+# ターンごとのイベントを記録するか（turn_eventsテーブルが必要）
+EVENT_LOG_ENABLED = os.getenv('EVENT_LOG_ENABLED', 'false').lower() == 'true'
+# このイベント数ごとに状態のスナップショットをログに残す
+SNAPSHOT_INTERVAL = int(os.getenv('EVENT_SNAPSHOT_INTERVAL', '50'))
+
+# イベントの種類
+TURN_RECEIVED = 'turn_received'
+COUNTER_CHANGED = 'counter_changed'
+PHASE_CHANGED = 'phase_changed'
+REPLY_SENT = 'reply_sent'
+SNAPSHOT = 'snapshot'
+
+# スナップショットに含めない属性（イベントの番号などの管理用）
+_UNTRACKED_ATTRIBUTES = ('EventSeq', 'Version')
+
+
+# イベントログのパーティションキー（ユーザーとゲームごと）
+def session_key(user_id, session_id):
+    return f'{user_id}#{session_id}'
+
+
+# イベントログのソートキー（番号順に並ぶよう桁を揃える。スナップショットは同じ番号の直後）
+def event_key(seq, snapshot=False):
+    return f'{seq:010d}#snapshot' if snapshot else f'{seq:010d}'
+
+
+# 1ターンで起きたことをイベントの一覧にする（番号はまだ振らない）
+def describe_turn(user, turn, query, speaker_id, replies):
+    events = [{'type': TURN_RECEIVED, 'phase': user['CurrentPhase'], 'query': query, 'speaker': speaker_id}]
+    for counter, delta in turn['increments'].items():
+        events.append({'type': COUNTER_CHANGED, 'counter': counter, 'delta': delta})
+    if turn['next_phase'] is not None and turn['next_phase'] != user['CurrentPhase']:
+        events.append({'type': PHASE_CHANGED, 'from': user['CurrentPhase'], 'to': turn['next_phase']})
+    events.append({'type': REPLY_SENT, 'replies': list(replies)})
+    return events
+
+
+# イベントに番号を振ってテーブルのアイテムにする
+# last_seqはユーザー情報の更新で返ってきたEventSeq（このターンの最後の番号）
+def build_items(user_id, session_id, events, last_seq, state=None):
+    key = session_key(user_id, session_id)
+    now = int(time.time() * 1000)
+    first_seq = last_seq - len(events) + 1
+    items = []
+    for offset, event in enumerate(events):
+        seq = first_seq + offset
+        items.append({
+            'session_key': key,
+            'event_key': event_key(seq),
+            'seq': seq,
+            'ts': now,
+            'user_id': user_id,
+            'session_id': session_id,
+            **event
+        })
+    # 区切りをまたいだらスナップショットも書く（再生はここから始められる）
+    if state is not None and (first_seq - 1) // SNAPSHOT_INTERVAL != last_seq // SNAPSHOT_INTERVAL:
+        items.append({
+            'session_key': key,
+            'event_key': event_key(last_seq, snapshot=True),
+            'seq': last_seq,
+            'ts': now,
+            'user_id': user_id,
+            'session_id': session_id,
+            'type': SNAPSHOT,
+            'state': {name: value for name, value in state.items() if name not in _UNTRACKED_ATTRIBUTES}
+        })
+    return items
+
+
+# ターンの状態を保存する
+# ユーザー情報（投影）の更新と、イベントログへの1回のまとめ書きを行い、更新後のユーザー情報を返す
+def commit_turn(user_id, session_id, user, turn, query, speaker_id, replies, attributes=None, remove=None):
+    increments = dict(turn['increments'])
+    events = None
+    if EVENT_LOG_ENABLED:
+        events = describe_turn(user, turn, query, speaker_id, replies)
+        # イベントの番号はユーザー情報の更新と一緒に確保する
+        increments['EventSeq'] = len(events)
+
+    # ターンの始めに読んだ状態のままの時だけ書く（他のターンが先に書いていたら StaleUserError。呼び出し元がやり直す）
+    state = lambda_dao.update_user_state(user_id, increments, turn['next_phase'], attributes, remove, expected_version=user.get('Version', 0))
+
+    if events and state is not None and 'EventSeq' in state:
+        items = build_items(user_id, session_id, events, int(state['EventSeq']), state)
+        try:
+            lambda_dao.put_turn_events(items)
+        except lambda_dao.DynamoDBError as e:
+            # 状態は更新済みなのでターンは続ける（この番号のイベントは欠ける。rebuild は次のスナップショットから正しくなる）
+            logger.error(f"Failed to write {len(items)} turn events of {user_id}: {e}")
+    return state
+
+
+# イベントを順に当てはめて状態を作り直す（snapshotから始めると早い）
+def project(events, snapshot=None):
+    state = dict(snapshot or {})
+    for event in events:
+        event_type = event['type']
+        if event_type == SNAPSHOT:
+            state = dict(event['state'])
+        elif event_type == TURN_RECEIVED:
+            # 最初のフェーズはフェーズ変更のイベントが無いので、発言を受けた時のフェーズを使う
+            state.setdefault('CurrentPhase', event['phase'])
+        elif event_type == COUNTER_CHANGED:
+            state[event['counter']] = state.get(event['counter'], 0) + event['delta']
+        elif event_type == PHASE_CHANGED:
+            state['CurrentPhase'] = event['to']
+    return state
+
+
+# ゲームのイベントログから状態を作り直す（直近のスナップショットから再生する）
+def rebuild(user_id, session_id):
+    events = list(lambda_dao.iter_turn_events(session_key(user_id, session_id)))
+    start = 0
+    for index in range(len(events) - 1, -1, -1):
+        if events[index]['type'] == SNAPSHOT:
+            start = index
+            break
+    return project(events[start:])
+
+
+# コマンドラインから状態を作り直す（--writeでuser_infoに書き戻す）
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rebuild a user_info projection from the turn event log.')
+    parser.add_argument('user_id')
+    parser.add_argument('--session', default=None, help='session id (default: the current SessionId)')
+    parser.add_argument('--write', action='store_true', help='write the rebuilt counters and phase back to user_info')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    current = lambda_dao.get_user_info(args.user_id) or {}
+    session_id = args.session or current.get('SessionId')
+    if session_id is None:
+        parser.error('no session id given and the user has no SessionId')
+    rebuilt = rebuild(args.user_id, session_id)
+    tracked = {name: rebuilt[name] for name in ('CurrentPhase', 'count', 'limit') if name in rebuilt}
+    print(json.dumps({'current': {name: current.get(name) for name in tracked}, 'rebuilt': tracked}, default=str, ensure_ascii=False))
+
+    if args.write and tracked:
+        lambda_dao.update_user_attributes(args.user_id, tracked)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
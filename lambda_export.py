@@ -0,0 +1,220 @@
+import argparse
+import io
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import lambda_archive
+import lambda_dao
+from lambda_backoff import AdaptiveBackoff, Checkpoint, call_with_backoff
+
+# INFOレベル以上のログメッセージを拾うように設定
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# 会話履歴を分析用の列指向ファイル（Parquet）に書き出す
+# 本番のテーブルを何度もスキャンしなくても、手元で何百万ターンでも集計できるようにする
+#   - 分割スキャン（前回の続きから。--checkpoint）
+#   - DynamoDB Streams（stream_handler をトリガーにする）
+# ファイルは <target>/dt=YYYY-MM-DD/<実行ID>-<番号>.parquet（日付は会話の日本時間）
+
+# 書き出し先。s3://bucket/prefix ならS3、それ以外はローカルのディレクトリ
+EXPORT_TARGET = os.getenv('EXPORT_TARGET', '')
+# 1ファイルあたりの行数
+EXPORT_ROWS_PER_FILE = int(os.getenv('EXPORT_ROWS_PER_FILE', '100000'))
+# 会話の時刻（date）はターンの始まりで、書き込まれるのはChatGPTの返答の後なので、
+# スキャンを始めた時刻からこの秒数より前の会話だけを書き出す（ターンの最長の時間より長くする）
+EXPORT_WATERMARK_MARGIN_SECONDS = int(os.getenv('EXPORT_WATERMARK_MARGIN_SECONDS', '300'))
+
+# 列（user_id などの繰り返しの多い列は辞書エンコードする）
+DICTIONARY_COLUMNS = ('user_id', 'session_id', 'phase', 'location', 'speaker')
+STRING_COLUMNS = ('message', 'reply')
+
+
+def _schema():
+    import pyarrow as pa
+
+    fields = [pa.field(name, pa.dictionary(pa.int32(), pa.string())) for name in DICTIONARY_COLUMNS]
+    fields.insert(2, pa.field('ts', pa.timestamp('ms', tz='UTC')))
+    fields.extend(pa.field(name, pa.string()) for name in STRING_COLUMNS)
+    return pa.schema(fields)
+
+
+# talk_historyのアイテムを1行にする
+# date は <SessionId>#<ISO 8601>（SessionIdが付く前の履歴は時刻だけ）
+def turn_row(item):
+    session_id, _, timestamp = item['date'].rpartition('#')
+    moment = datetime.fromisoformat(timestamp)
+    return {
+        'user_id': item['user_id'],
+        'session_id': item.get('session_id') or session_id or None,
+        'ts': int(moment.timestamp() * 1000),
+        'phase': item.get('phase'),
+        'location': item.get('location'),
+        'speaker': item.get('speaker'),
+        'message': item.get('message'),
+        'reply': item.get('reply'),
+        # パーティション（会話した日）
+        'dt': timestamp[:10]
+    }
+
+
+# 行をParquetのバイト列にする
+def to_parquet(rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _schema()
+    columns = {}
+    for field in schema:
+        values = [row[field.name] for row in rows]
+        if field.name in DICTIONARY_COLUMNS:
+            columns[field.name] = pa.array(values, pa.string()).dictionary_encode()
+        else:
+            columns[field.name] = pa.array(values, field.type)
+    table = pa.Table.from_pydict(columns, schema=schema)
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='zstd')
+    return buffer.getvalue()
+
+
+# 日付ごとに行を溜めて、一定の行数でファイルにする
+class PartitionWriter:
+    def __init__(self, target, run_id, rows_per_file=None):
+        self.target = target
+        self.run_id = run_id
+        self.rows_per_file = rows_per_file or EXPORT_ROWS_PER_FILE
+        self.partitions = {}
+        self.buffered = 0
+        self.files = []
+        self.rows = 0
+
+    def add(self, row):
+        self.partitions.setdefault(row['dt'], []).append(row)
+        self.buffered += 1
+
+    def full(self):
+        return self.buffered >= self.rows_per_file
+
+    def flush(self):
+        for dt, rows in sorted(self.partitions.items()):
+            key = f'dt={dt}/{self.run_id}-{len(self.files):05d}.parquet'
+            self.files.append(lambda_archive.write_archive(self.target, key, to_parquet(rows), content_type='application/vnd.apache.parquet'))
+            self.rows += len(rows)
+        self.partitions = {}
+        self.buffered = 0
+
+
+# 1つのセグメントを書き出す（ファイルに書いてから読み込み位置を保存するので、中断しても行は失われない）
+def export_segment(segment, args, since, until, checkpoint, backoff, run_id, summary, lock):
+    start_key = checkpoint.get(segment)
+    if start_key == 'done':
+        return
+    writer = PartitionWriter(args.target, f'{run_id}-s{segment:03d}', args.rows_per_file)
+    while True:
+        response = call_with_backoff(backoff, lambda_dao.scan_talk_history_page, segment, args.segments, start_key, args.page_size)
+        for item in response.get('Items', []):
+            row = turn_row(item)
+            # 前回の範囲の後から、今回の範囲の終わりまで（それより新しい会話は次の実行で書き出す）
+            if since < row['ts'] <= until:
+                writer.add(row)
+        start_key = response.get('LastEvaluatedKey')
+        if writer.full() or start_key is None:
+            writer.flush()
+            checkpoint.save(segment, start_key or 'done')
+        if start_key is None:
+            break
+    with lock:
+        summary['rows'] += writer.rows
+        summary['files'] += len(writer.files)
+    logger.info(f"Segment {segment} exported {writer.rows} turns in {len(writer.files)} files.")
+
+
+# 分割スキャンで書き出す（前回の続きから）
+def export_scan(args):
+    checkpoint = Checkpoint(args.checkpoint)
+    since = int(checkpoint.state.get('watermark', 0))
+    if checkpoint.state.get('segments', args.segments) != args.segments:
+        raise ValueError(f"checkpoint was written with --segments {checkpoint.state['segments']}")
+    checkpoint.save('segments', args.segments)
+    # 今回の範囲の終わり（途中で止まった実行を再開する時は、同じ範囲のまま続ける）
+    until = checkpoint.state.get('until')
+    if until is None:
+        until = int((time.time() - EXPORT_WATERMARK_MARGIN_SECONDS) * 1000)
+        checkpoint.save('until', until)
+    # 途中で止まった実行を再開する時は、同じ実行IDでファイル名がぶつからないよう新しく振る
+    run_id = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    backoff = AdaptiveBackoff()
+    summary = {'rows': 0, 'files': 0, 'until': until}
+    lock = threading.Lock()
+
+    with ThreadPoolExecutor(max_workers=args.workers or args.segments) as executor:
+        futures = [
+            executor.submit(export_segment, segment, args, since, until, checkpoint, backoff, run_id, summary, lock)
+            for segment in range(args.segments)
+        ]
+        errors = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Segment failed: {e}")
+                errors += 1
+
+    if not errors and checkpoint.path:
+        # 全部終わったら、次は今回の範囲の終わりより後を書き出す
+        # （書き出した一番新しい会話の時刻にすると、後から書き込まれた、それより前の時刻の会話を取りこぼす）
+        checkpoint.state = {}
+        checkpoint.save('watermark', until)
+    summary['errors'] = errors
+    logger.info(f"Export summary: {summary}")
+    return summary
+
+
+# DynamoDB Streams（talk_historyの新しいイメージ）を受け取って書き出すLambdaハンドラー
+def stream_handler(event, context):
+    from boto3.dynamodb.types import TypeDeserializer
+
+    deserializer = TypeDeserializer()
+    writer = PartitionWriter(EXPORT_TARGET, f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}")
+    for record in event.get('Records', []):
+        if record.get('eventName') not in ('INSERT', 'MODIFY'):
+            continue
+        image = record.get('dynamodb', {}).get('NewImage')
+        if not image:
+            continue
+        item = {name: deserializer.deserialize(value) for name, value in image.items()}
+        writer.add(turn_row(item))
+    if writer.buffered:
+        writer.flush()
+    logger.info(f"Exported {writer.rows} turns from the stream in {len(writer.files)} files.")
+    return {'rows': writer.rows, 'files': writer.files}
+
+
+# コマンドラインから実行する
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export talk_history turns to partitioned Parquet files.')
+    parser.add_argument('--target', default=EXPORT_TARGET, help='s3://bucket/prefix or a local directory')
+    parser.add_argument('--checkpoint', default=None, help='file to keep progress and the export watermark in')
+    parser.add_argument('--segments', type=int, default=4, help='number of scan segments')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker threads (default: segments)')
+    parser.add_argument('--page-size', type=int, default=None, help='items per scan page')
+    parser.add_argument('--rows-per-file', type=int, default=EXPORT_ROWS_PER_FILE, help='rows per Parquet file')
+    args = parser.parse_args(argv)
+    if not args.target:
+        parser.error('--target or EXPORT_TARGET is required')
+    logging.basicConfig(level=logging.INFO)
+    try:
+        summary = export_scan(args)
+    except ValueError as e:
+        parser.error(str(e))
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
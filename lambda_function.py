@@ -3,8 +3,22 @@ import logging
 import openai
 import os
 import sys
+import time
 import boto3
+import lambda_archive
 import lambda_dao
+import lambda_deadline
+import lambda_events
+import lambda_io
+import lambda_location
+import lambda_metrics
+import lambda_phase
+import lambda_profile
+import lambda_reasoning
+import lambda_scenario
+import lambda_throttle
+import lambda_usage
+import lambda_user_cache
 
 from datetime import datetime
 from zoneinfo import ZoneInfo
@@ -37,203 +51,200 @@ if CHANNEL_ACCESS_TOKEN is None or CHANNEL_SECRET is None or openai.api_key is N
 line_bot_api = LineBotApi(CHANNEL_ACCESS_TOKEN)
 webhook_handler = WebhookHandler(CHANNEL_SECRET)
 
+# グループやトークルームでボットに話しかける時の合図（空なら全部のメッセージに反応）
+GROUP_TRIGGER_PREFIX = os.getenv('GROUP_TRIGGER_PREFIX', '')
+
+# 読んだ後に他のターンがフェーズを進めていた（返答が前のフェーズで作られているので、送る前にターンをやり直す）
+# query は連投制限でまとめたメッセージ（やり直しでも同じものを使う）
+class PhaseChangedError(Exception):
+    def __init__(self, user_id, query):
+        super().__init__(f"CurrentPhase of {user_id} was changed by another turn")
+        self.query = query
+
 # ユーザーからのメッセージを処理する
 @webhook_handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
+    # ターンの計測を開始
+    lambda_metrics.start_turn()
+    lambda_io.start_turn()
+    # このイベントの返信と本回答の締め切りを決める
+    lambda_deadline.start_turn()
+    lambda_usage.start_turn()
+    try:
+        with lambda_metrics.span('handle_message'):
+            try:
+                _handle_message(event)
+            except PhaseChangedError as e:
+                logger.info(f"{e}; running the turn again.")
+                lambda_metrics.record('user_cache.reruns', 1, 'Count')
+                _handle_message(event, admitted_query=e.query)
+    finally:
+        # 連投制限のターンを終える
+        lambda_throttle.release()
+        # DynamoDB、OpenAI、LINEの呼び出し回数をまとめる
+        lambda_io.finish()
+        # 計測値を1行にまとめて出力
+        lambda_metrics.flush()
+
+# admitted_query: やり直しの時に、連投制限を通ったメッセージ（もう一度は数えない）
+def _handle_message(event, admitted_query=None):
+    # DynamoDBのエラーで返す定型文に使う（読み込む前なら既定のシナリオ）
+    scenario = None
     try:
         # eventからsourceを取得
         source = event.source
         
-        # sourceからuserIdを取得
-        user_id = source.user_id
+        # sourceからセッションのIDを取得
+        # グループやトークルームではメンバー全員で1つのセッション（状態も会話履歴も共有）
+        user_id = get_session_id(source)
+        
+        # 発言したメンバーのuserId（個人チャットではuser_idと同じ）
+        speaker_id = getattr(source, 'user_id', None)
+        is_group = user_id != speaker_id
         
         # ユーザーからのメッセージ
         query = event.message.text
         
-        # ユーザー情報を取得
-        get_user = lambda_dao.get_user_info(user_id)
+        if query is None:
+            logger.error("query is None")
+            return
         
-        # ユーザー情報がない場合新しく作成
-        if get_user is None:
-            user_item = {'user_id': user_id, 'limit': 0, 'count': 0,'CurrentPhase': 'intro'}
-            lambda_dao.put_user_info(user_item)
-            get_user = lambda_dao.get_user_info(user_id)
-            
-        # 返答メッセージリストの初期化
-        answer_list = []
+        # グループでは合図の言葉で始まるメッセージだけに反応する（雑談でChatGPTを呼ばない）
+        if is_group and GROUP_TRIGGER_PREFIX:
+            if not query.startswith(GROUP_TRIGGER_PREFIX):
+                return
+            query = query[len(GROUP_TRIGGER_PREFIX):].strip()
         
+        # ユーザー情報を取得（このターンで読むのはこの1回だけ。温まったコンテナでは覚えている情報を使う）
+        user = lambda_dao.get_user_info(user_id)
+        
+        # ユーザー情報がない場合新しく作成（既定のシナリオで始める）
+        if user is None:
+            scenario = lambda_scenario.get_scenario()
+            user = lambda_phase.initial_user_item(scenario['machine'], user_id)
+            user['ScenarioId'] = scenario['id']
+            user['SessionId'] = lambda_dao.new_session_id()
+            user['LastActivity'] = int(time.time())
+            try:
+                lambda_dao.put_user_info(user)
+            except lambda_dao.StaleUserError as e:
+                # 同時に届いたメッセージで他のターンが先に登録していた（そのユーザー情報で続ける）
+                if e.item is None:
+                    raise
+                user = e.item
+                scenario = lambda_scenario.get_scenario(user.get('ScenarioId'))
+        else:
+            # ユーザーのシナリオを取得（初回だけ読み込み、以降はプロセス内のキャッシュ）
+            scenario = lambda_scenario.get_scenario(user.get('ScenarioId'))
+
+        # シナリオを読み込めずに既定のシナリオを使う時など、今のフェーズがシナリオに無ければ最初からやり直す
+        if user['CurrentPhase'] not in scenario['machine']['phases']:
+            user = restart_in_scenario(scenario, user)
+            
         # 現在時刻を取得
         now_obj = datetime.now(ZoneInfo("Asia/Tokyo"))
         
         # 現在時刻を文字列に変換
         now = now_obj.isoformat()
 
+        # 今のゲームのセッションID
+        # SessionIdの無い以前からのユーザーは、途中のゲームの履歴を読めるように、そのゲームが終わるまで以前の形式のキーのまま
+        session_id = user.get('SessionId')
+        # 最後に発言した時刻もターンごとの更新に含める（フェーズ別インデックスの並び順に使う）
+        state_attributes = {'LastActivity': int(time.time())}
+
         # 現在のフェーズを確認
-        current_phase = lambda_dao.get_user_info(user_id)['CurrentPhase']
+        current_phase = user['CurrentPhase']
+        lambda_metrics.set_dimension('Phase', current_phase)
+        lambda_metrics.set_dimension('Scenario', scenario['id'])
+        lambda_io.set_phase(current_phase)
 
-        # ChatGPTを使わない定型文を変数に格納している。
-        counterattack ='お見通しだよ'
+        # 現在のフェーズのルールだけを評価して、このターンにやることを決める
+        turn = lambda_phase.evaluate_turn(scenario['machine'], user, query)
+        phase = turn['phase']
 
-        first_line = "ああ、何でも聞いてくれてかまわない。"
+        # ChatGPTを使わない定型文を返す場合は、状態をまとめて更新して終わり
+        if turn['replies']:
+            commit_turn(scenario, user_id, session_id, user, turn, query, speaker_id, turn['replies'], state_attributes)
+            result = reply_message(event.reply_token, [TextSendMessage(text=reply) for reply in turn['replies']])
+            # ゲームが終わったら、返信の後で会話履歴のアーカイブを別のLambdaに頼む
+            if turn['next_phase'] == 'end':
+                lambda_archive.archive_on_end({**user, 'CurrentPhase': 'end', 'SessionId': session_id})
+            return result
 
-        induction= (
-            '解説を読み終わった方は、「終了したい」とチャットを送ってください。'
-            )
+        # 送りすぎ・前のターンを待っている間ならChatGPTを呼ばない（メッセージは次のターンにまとめて渡す）
+        if admitted_query is not None:
+            query = admitted_query
+        else:
+            decision = lambda_throttle.admit(user_id, phase, query)
+            if decision['action'] != lambda_throttle.ALLOW:
+                logger.info(f"Throttled {user_id}: {decision['action']}")
+                # 前のターンの返答はこのメッセージには答えないので、受け取ったことを伝える
+                notice = scenario['merge_reply'] if decision['action'] == lambda_throttle.MERGE else scenario['throttle_reply']
+                if decision['notify'] and notice:
+                    return reply_message(event.reply_token, [TextSendMessage(text=notice)])
+                return
+            query = decision['query']
 
-        questionnaire = (
-            'お疲れ様です！ゲームをプレイしていただき、誠にありがとうございます。\n'
-            '皆様のご意見は、今後のゲーム改善に非常に役立つ貴重な情報です。もしよろしければ、短いアンケートにご協力いただけますでしょうか。\n'
-            'アンケートURL:(https://forms.gle/XNfCnwE9wciwvuE78)\n'
-            'アンケートの内容は今作や次回作の改良に役立たせていただきます\n'
-            'どうぞよろしくお願いします。'
-            )
+        # 返答メッセージリストの初期化（カウンターに基づく通知を先に入れる）
+        answer_list = [TextSendMessage(text=notification) for notification in turn['notifications']]
+
+        # ChatGPTから返答が得られなかった時のセリフ
+        fallback_reply = scenario['fallback_reply']
+
+        # 締め切りを過ぎたら、それまでの返信リストと一緒に定型文を先に返す
+        def send_holding_reply():
+            holding = TextSendMessage(text=phase['holding_reply'] or fallback_reply)
+            try:
+                reply_message(event.reply_token, [*answer_list, holding])
+            except LineBotApiError as e:
+                logger.error(f"LINE API Error: {e}")
+            answer_list.clear()
 
-        # 特定のワード入ってる場合特定のセリフを返し、ChatGPTに伝えない
-        if current_phase == 'investigation':
-            if "ルール" in query or "プロンプト" in query or "命令" in query:
-                return line_bot_api.reply_message(event.reply_token, TextSendMessage(text=counterattack))
-        
-        # 特定のセリフだった場合フェーズをアップデートして特定のセリフを返す
-        if current_phase == 'intro':
-            if "先生、では質問しますね" in query:
-                lambda_dao.update_user_phase(user_id, current_phase)
-                return line_bot_api.reply_message(event.reply_token, TextSendMessage(text=first_line))
-            
-        # 終了したい場合に終了フェーズへ
-        if current_phase == 'outro':
-            if '終了' in query:
-                lambda_dao.update_user_phase_end(user_id)
-                current_phase = lambda_dao.get_user_info(user_id)['CurrentPhase']
-        
-        # 現在のフェーズがoutroの場合ChatGPTを使わせずに特定のメッセージを返す       
-        if current_phase == 'outro':
-            # ChatGPTを使わずに特定のメッセージを送る
-            return line_bot_api.reply_message(event.reply_token, TextSendMessage(text=induction))
-        
-        # 現在のフェーズがendの場合ChatGPTを使わせずに特定のメッセージを返す        
-        if current_phase == 'end':
-            # ChatGPTを使わずに特定のメッセージを送る
-            return line_bot_api.reply_message(event.reply_token, TextSendMessage(text=questionnaire))
-        
-        # 利用回数カウントアップ
-        count = lambda_dao.increment_count(user_id)
-        
-        # もし、意図的にイントロで質問しまくる人がいる場合排除
-        if current_phase == 'intro':
-            if count == 19:
-                eliminate_unauthorized_use = "質問の時間は次の次で終了しますゲームを開始したい場合は、「先生、では質問しますね」とチャットで送信してください。もし、質問を続けた場合はゲームをプレイできません。"
-                answer_list.append(TextSendMessage(text=eliminate_unauthorized_use))
-                
-            elif count == 21:
-                lambda_dao.update_user_phase_end(user_id)
-
-        # limitという変数の定義
-        limit = lambda_dao.get_user_info(user_id)['limit']
-        # 利用制限回数カウントアップ
-        # 現在のフェーズが「調査フェーズ」である場合にのみ、カウントアップ
-        if current_phase == 'investigation':
-            limit = lambda_dao.increment_limit(user_id)
-            
-        # タイムリミットに基づく通知やフェーズの変更
-        time_limit_notification = ""
-        if limit == 15:
-            time_limit_notification = "もう時間も半分が過ぎたけど調子はどうかな？"
-        elif limit == 25:
-            time_limit_notification = "あと少ししか時間は残っていない。後10分程度だ。もうすぐ家を出る準備を始めようと思うから急いでくれ。"
-        elif limit == 30:
-            time_limit_notification = "時間だな。君がどんな推理をしたのか聞かせてもらおうか。"
-            lambda_dao.update_user_phase(user_id, current_phase)
-            
-        # タイムリミットに基づく通知が存在する場合、それも返信リストに追加
-        if current_phase == 'investigation':
-            if time_limit_notification:
-                answer_list.append(TextSendMessage(text=time_limit_notification))
-                
-        # 過去の会話履歴を保存
-        get_talk = lambda_dao.get_talk_history(user_id)
-        past_conversations = get_past_conversations(get_talk)
-        
         # フェーズに応じたプロンプトを取得
-        current_prompt = lambda_dao.get_prompt_for_phase(current_phase)
+        current_prompt = lambda_scenario.get_prompt(scenario, current_phase)
         
         if current_prompt is None:
             logger.error("current_prompt is None")
             return
         
+        # 過去の会話履歴を取得（履歴を使わないフェーズでは読まない）
+        past_conversations = []
+        if phase['read_history']:
+            get_talk = lambda_dao.get_talk_history(user_id, session_id)
+            past_conversations = get_past_conversations(get_talk, group=is_group)
+        
         if any(conv is None or conv.get('content') is None for conv in past_conversations):
             logger.error("Invalid value in past_conversations")
             return
         
-        if query is None:
-            logger.error("query is None")
-            return        
-        
         # 会話履歴をChatGPTに渡すmessagesに追加
-        try:
-            past_conversations = None
-            # reasoning以外の場合会話履歴を取得
-            if current_phase != 'reasoning':
-                past_conversations = get_past_conversations(get_talk)
-            
-            if not past_conversations:
-                # past_conversationsがなければ何もしない（または別の手続き）
-                messages = [
-                    {'role': 'system', 'content': current_prompt}, 
-                    {'role': 'user', 'content': query}
-                ]
-            else:
-                messages = [
-                    {'role': 'system', 'content': current_prompt}, 
-                    *past_conversations, 
-                    {'role': 'user', 'content': query}
-                ]
-        except Exception as e:
-            logger.error(f"An unexpected error occurred: {e}")
+        user_message = {'role': 'user', 'content': query}
+        # グループでは誰の発言か分かるようにする
+        if is_group and speaker_id:
+            user_message['name'] = get_speaker_name(speaker_id)
+        messages = [
+            {'role': 'system', 'content': current_prompt}, 
+            *past_conversations, 
+            user_message
+        ]
 		# Logにmessagesを出力
         logger.info(messages)
-        
-        # ファンクションコーリングの関数を呼び出す判断をChatGPTにさせるための条件とか抜き出す単語とかを指定してる
-        functions=[
-            {
-                "name": "want_survey_location",
-                "description": "ユーザーが特定の場所を調査したい場合は、場所の名前を保存する。",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "location_name": {
-                            "type": "string",
-                            'description': 'ユーザーが調査したい場所の名前。例えば、"リビング"、"テーブル"、"テーブルの影"、"仕事机"、"服のポケット"など。'
-                        },
-                    }
-                },
-                "required": ["location_name"]
-            },
-            {
-                "name": "update_user_phase_investigation",
-                "description": "ユーザーが推理を宣言してもいいか許可を得てきたときに呼ぶ関数",
-                # 必要ないけど無いと作用しないのでダミーパラメーターを用意した
-                "parameters": {
-                  "type": "object",
-                  "properties": {
-                    "dummy": {
-                      "type": "string",
-                      "description": "This is a dummy parameter."
-                    }
-                  },
-                  "required": []
-                }
-            }
-        ]
             
-        # ChatGPTに質問を投げて回答を取得する
-        if current_phase != "investigation":
-            answer_response = call_second_gpt(messages)
-        else:
-            answer_response = call_gpt(messages, functions)
-        # answer_responseの中身が無かったらエラーを吐く
+        # ChatGPTに質問を投げて回答を取得する（締め切りを過ぎたら定型文を先に返す）
+        try:
+            if phase['gpt'] == 'functions':
+                answer_response = lambda_deadline.run(call_gpt, messages, scenario['function_schemas'], on_timeout=send_holding_reply)
+            else:
+                answer_response = lambda_deadline.run(call_second_gpt, messages, on_timeout=send_holding_reply)
+        except Exception as e:
+            logger.error(f"An error occurred while calling GPT: {e}")
+            answer_response = None
+        # answer_responseの中身が無かったらエラーを吐いて、無言にならないように定型文を返す
         if answer_response is None:
             logger.error("Failed to get a response from GPT.")
-            return
+            answer_list.append(TextSendMessage(text=fallback_reply))
+            return send_messages(event, answer_list)
         # １回目のChatGPTからの返信を変数answerに入れる。answerは実際にメッセージをLINEに返すときに使う変数。
         answer = answer_response["choices"][0]["message"]["content"]
 		# １回目のChatGPTからの返信から２回目の呼び出しに使う部分を取り出す
@@ -245,39 +256,32 @@ def handle_message(event):
         # urlの変数が未定義だとエラーが起こるので先に定義
         url_01 = None
         url_02 = None
+        # 調べた場所（会話履歴に残して分析に使う）
+        location = None
         
         # モデルが関数を呼び出したいかどうかを確認
         if message.get("function_call"):
             function_name = message["function_call"]["name"]
             arguments = json.loads(message["function_call"]["arguments"])
-  	        # ユーザーが推理を宣言してもいいか許可を得てきたときに呼ぶ関数              
-            if function_name == "update_user_phase_investigation":
-                # ユーザーの現在のフェーズを取得
-                current_phase = lambda_dao.get_user_info(user_id)['CurrentPhase']
-                # ファンクションコーリングの暴発防止
-                if "発表" in query:
-                    # 条件に合致するか確認
-                    if current_phase == 'investigation':
-                        # フェーズを次の段階に移行
-                        lambda_dao.update_user_phase(user_id, current_phase)
-                        second_response = call_second_gpt(messages)
-                        answer = second_response["choices"][0]["message"]["content"]
-                    
-                else:  #なんか無理やり違うフェーズなのに呼び出そうとしてエラー起こすから軌道修正
-                    second_response = call_second_gpt(messages)
-                    answer = second_response["choices"][0]["message"]["content"]
-					
-            # ユーザーが特定の場所を調査したい場合呼ぶ関数
-            elif function_name == "want_survey_location":
-                # ユーザーの現在のフェーズを取得
-                current_phase = lambda_dao.get_user_info(user_id)['CurrentPhase']
-                # 条件に合致するか確認
-                if current_phase == 'investigation':
+            action = lambda_phase.function_action(phase, function_name, query)
+            # このターンで既にフェーズが移っていたら、関数の処理はしない
+            if action is not None and turn['next_phase'] is None:
+                # 条件に合えばフェーズを次の段階に移行
+                if action['goto'] is not None:
+                    turn['next_phase'] = action['goto']
+                # ユーザーが特定の場所を調査したい場合
+                if action['action'] == 'survey_location':
                     # 場所の名前を取得
-                    location_name = arguments["location_name"]
-                    url_01 = get_url_based_on_keyword_place(location_name, url_mapping)
-                    second_response = call_second_gpt(messages)
-                    answer = second_response["choices"][0]["message"]["content"]
+                    location_name = arguments.get("location_name")
+                    location, url_01 = get_url_based_on_keyword_place(location_name, scenario['location_index'])
+            # 関数を呼んだ時の返答は本文が無いので、２回目の呼び出しで作り直す
+            # 失敗や締め切り切れでも、関数の結果（フェーズの移行や場所のURL）と一緒に定型文を返す
+            try:
+                second_response = lambda_deadline.run(call_second_gpt, messages, on_timeout=send_holding_reply)
+            except Exception as e:
+                logger.error(f"An error occurred while calling GPT for the function result: {e}")
+                second_response = None
+            answer = get_answer(second_response, fallback_reply)
                 
         # 受け取った回答のJSONを目視確認できるようにINFOでログに吐く
         logger.info(answer)
@@ -285,25 +289,26 @@ def handle_message(event):
         # GPTからのレスポンス（answer変数）を返信リストに追加
         answer_list.append(TextSendMessage(text=answer))
         
-        #推理が正解か不正解か判別するキーワード
-        keywords = ["契約", "破棄", "成田", "さき",  "擦ると消える", "アイロン"]
-        
         #推理フェーズの時にキーワードの数で正解のURLか不正解のURLかに決める
-        if current_phase == "reasoning":
-            #フェーズをアップデート
-            lambda_dao.update_user_phase(user_id, current_phase)
+        if phase['ending']:
             answer_list.append(TextSendMessage(text='エンディング'))
-            #正解か不正解か判別してURLを変える
-            if check_keywords(query, keywords):
+            endings = scenario['endings']
+            #推理を採点して、正解か不正解か判別してURLを変える
+            reasoning_result = lambda_reasoning.score(scenario['reasoning'], query)
+            logger.info(reasoning_result)
+            lambda_metrics.record('reasoning.score', reasoning_result['score'], 'None')
+            if reasoning_result['passed']:
                 #エンディング１
-                url_01 = "https://docs.google.com/document/d/1j23deV8p8PwYVdYBxhHL0id7vxjd1iwOr0GjFkTuGXw/edit?usp=sharing"
-                #解説
-                url_02 = "https://docs.google.com/document/d/10MUbcFgBWeIK18LUYyntIJ6eC-0MOEoLBI6qLAG5YYw/edit?usp=sharing"
+                url_01 = endings['correct']
             else:
                 #エンディング２
-                url_01 = "https://docs.google.com/document/d/1Xfjb69VUMf9gz63UTd65Rk-qp5INDD_GHJ-DbxCg4eU/edit?usp=sharing"
-                #解説
-                url_02 = "https://docs.google.com/document/d/10MUbcFgBWeIK18LUYyntIJ6eC-0MOEoLBI6qLAG5YYw/edit?usp=sharing"
+                url_01 = endings['incorrect']
+            #解説
+            url_02 = endings.get('explanation')
+
+        # 返答した後に移るフェーズ（推理を発表したら次へ）
+        if turn['next_phase'] is None and phase['after_reply_goto'] is not None:
+            turn['next_phase'] = phase['after_reply_goto']
             
         # 特定のURLが存在する場合、それも返信リストに追加
         if url_01 is not None:
@@ -312,51 +317,177 @@ def handle_message(event):
         if url_02 is not None:
             answer_list.append(TextSendMessage(text='解説'))
             answer_list.append(TextSendMessage(text=f'{url_02}'))
-            line_bot_api.reply_message(event.reply_token, answer_list[1:])
+            # エンディングはChatGPTの返答を除いて送る
+            answer_list = answer_list[1:]
+
+        # ChatGPTのトークン数と費用も同じ更新で足す
+        turn['increments'].update(lambda_usage.increments(current_phase))
+
+        # カウンターとフェーズをまとめて1回で更新（イベントログが有効ならこのターンのイベントも書く）
+        replies = [message.text for message in answer_list]
+        commit_turn(scenario, user_id, session_id, user, turn, query, speaker_id, replies, state_attributes)
         
-        # introの時の会話履歴は残したくない
-        if current_phase != 'intro':
+        # 会話履歴を残すフェーズだけ保存
+        if phase['save_history']:
             # 会話履歴に登録するアイテム情報
             talk_item = {
                 'user_id': user_id,
-                'date': now,
+                'date': lambda_dao.history_sort_key(session_id, now),
                 'message': query,
-                'reply': answer
+                'reply': answer,
+                'phase': current_phase
             }
-            # 会話履歴に登録
-            lambda_dao.put_talk_history(talk_item)
+            if session_id is not None:
+                talk_item['session_id'] = session_id
+            if location is not None:
+                talk_item['location'] = location
+            # グループでは発言したメンバーを記録
+            if is_group and speaker_id:
+                talk_item['speaker'] = speaker_id
+            # 会話履歴に登録（状態は更新済みなので、保存できなくても返答は送る）
+            try:
+                lambda_dao.put_talk_history(talk_item)
+            except lambda_dao.DynamoDBError as e:
+                logger.error(f"Failed to save talk history: {e}")
         
-        # LINE APIを使用して返信リストを送信
+        # LINE APIを使用して返信リストを送信（定型文を先に返していたらpushで送る）
         try:
-            line_bot_api.reply_message(event.reply_token, answer_list)
+            send_messages(event, answer_list)
         except LineBotApiError as e:
             logger.error(f"LINE API Error: {e}")
+
+        # ゲームが終わったら、返信の後で会話履歴のアーカイブを別のLambdaに頼む
+        if turn['next_phase'] == 'end':
+            lambda_archive.archive_on_end({**user, 'CurrentPhase': 'end', 'SessionId': session_id})
             
     except LineBotApiError as e:
     # LINE API特有のエラー
         logger.error(f"LINE API Error: {e}")
+
+    except PhaseChangedError as e:
+        # やり直すのは1回だけ（やり直しでも先を越されたら、状態を進めずに送り直してもらう）
+        if admitted_query is None:
+            raise
+        logger.error(f"Gave up the turn: {e}")
+        send_busy_reply(event, scenario)
+
+    except lambda_dao.DynamoDBError as e:
+        # 再試行しても読み書きできなかった（状態を進めずに、送り直してもらう）
+        logger.error(f"DynamoDB error in handle_message: {e}")
+        send_busy_reply(event, scenario)
         
     except Exception as e:
         # その他の未知のエラー
         logger.error(f"An unexpected error occurred in handle_message: {e.args}")
 
+# ターンの状態を書けなかった時に、送り直してもらう定型文を返す
+def send_busy_reply(event, scenario):
+    lambda_metrics.record('dynamodb.turn_failed', 1, 'Count')
+    busy_reply = (scenario or lambda_scenario.get_scenario())['busy_reply']
+    if busy_reply:
+        try:
+            send_messages(event, [TextSendMessage(text=busy_reply)])
+        except LineBotApiError as e:
+            logger.error(f"LINE API Error: {e}")
+
 # 会話履歴をリスト化
-def get_past_conversations(get_talk, n=15):
+# グループの場合は発言したメンバーを名前として付ける
+def get_past_conversations(get_talk, n=15, group=False):
     try:
         items = get_talk.get('Items', [])
         result = []
         for item in items[:n]:
             if 'message' in item and 'reply' in item:
-                result.append({'role': 'user', 'content': item['message']})
+                user_message = {'role': 'user', 'content': item['message']}
+                if group and item.get('speaker'):
+                    user_message['name'] = get_speaker_name(item['speaker'])
+                result.append(user_message)
                 result.append({'role': 'assistant', 'content': item['reply']})
         return result
     except Exception as e:
         logger.error(f"Failed to get past conversations: {e}")
         return []
 
+# ターンの状態を保存する
+# 読んだ後に他のターンが状態を進めていたら（StaleUserError）、フェーズが同じなら返ってきた今の状態でカウンターとフェーズの移行だけを決め直して、
+# 書き込みを1回だけやり直す（ChatGPTは呼び直さない。turn は決め直した内容に書き換わる）
+# フェーズが変わっていたら PhaseChangedError（返信する前にターンをやり直す）
+# ユーザー情報が消えていた・別のゲームが始まっていた時は、このターンの状態は書けないので例外のまま返す
+def commit_turn(scenario, user_id, session_id, user, turn, query, speaker_id, replies, state_attributes):
+    try:
+        return lambda_events.commit_turn(user_id, session_id, user, turn, query, speaker_id, replies, *state_changes(turn, state_attributes))
+    except lambda_dao.StaleUserError as e:
+        current = e.item
+        if current is None or current.get('SessionId', session_id) != session_id:
+            raise
+        # フェーズが変わっていたら、返答も前のフェーズのもの（送る前にターンをやり直す）
+        if current['CurrentPhase'] != user['CurrentPhase']:
+            lambda_user_cache.invalidate(user_id)
+            raise PhaseChangedError(user_id, query) from e
+        logger.info(f"user_info of {user_id} was changed by another turn; recomputing the state change.")
+        lambda_metrics.record('user_cache.conflicts', 1, 'Count')
+        turn.update(lambda_phase.reconcile_turn(scenario['machine'], user, current, turn, query))
+        return lambda_events.commit_turn(user_id, session_id, current, turn, query, speaker_id, replies, *state_changes(turn, state_attributes))
+
+# ターンの終わりに書き込む属性と消す属性を決める
+# endになったらLastActivityを消して、フェーズ別インデックスから外す（インデックスには遊んでいる人だけが載る）
+def state_changes(turn, attributes):
+    if (turn['next_phase'] or turn['phase']['name']) != 'end':
+        return attributes, None
+    attributes = {name: value for name, value in attributes.items() if name != 'LastActivity'}
+    return attributes, ['LastActivity'] if turn['next_phase'] == 'end' else None
+
+# ユーザーのフェーズが使うシナリオに無い時に、そのシナリオの最初のフェーズから新しいゲームを始める
+# （ここで書き込むのは1回だけ。他のターンが先に書いていたら StaleUserError のまま返して、送り直してもらう）
+def restart_in_scenario(scenario, user):
+    machine = scenario['machine']
+    logger.warning(f"Phase {user['CurrentPhase']} of {user['user_id']} is not in scenario {scenario['id']} (ScenarioId: {user.get('ScenarioId')}); restarting from {machine['initial_phase']}.")
+    lambda_metrics.record('scenario.restarted', 1, 'Count')
+    attributes = {name: value for name, value in lambda_phase.initial_user_item(machine, user['user_id']).items() if name not in ('user_id', 'CurrentPhase')}
+    attributes['ScenarioId'] = scenario['id']
+    attributes['SessionId'] = lambda_dao.new_session_id()
+    # トークン数と費用も新しいゲームの分から数え直す
+    attributes.update({name: 0 for name in user if lambda_usage.is_usage_attribute(name)})
+    return lambda_dao.update_user_state(user['user_id'], {}, machine['initial_phase'], attributes, expected_version=user.get('Version', 0))
+
+# セッションのIDを決める（グループ、トークルーム、個人の順）
+def get_session_id(source):
+    if getattr(source, 'type', None) == 'group':
+        return source.group_id
+    if getattr(source, 'type', None) == 'room':
+        return source.room_id
+    return source.user_id
+
+# ChatGPTに渡す発言者の名前（userIdの末尾だけ使う。nameは英数字と_-のみ可）
+def get_speaker_name(speaker_id):
+    return f'player_{speaker_id[-6:]}'
+
+# LINEに返信する（処理時間を計測）
+@lambda_io.timed('line', 'reply_message')
+def reply_message(reply_token, messages):
+    return line_bot_api.reply_message(reply_token, messages)
+
+# LINEにプッシュで送る（処理時間を計測）
+@lambda_io.timed('line', 'push_message')
+def push_message(to, messages):
+    return line_bot_api.push_message(to, messages)
+
+# 定型文を先に返していたらpush、そうでなければreplyで送る
+def send_messages(event, messages):
+    if lambda_deadline.holding_sent():
+        return push_message(get_session_id(event.source), messages)
+    return reply_message(event.reply_token, messages)
+
+# ChatGPTの返答から本文を取り出す（返答が無ければ代わりのセリフ）
+def get_answer(response, fallback):
+    if response is None:
+        return fallback
+    return response["choices"][0]["message"]["content"]
+
 # gptを呼び出す
+@lambda_io.timed('openai', 'call_gpt')
 def call_gpt(messages, functions):
-    return openai.ChatCompletion.create(
+    response = openai.ChatCompletion.create(
         model= 'gpt-3.5-turbo-16k-0613',
         temperature=0.05,
         max_tokens=200,
@@ -365,12 +496,18 @@ def call_gpt(messages, functions):
         presence_penalty=0,
         messages= messages,
         functions= functions,
-        function_call="auto"
+        function_call="auto",
+        # 締め切りを過ぎたら通信を打ち切る
+        request_timeout=max(1, lambda_deadline.hard_remaining())
     )
+    lambda_metrics.record_usage(response)
+    lambda_usage.record(response)
+    return response
 
 # gptを呼び出す(２回目)
+@lambda_io.timed('openai', 'call_second_gpt')
 def call_second_gpt(messages):
-    return openai.ChatCompletion.create(
+    response = openai.ChatCompletion.create(
         model= 'gpt-3.5-turbo-16k-0613',
         temperature=0.05,
         max_tokens=200,
@@ -378,47 +515,46 @@ def call_second_gpt(messages):
         frequency_penalty=0,
         presence_penalty=0,
         stop=["\n"],
-        messages= messages
+        messages= messages,
+        # 締め切りを過ぎたら通信を打ち切る
+        request_timeout=max(1, lambda_deadline.hard_remaining())
     )
-
-#Urlをまとめたデータを作成
-url_mapping = {
-    'リビング': 'https://docs.google.com/document/d/15f_UX1WtwFy12CgMsHcwBBIWp0DMD8ohWu-QUDE1J4A/edit?usp=sharing',
-    '書斎': 'https://docs.google.com/document/d/1Njvoai5L34A8AJRuhgmgznDBuFgvnoWOJOs5apgH0es/edit?usp=sharing',
-    'キッチン': 'https://docs.google.com/document/d/10HO1uwx1EMOzfDpSYCmHInyryay-OekP3al7jp28fn0/edit?usp=sharing',
-    'テーブル': 'https://docs.google.com/document/d/1Vx4AZe6lUX2fsGlYImrj7Ms5p36R4w4cJXfdcnVbQfE/edit?usp=sharing',
-    'テーブルの下': 'https://docs.google.com/document/d/1zaZ61Cwcl5QsVoYlGLG0zzmfK01fyiy9FZOl0C-uhnY/edit?usp=sharing',
-    'ベランダ': 'https://docs.google.com/document/d/1wdtKf0XS7_w0XMDsLBrYtV-edDRTbblhQFtmSuj95IQ/edit?usp=sharing',
-    'ゴミ箱': 'https://docs.google.com/document/d/1S6m8qgAMDNDa_kvNh0f2HFF4OACn1Pf9c0C9hHiEpBk/edit?usp=sharing',
-    'クローゼット': 'https://docs.google.com/document/d/1zjORtkbF2XtV4EbS5_A0nu0foY7bo8Cn7APTe1E4zQ8/edit?usp=sharing',
-    '仕事机': 'https://docs.google.com/document/d/1N2CeDvdrijRYHkjhXtXqfk2KCdylYNH3-kGOhzbytvk/edit?usp=sharing',
-    '引き出し': 'https://docs.google.com/document/d/1_Qwj_RovS5grrqg-OPBxrOUI5i-PI2cg-8tqEiXEDdc/edit?usp=sharing',
-    'トイレ': 'https://docs.google.com/document/d/1tLDczy1QTuyCRpvthdSttpEQ4hcwBf0d-DtsHAJYIr4/edit?usp=sharing'
-}
+    lambda_metrics.record_usage(response)
+    lambda_usage.record(response)
+    return response
 
 #特定のキーワードをもとにUrlを取得（場所）
-def get_url_based_on_keyword_place(location_name, url_mapping):
-    return url_mapping.get(location_name)
+#表記ゆれや別名も吸収して一番近い場所を探す
+#返り値: (場所名, URL)。見つからなければ (None, None)
+def get_url_based_on_keyword_place(location_name, location_index):
+    name, score = lambda_location.find_location(location_index, location_name)
+    if name is None:
+        logger.info(f"No location matched for {location_name} (best score {score:.2f})")
+        lambda_metrics.record('location.miss', 1, 'Count')
+        return None, None
+    lambda_metrics.record('location.score', score, 'None')
+    return name, location_index['urls'][name]
     
-
-#推理のキーワードの数をチェック
-def check_keywords(query, keywords):
-    count = sum(keyword in query for keyword in keywords)
-    return count >= 5
     
 # LINE Messaging APIからのWebhookを処理する
 def lambda_handler(event, context):
 
     # リクエストヘッダーにx-line-signatureがあることを確認
+    # 無い場合は空文字にして署名検証で弾く
+    signature = ''
     if 'x-line-signature' in event['headers']:
         signature = event['headers']['x-line-signature']
 
+    # Lambdaの残り時間とリプライトークンの有効期間の起点を覚える（締め切りはイベントごとに決める）
+    lambda_deadline.start_invocation(context)
+
     body = event['body']
     # 受け取ったWebhookのJSONを目視確認できるようにINFOでログに吐く
     logger.info(body)
 
     try:
-        webhook_handler.handle(body, signature)
+        # 選ばれた呼び出しだけプロファイルする（設定が無ければそのまま呼ぶ）
+        lambda_profile.call(event, webhook_handler.handle, body, signature)
     except InvalidSignatureError:
         # 署名を検証した結果、飛んできたのがLINEプラットフォームからのWebhookでなければ400を返す
         return {
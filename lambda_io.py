@@ -0,0 +1,173 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from functools import wraps
+
+import lambda_metrics
+
+logger = logging.getLogger()
+
+# 1ターンのDynamoDB、OpenAI、LINEの呼び出しを数えて、ターンの終わりにログと計測値に出す
+# 予算（フェーズごとの呼び出し回数の上限）を超えたら記録する（ベンチマークで確かめる用）
+# IO_BUDGET_MODE: off: 確かめない / warn: ログに出す / assert: 超えたターンを budget_violations() に溜める
+IO_BUDGET_MODE = os.getenv('IO_BUDGET_MODE', 'off')
+# 予算のJSONファイル（{フェーズ: {項目: 上限}}、項目は totals() のキー）
+IO_BUDGETS_FILE = os.getenv('IO_BUDGETS_FILE', '')
+
+# 読み込みとみなすDynamoDBの操作（それ以外は書き込み）
+READ_OPERATIONS = frozenset((
+    'get_user_info',
+    'get_talk_history',
+    'get_prompt_for_phase',
+    'iter_talk_history',
+    'iter_turn_events',
+    'scan_users_in_phase',
+    'query_phase_cohort',
+    'scan_users_page',
+    'scan_talk_history_page'
+))
+
+_turn = contextvars.ContextVar('io_turn', default=None)
+_budgets = {}
+_violations = []
+_violations_lock = threading.Lock()
+
+
+# 呼び出しの種類（dynamodb_reads など）
+def _category(kind, operation):
+    if kind == 'dynamodb':
+        return 'dynamodb_reads' if operation in READ_OPERATIONS else 'dynamodb_writes'
+    return kind
+
+
+# 呼び出し1回を数えて時間を測る（計測のspanも兼ねる）
+class _Call:
+    def __init__(self, kind, operation):
+        self.kind = kind
+        self.operation = operation
+        self.metrics_span = lambda_metrics.span(f'{kind}.{operation}')
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.metrics_span.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics_span.__exit__(exc_type, exc, tb)
+        turn = _turn.get()
+        if turn is not None:
+            elapsed_ms = (time.perf_counter() - self.start) * 1000
+            category = _category(self.kind, self.operation)
+            # GPTは別スレッドで呼ぶことがあるのでロックを取る
+            with turn['lock']:
+                turn['counts'][category] = turn['counts'].get(category, 0) + 1
+                turn['ms'][self.kind] = turn['ms'].get(self.kind, 0.0) + elapsed_ms
+                turn['operations'][f'{self.kind}.{self.operation}'] = turn['operations'].get(f'{self.kind}.{self.operation}', 0) + 1
+        return False
+
+
+# with文で囲んだ呼び出しを数える
+def span(kind, operation):
+    return _Call(kind, operation)
+
+
+# 関数の呼び出しを数えるデコレーター
+def timed(kind, operation):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Call(kind, operation):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ターンの数え始め
+def start_turn():
+    _turn.set({'phase': None, 'counts': {}, 'ms': {}, 'operations': {}, 'lock': threading.Lock()})
+
+
+# 予算を確かめるフェーズ（ターンの始めのフェーズ）
+def set_phase(phase):
+    turn = _turn.get()
+    if turn is not None:
+        turn['phase'] = phase
+
+
+# このターンの呼び出し回数と時間
+def totals():
+    turn = _turn.get()
+    if turn is None:
+        return None
+    with turn['lock']:
+        result = {
+            'dynamodb_reads': turn['counts'].get('dynamodb_reads', 0),
+            'dynamodb_writes': turn['counts'].get('dynamodb_writes', 0),
+            'openai': turn['counts'].get('openai', 0),
+            'line': turn['counts'].get('line', 0)
+        }
+        result['ms'] = {kind: round(ms, 1) for kind, ms in turn['ms'].items()}
+        result['operations'] = dict(turn['operations'])
+    return result
+
+
+# 予算を設定する（{フェーズ: {項目: 上限}}。'*' は全フェーズ）
+def set_budgets(budgets):
+    _budgets.clear()
+    _budgets.update(budgets or {})
+
+
+def load_budgets(path):
+    with open(path, encoding='utf-8') as f:
+        set_budgets(json.load(f))
+
+
+# 予算を超えた項目の一覧
+def check(phase, result):
+    budget = {**_budgets.get('*', {}), **_budgets.get(phase, {})}
+    return [
+        f"{phase}: {name} {result.get(name, 0)} > {limit}"
+        for name, limit in budget.items()
+        if result.get(name, 0) > limit
+    ]
+
+
+# 予算を超えたターンの一覧（assertモード）
+def budget_violations():
+    with _violations_lock:
+        return list(_violations)
+
+
+def reset_violations():
+    with _violations_lock:
+        _violations.clear()
+
+
+# ターンの終わりに、呼び出し回数をログと計測値に出す
+def finish():
+    turn = _turn.get()
+    if turn is None:
+        return None
+    result = totals()
+    _turn.set(None)
+    phase = turn['phase']
+    logger.info(f"I/O: {json.dumps({'phase': phase, **result}, ensure_ascii=False)}")
+    for name in ('dynamodb_reads', 'dynamodb_writes', 'openai', 'line'):
+        lambda_metrics.record(f'io.{name}', result[name], 'Count')
+
+    if IO_BUDGET_MODE != 'off' and phase is not None:
+        violations = check(phase, result)
+        if violations:
+            if IO_BUDGET_MODE == 'assert':
+                with _violations_lock:
+                    _violations.append({'phase': phase, 'violations': violations, 'operations': result['operations']})
+            logger.warning(f"I/O budget exceeded: {violations}")
+    return result
+
+
+if IO_BUDGETS_FILE:
+    load_budgets(IO_BUDGETS_FILE)
@@ -0,0 +1,87 @@
+import unicodedata
+
+# 一致とみなす類似度の下限（0〜1）
+LOCATION_MATCH_THRESHOLD = 0.5
+# 検索に使う文字数の上限（長い文でも検索時間が一定以内に収まるように）
+MAX_QUERY_CHARS = 64
+
+# ひらがなをカタカナに揃える変換表
+_HIRAGANA_TO_KATAKANA = {code: code + 0x60 for code in range(0x3041, 0x3097)}
+# 比較の邪魔になる記号や空白
+_IGNORED_CATEGORIES = ('Z', 'P', 'S', 'C')
+
+
+# 表記ゆれを吸収する（全角半角、ひらがなカタカナ、大文字小文字、記号や空白）
+def normalize(text):
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', text).lower().translate(_HIRAGANA_TO_KATAKANA)
+    return ''.join(ch for ch in text if unicodedata.category(ch)[0] not in _IGNORED_CATEGORIES)
+
+
+# 文字のbi-gramを作る（1文字でも比較できるよう両端に印を付ける）
+def ngrams(text):
+    padded = f'^{text}$'
+    return frozenset(padded[i:i + 2] for i in range(len(padded) - 1))
+
+
+# 場所の定義から検索用の索引を作る（シナリオを読み込んだ時に1回だけ）
+# locations: 場所名 -> URL、または場所名 -> {'url': URL, 'synonyms': [別名, ...]}
+def build_index(locations):
+    urls = {}
+    exact = {}
+    entries = []
+    postings = {}
+    for name, value in locations.items():
+        if isinstance(value, str):
+            url, synonyms = value, []
+        else:
+            url, synonyms = value['url'], value.get('synonyms', [])
+        urls[name] = url
+        for term in [name, *synonyms]:
+            key = normalize(term)
+            if not key or key in exact:
+                continue
+            exact[key] = name
+            grams = ngrams(key)
+            index = len(entries)
+            entries.append({'key': key, 'name': name, 'grams': len(grams)})
+            for gram in grams:
+                postings.setdefault(gram, []).append(index)
+    return {'urls': urls, 'exact': exact, 'entries': entries, 'postings': postings}
+
+
+# 場所の名前から一番近い場所を探す
+# 返り値: (場所名, 類似度)。見つからなければ (None, 一番高かった類似度)
+def find_location(index, location_name):
+    key = normalize(location_name)[:MAX_QUERY_CHARS]
+    if not key:
+        return None, 0.0
+
+    # 表記ゆれを揃えた上で完全一致
+    name = index['exact'].get(key)
+    if name is not None:
+        return name, 1.0
+
+    # 共通するbi-gramの数を数える（共通部分が無い場所は最初から比べない）
+    grams = ngrams(key)
+    shared = {}
+    for gram in grams:
+        for entry_index in index['postings'].get(gram, ()):
+            shared[entry_index] = shared.get(entry_index, 0) + 1
+
+    best_name = None
+    best_score = 0.0
+    for entry_index, count in shared.items():
+        entry = index['entries'][entry_index]
+        # Dice係数
+        score = 2 * count / (len(grams) + entry['grams'])
+        # 「キッチンの棚」のように場所名をそのまま含む場合は、含む割合に応じて高めに評価
+        if len(entry['key']) >= 2 and entry['key'] in key:
+            score = max(score, 0.6 + 0.4 * len(entry['key']) / len(key))
+        if score > best_score:
+            best_name, best_score = entry['name'], score
+
+    if best_score < LOCATION_MATCH_THRESHOLD:
+        return None, best_score
+    return best_name, best_score
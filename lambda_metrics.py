@@ -0,0 +1,170 @@
+import contextvars
+import json
+import logging
+import os
+import time
+from functools import wraps
+
+logger = logging.getLogger()
+
+# 計測の出力先を環境変数で切り替える
+# off: 計測しない / emf: CloudWatch Embedded Metric Formatで標準出力 / file: ローカルファイルにJSONL
+METRICS_MODE = os.getenv('METRICS_MODE', 'off')
+METRICS_FILE = os.getenv('METRICS_FILE', '/tmp/metrics.jsonl')
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'MurderMysteryBot')
+
+ENABLED = METRICS_MODE in ('emf', 'file')
+
+# 1ターン分の計測値はコンテキストごとに持つ
+# （サーバー実行時に複数ターンが並行し、GPT呼び出しは別スレッドに渡すことがあるため）
+_turn = contextvars.ContextVar('metrics_turn', default=None)
+
+
+# 計測が無効の時に返す何もしないspan
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+# with文で囲んだ区間の時間を計測するspan
+class _Span:
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        record(self.name, elapsed_ms, 'Milliseconds')
+        if exc_type is not None:
+            record(f'{self.name}.error', 1, 'Count')
+        return False
+
+
+# ターンの計測を開始する
+def start_turn(**dimensions):
+    if not ENABLED:
+        return
+    _turn.set({'dimensions': dict(dimensions), 'values': {}, 'units': {}})
+
+
+# ディメンション（フェーズやモデル）を設定する
+def set_dimension(name, value):
+    if not ENABLED:
+        return
+    turn = _turn.get()
+    if turn is not None and value is not None:
+        turn['dimensions'][name] = str(value)
+
+
+# 計測値を1件記録する（同じ名前は配列で保持）
+def record(name, value, unit='None'):
+    if not ENABLED:
+        return
+    turn = _turn.get()
+    if turn is None:
+        return
+    turn['values'].setdefault(name, []).append(value)
+    turn['units'][name] = unit
+
+
+# 区間計測用のspanを返す
+def span(name):
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+# 関数全体の実行時間を計測するデコレーター
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with _Span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ChatGPTの返答のusageからトークン数を記録する
+def record_usage(response):
+    if not ENABLED or response is None:
+        return
+    try:
+        usage = response.get('usage') or {}
+        set_dimension('Model', response.get('model'))
+        record('openai.prompt_tokens', usage.get('prompt_tokens', 0), 'Count')
+        record('openai.completion_tokens', usage.get('completion_tokens', 0), 'Count')
+        record('openai.total_tokens', usage.get('total_tokens', 0), 'Count')
+    except Exception as e:
+        logger.error(f"Failed to record token usage: {e}")
+
+
+# DynamoDBのレスポンスから消費キャパシティを記録する
+def record_capacity(operation, response):
+    if not ENABLED or not response:
+        return
+    capacity = response.get('ConsumedCapacity')
+    if not capacity:
+        return
+    # BatchWriteItemなどはリストで返ってくる
+    if isinstance(capacity, list):
+        units = sum(float(c.get('CapacityUnits', 0)) for c in capacity)
+    else:
+        units = float(capacity.get('CapacityUnits', 0))
+    record(f'dynamodb.{operation}.capacity', units, 'Count')
+
+
+# 1ターン分の計測値をEMFの1行にまとめる
+def build_emf(dimensions, values, units, timestamp_ms=None):
+    if timestamp_ms is None:
+        timestamp_ms = int(time.time() * 1000)
+    document = {
+        '_aws': {
+            'Timestamp': timestamp_ms,
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [sorted(dimensions.keys())],
+                'Metrics': [{'Name': name, 'Unit': units[name]} for name in values]
+            }]
+        }
+    }
+    document.update(dimensions)
+    for name, samples in values.items():
+        # 1件だけなら数値、複数なら配列（EMFはどちらも受け付ける）
+        document[name] = samples[0] if len(samples) == 1 else samples
+    return document
+
+
+# ターンの計測値を出力してリセットする
+def flush():
+    if not ENABLED:
+        return
+    turn = _turn.get()
+    if turn is None:
+        return
+    _turn.set(None)
+    dimensions, values, units = turn['dimensions'], turn['values'], turn['units']
+    if not values:
+        return
+    line = json.dumps(build_emf(dimensions, values, units), ensure_ascii=False)
+    try:
+        if METRICS_MODE == 'file':
+            with open(METRICS_FILE, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+        else:
+            # Lambdaの標準出力はそのままCloudWatch Logsに入り、EMFとして解釈される
+            print(line, flush=True)
+    except Exception as e:
+        logger.error(f"Failed to flush metrics: {e}")
@@ -0,0 +1,160 @@
+import re
+
+# シナリオパック（scenarios/<id>/scenario.json）の phases の書式
+# phases: フェーズの一覧（先頭が最初のフェーズ）
+#   name: フェーズ名（user_infoのCurrentPhaseに入る）
+#   next: 次のフェーズ（goto: 'next' で参照）
+#   guards: ChatGPTに渡す前にメッセージを調べるルール。当てはまったら定型文を返してターンを終える
+#   reply: ChatGPTを使わずに返す定型文（guardsに当てはまらなかった時）
+#   counters: 1ターンごとに+1するカウンター
+#   thresholds: カウンターが特定の値になった時の通知やフェーズ移行
+#   gpt: 'functions'ならファンクションコーリングあり、'chat'なら無し
+#   functions: ChatGPTが呼んだ関数ごとの処理
+#   read_history / save_history: 会話履歴をChatGPTに渡すか、保存するか
+#   after_reply_goto: 返答した後に移るフェーズ
+#   ending: 推理の判定をしてエンディングを返すフェーズ
+#   holding_reply: ChatGPTの返答が締め切りに間に合わない時に先に返すセリフ
+#   throttle: ChatGPTに渡すメッセージの連投制限 {rate_per_minute, burst}（無ければ環境変数の既定値）
+
+
+# goto: 'next' をフェーズ名に置き換え、存在しないフェーズならエラー
+def _resolve_goto(phase, goto, names):
+    if goto is None:
+        return None
+    if goto == 'next':
+        goto = phase.get('next')
+    if goto not in names:
+        raise ValueError(f"Phase {phase['name']} refers to unknown phase {goto}")
+    return goto
+
+
+# 単語のどれかを含むかを1回の検索で調べる正規表現を作る
+def _compile_words(words):
+    return re.compile('|'.join(re.escape(word) for word in words))
+
+
+# シナリオ定義をフェーズごとの判定テーブルにコンパイルする（シナリオを読み込んだ時に1回だけ）
+def compile_scenario(scenario):
+    names = {phase['name'] for phase in scenario['phases']}
+    phases = {}
+    for phase in scenario['phases']:
+        guards = []
+        for guard in phase.get('guards', []):
+            guards.append({
+                'pattern': _compile_words(guard['contains_any']),
+                'reply': guard.get('reply'),
+                'goto': _resolve_goto(phase, guard.get('goto'), names)
+            })
+
+        # (カウンター名, 値) で引ける表にして、ターンごとの判定を辞書引き1回にする
+        thresholds = {}
+        for threshold in phase.get('thresholds', []):
+            key = (threshold['counter'], threshold['equals'])
+            thresholds.setdefault(key, []).append({
+                'notify': threshold.get('notify'),
+                'goto': _resolve_goto(phase, threshold.get('goto'), names)
+            })
+
+        functions = {}
+        for name, function in phase.get('functions', {}).items():
+            requires = function.get('requires_any')
+            functions[name] = {
+                'action': function.get('action'),
+                'requires': _compile_words(requires) if requires else None,
+                'goto': _resolve_goto(phase, function.get('goto'), names)
+            }
+
+        phases[phase['name']] = {
+            'name': phase['name'],
+            'next': _resolve_goto(phase, phase.get('next'), names) if phase.get('next') else None,
+            'guards': guards,
+            'reply': phase.get('reply'),
+            'counters': tuple(phase.get('counters', [])),
+            'thresholds': thresholds,
+            'gpt': phase.get('gpt'),
+            'functions': functions,
+            'read_history': phase.get('read_history', False),
+            'save_history': phase.get('save_history', False),
+            'after_reply_goto': _resolve_goto(phase, phase.get('after_reply_goto'), names),
+            'ending': phase.get('ending', False),
+            'holding_reply': phase.get('holding_reply'),
+            'throttle': phase.get('throttle')
+        }
+
+    return {
+        'initial_phase': scenario['phases'][0]['name'],
+        'phases': phases
+    }
+
+
+# 新しいユーザーの初期状態
+def initial_user_item(machine, user_id):
+    return {'user_id': user_id, 'limit': 0, 'count': 0, 'CurrentPhase': machine['initial_phase']}
+
+
+# 現在のフェーズのルールだけを評価して、このターンにやることを決める
+# 返り値:
+#   phase: 現在のフェーズの判定テーブル
+#   replies: ChatGPTを使わずに返すセリフ（あればターンはそこで終わり）
+#   notifications: ChatGPTの返答の前に付ける通知
+#   increments: 1回の更新でまとめて足すカウンター
+#   next_phase: 移るフェーズ（無ければNone）
+def evaluate_turn(machine, user, query):
+    phase = machine['phases'][user['CurrentPhase']]
+    turn = {
+        'phase': phase,
+        'replies': [],
+        'notifications': [],
+        'increments': {},
+        'next_phase': None
+    }
+
+    for guard in phase['guards']:
+        if guard['pattern'].search(query):
+            turn['replies'].append(guard['reply'])
+            turn['next_phase'] = guard['goto']
+            return turn
+
+    if phase['reply'] is not None:
+        turn['replies'].append(phase['reply'])
+        return turn
+
+    for counter in phase['counters']:
+        value = int(user.get(counter, 0)) + 1
+        turn['increments'][counter] = 1
+        for action in phase['thresholds'].get((counter, value), ()):
+            if action['notify']:
+                turn['notifications'].append(action['notify'])
+            if action['goto']:
+                turn['next_phase'] = action['goto']
+
+    return turn
+
+
+# 読んだ後に他のターンが状態を進めていた時に、今の状態（current）でこのターンの書き込みを決め直す
+# 返答はそのまま使い、フェーズのカウンターとしきい値・ルールでの移行だけを今の状態で評価し直す
+# 関数の呼び出しや返答の後の移行は、フェーズが変わっておらず、ルールでの移行も無い時だけ残す
+# カウンター以外の加算（トークン数など）はそのまま
+def reconcile_turn(machine, user, current, turn, query):
+    stale = evaluate_turn(machine, user, query)
+    fresh = evaluate_turn(machine, current, query)
+    increments = {name: amount for name, amount in turn['increments'].items() if name not in stale['increments']}
+    increments.update(fresh['increments'])
+    next_phase = fresh['next_phase']
+    if next_phase is None and stale['next_phase'] is None and current['CurrentPhase'] == user['CurrentPhase']:
+        next_phase = turn['next_phase']
+    return {**turn, 'phase': fresh['phase'], 'increments': increments, 'next_phase': next_phase}
+
+
+# ChatGPTが呼んだ関数に対する処理を決める（このフェーズで扱わない関数ならNone）
+def function_action(phase, function_name, query):
+    function = phase['functions'].get(function_name)
+    if function is None:
+        return None
+    allowed = function['requires'] is None or function['requires'].search(query) is not None
+    return {
+        'action': function['action'],
+        # 条件に合わない呼び出しはフェーズを動かさない
+        'goto': function['goto'] if allowed else None
+    }
+
@@ -0,0 +1,148 @@
+import cProfile
+import gzip
+import json
+import logging
+import marshal
+import os
+import random
+import time
+import tracemalloc
+
+import lambda_archive
+
+logger = logging.getLogger()
+
+# 本番の呼び出しの一部だけをプロファイルする
+# 選ばれる条件（どれか）:
+#   PROFILE_SAMPLE_RATE: この割合の呼び出し（0〜1）
+#   PROFILE_USER_IDS: このユーザー（またはグループ）からのWebhook（カンマ区切り）
+#   PROFILE_TOKEN: x-profile ヘッダーがこの値のリクエスト（リプレイやローカルの負荷試験用）
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_USER_IDS = frozenset(user_id for user_id in os.getenv('PROFILE_USER_IDS', '').split(',') if user_id)
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN', '')
+PROFILE_HEADER = 'x-profile'
+# 結果の保存先。s3://bucket/prefix ならS3、それ以外はローカルのディレクトリ
+PROFILE_TARGET = os.getenv('PROFILE_TARGET', '/tmp/profiles')
+# メモリの割り当ても記録するか（遅くなるので既定は無効）
+PROFILE_TRACEMALLOC = os.getenv('PROFILE_TRACEMALLOC', 'false').lower() == 'true'
+# ログに出す上位の件数
+PROFILE_TOP = int(os.getenv('PROFILE_TOP', '15'))
+
+# どれも設定されていなければ何もしない（呼び出しごとの判定はこれだけ）
+ACTIVE = PROFILE_SAMPLE_RATE > 0 or bool(PROFILE_USER_IDS) or bool(PROFILE_TOKEN)
+
+
+# Webhookの送り主（ユーザー、グループ、トークルーム）
+def _source_ids(body):
+    try:
+        events = json.loads(body).get('events', [])
+    except (TypeError, ValueError):
+        return set()
+    ids = set()
+    for event in events:
+        source = event.get('source', {})
+        ids.update(value for key, value in source.items() if key in ('userId', 'groupId', 'roomId'))
+    return ids
+
+
+# この呼び出しをプロファイルするか。理由を返す（しなければNone）
+def select(event):
+    if not ACTIVE:
+        return None
+    headers = event.get('headers') or {}
+    if PROFILE_TOKEN and headers.get(PROFILE_HEADER) == PROFILE_TOKEN:
+        return 'header'
+    if PROFILE_USER_IDS and PROFILE_USER_IDS & _source_ids(event.get('body')):
+        return 'user'
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return 'sample'
+    return None
+
+
+# 上位の関数（累積時間順）
+def _top_functions(stats, limit):
+    rows = []
+    for func, (cc, nc, tt, ct, callers) in sorted(stats.items(), key=lambda entry: entry[1][3], reverse=True)[:limit]:
+        filename, line, name = func
+        rows.append({
+            'function': f'{os.path.basename(filename)}:{line}({name})',
+            'calls': nc,
+            'own_ms': round(tt * 1000, 2),
+            'cumulative_ms': round(ct * 1000, 2)
+        })
+    return rows
+
+
+def _top_allocations(snapshot, limit):
+    return [
+        {'line': str(stat.traceback[0]), 'kb': round(stat.size / 1024, 1), 'count': stat.count}
+        for stat in snapshot.statistics('lineno')[:limit]
+    ]
+
+
+# 関数を呼ぶ。選ばれた呼び出しならプロファイルして、結果を保存してログにまとめる
+# GPTの呼び出しは別スレッドで動くので、ここで見えるのは待ち時間だけ
+def call(event, func, *args, **kwargs):
+    reason = select(event)
+    if reason is None:
+        return func(*args, **kwargs)
+
+    started_tracemalloc = False
+    if PROFILE_TRACEMALLOC and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started_tracemalloc = True
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 別のスレッドでプロファイル中（常駐サーバー）なら今回はしない
+        if started_tracemalloc:
+            tracemalloc.stop()
+        return func(*args, **kwargs)
+    started = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        snapshot = tracemalloc.take_snapshot() if started_tracemalloc else None
+        if started_tracemalloc:
+            tracemalloc.stop()
+        _report(reason, event, profiler, snapshot, elapsed_ms)
+
+
+# 結果を保存して、上位の関数と割り当てをログに出す（失敗しても処理には影響させない）
+def _report(reason, event, profiler, snapshot, elapsed_ms):
+    try:
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{random.randrange(16 ** 6):06x}"
+        profiler.create_stats()
+        # 圧縮して保存する（gunzip すれば pstats.Stats で読める）
+        locations = [_write(f'{name}.pstats.gz', marshal.dumps(profiler.stats))]
+        summary = {
+            'reason': reason,
+            'sources': sorted(_source_ids(event.get('body'))),
+            'elapsed_ms': round(elapsed_ms, 1),
+            'top_functions': _top_functions(profiler.stats, PROFILE_TOP)
+        }
+        if snapshot is not None:
+            locations.append(_write(f'{name}.alloc.gz', _dump_snapshot(snapshot)))
+            summary['top_allocations'] = _top_allocations(snapshot, PROFILE_TOP)
+        summary['files'] = locations
+        logger.info(f"Profile: {json.dumps(summary, ensure_ascii=False)}")
+    except Exception as e:
+        logger.error(f"Failed to write profile: {e}")
+
+
+def _write(key, payload):
+    return lambda_archive.write_archive(PROFILE_TARGET, key, gzip.compress(payload), content_type='application/octet-stream')
+
+
+# tracemallocのスナップショットをバイト列にする（tracemalloc.Snapshot.load で読める）
+def _dump_snapshot(snapshot):
+    path = f'/tmp/profile-{os.getpid()}.alloc'
+    snapshot.dump(path)
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(path)
@@ -0,0 +1,125 @@
+from collections import deque
+
+from lambda_location import normalize
+
+# シナリオパックの reasoning の書式
+#   concepts: 推理に含まれるべき要素の一覧
+#     name: 要素の名前
+#     weight: 当てはまった時に加える点数（既定 1）
+#     synonyms: 要素を表す言葉（表記ゆれは normalize で吸収される）
+#   threshold: 正解とみなす点数
+#   required_groups: どれか1つは必ず含まれていないといけない要素名の組（組ごとに判定）
+# 旧書式の keywords / required（キーワードの数で判定）も読み込める
+
+
+# 言葉の一覧からAho-Corasickの照合機械を作る（全部の言葉を1回の走査で探すため）
+def _build_automaton(terms):
+    goto = [{}]
+    fail = [0]
+    outputs = [[]]
+    for term, value in terms:
+        state = 0
+        for ch in term:
+            next_state = goto[state].get(ch)
+            if next_state is None:
+                next_state = len(goto)
+                goto[state][ch] = next_state
+                goto.append({})
+                fail.append(0)
+                outputs.append([])
+            state = next_state
+        outputs[state].append((term, value))
+
+    # 幅優先で失敗時の戻り先を決める
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for ch, next_state in goto[state].items():
+            queue.append(next_state)
+            back = fail[state]
+            while back and ch not in goto[back]:
+                back = fail[back]
+            fail[next_state] = goto[back].get(ch, 0)
+            outputs[next_state] = outputs[next_state] + outputs[fail[next_state]]
+    return {'goto': goto, 'fail': fail, 'outputs': outputs}
+
+
+# テキストを1回走査して、見つかった言葉を返す
+def _scan(automaton, text):
+    goto, fail, outputs = automaton['goto'], automaton['fail'], automaton['outputs']
+    state = 0
+    for ch in text:
+        while state and ch not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(ch, 0)
+        if outputs[state]:
+            yield from outputs[state]
+
+
+# 推理の判定表をコンパイルする（シナリオを読み込んだ時に1回だけ）
+def compile_reasoning(reasoning):
+    if 'concepts' in reasoning:
+        concepts = reasoning['concepts']
+        threshold = reasoning.get('threshold', 0)
+    else:
+        # 旧書式: キーワード1つを重み1の要素として扱う
+        concepts = [{'name': keyword, 'synonyms': [keyword]} for keyword in reasoning.get('keywords', [])]
+        threshold = reasoning.get('required', 0)
+
+    names = []
+    weights = []
+    terms = []
+    for index, concept in enumerate(concepts):
+        names.append(concept['name'])
+        weights.append(concept.get('weight', 1))
+        # 名前そのものも言葉に含める
+        seen = set()
+        for term in [concept['name'], *concept.get('synonyms', [])]:
+            key = normalize(term)
+            if key and key not in seen:
+                seen.add(key)
+                terms.append((key, index))
+
+    concept_index = {name: index for index, name in enumerate(names)}
+    required_groups = []
+    for group in reasoning.get('required_groups', []):
+        unknown = [name for name in group if name not in concept_index]
+        if unknown:
+            raise ValueError(f"Unknown concepts in required_groups: {unknown}")
+        required_groups.append(tuple(concept_index[name] for name in group))
+
+    return {
+        'names': names,
+        'weights': weights,
+        'threshold': threshold,
+        'required_groups': required_groups,
+        'automaton': _build_automaton(terms)
+    }
+
+
+# 推理の文章を採点する
+# 返り値:
+#   score: 当てはまった要素の重みの合計（同じ要素は1回だけ数える）
+#   passed: 点数が閾値以上で、required_groupsを全部満たしているか
+#   concepts: 当てはまった要素ごとの {matched: 見つかった言葉, weight: 重み}
+#   missing_groups: 満たしていないrequired_groups（要素名のリスト）
+def score(compiled, text):
+    matched = {}
+    for term, index in _scan(compiled['automaton'], normalize(text or '')):
+        matched.setdefault(index, []).append(term)
+
+    total = sum(compiled['weights'][index] for index in matched)
+    missing_groups = [
+        [compiled['names'][index] for index in group]
+        for group in compiled['required_groups']
+        if not any(index in matched for index in group)
+    ]
+    return {
+        'score': total,
+        'passed': total >= compiled['threshold'] and not missing_groups,
+        'concepts': {
+            compiled['names'][index]: {'matched': sorted(set(terms)), 'weight': compiled['weights'][index]}
+            for index, terms in matched.items()
+        },
+        'missing_groups': missing_groups
+    }
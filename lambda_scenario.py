@@ -0,0 +1,106 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from functools import lru_cache
+
+import lambda_dao
+import lambda_location
+import lambda_phase
+import lambda_reasoning
+
+logger = logging.getLogger()
+
+# シナリオパックを置くディレクトリ（scenarios/<id>/scenario.json）
+SCENARIO_DIR = os.getenv('SCENARIO_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenarios'))
+# ユーザーにシナリオが設定されていない時に使うシナリオ
+DEFAULT_SCENARIO_ID = os.getenv('DEFAULT_SCENARIO_ID', 'default')
+# プロセス内に保持しておくシナリオの数
+SCENARIO_CACHE_SIZE = int(os.getenv('SCENARIO_CACHE_SIZE', '8'))
+# DynamoDBから取得したプロンプトを使い回す秒数
+PROMPT_CACHE_TTL_SECONDS = int(os.getenv('PROMPT_CACHE_TTL_SECONDS', '300'))
+
+# パスに使うのでシナリオIDは英数字と-_だけ
+_SCENARIO_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+
+# シナリオパックを読み込んで、判定テーブルなどをコンパイルする
+def _compile_pack(scenario_id, pack):
+    return {
+        'id': scenario_id,
+        'title': pack.get('title', scenario_id),
+        'machine': lambda_phase.compile_scenario(pack),
+        'function_schemas': pack.get('function_schemas', []),
+        # 調査場所の索引（表記ゆれや別名でも引けるようにしておく）
+        'location_index': lambda_location.build_index(pack.get('locations', {})),
+        # 推理の採点表（同義語をまとめて1回の走査で探せるようにしておく）
+        'reasoning': lambda_reasoning.compile_reasoning(pack.get('reasoning', {})),
+        'endings': pack.get('endings', {}),
+        'fallback_reply': pack.get('fallback_reply', ''),
+        # 連投制限に掛かった時に1回だけ返すセリフ
+        'throttle_reply': pack.get('throttle_reply', ''),
+        # 前のターンの返答を待っている間のメッセージに1回だけ返すセリフ（メッセージは次のターンで一緒に聞く）
+        'merge_reply': pack.get('merge_reply', ''),
+        # DynamoDBが混んでいてターンを処理できなかった時のセリフ
+        'busy_reply': pack.get('busy_reply', ''),
+        'prompt_prefix': pack.get('prompt_prefix', ''),
+        'prompts': dict(pack.get('prompts', {})),
+        # DynamoDBから取得したプロンプト（フェーズ -> (取得時刻, プロンプト)）
+        'prompt_cache': {},
+        'prompt_lock': threading.Lock()
+    }
+
+
+# シナリオパックを初めて使う時に読み込み、プロセス内のLRUに保持する
+@lru_cache(maxsize=SCENARIO_CACHE_SIZE)
+def load_scenario(scenario_id):
+    if not _SCENARIO_ID_PATTERN.match(scenario_id):
+        raise ValueError(f"Invalid scenario id: {scenario_id}")
+    path = os.path.join(SCENARIO_DIR, scenario_id, 'scenario.json')
+    with open(path, encoding='utf-8') as f:
+        pack = json.load(f)
+    logger.info(f"Loaded scenario pack {scenario_id} from {path}")
+    return _compile_pack(scenario_id, pack)
+
+
+# ユーザーのシナリオを取得する（読み込めなければ既定のシナリオ）
+def get_scenario(scenario_id=None):
+    scenario_id = scenario_id or DEFAULT_SCENARIO_ID
+    try:
+        return load_scenario(scenario_id)
+    except (OSError, ValueError) as e:
+        if scenario_id == DEFAULT_SCENARIO_ID:
+            raise
+        logger.error(f"Failed to load scenario {scenario_id}, falling back to {DEFAULT_SCENARIO_ID}: {e}")
+        return load_scenario(DEFAULT_SCENARIO_ID)
+
+
+# フェーズに応じたプロンプトを取得する
+# パックに書かれていればそれを使い、無ければDynamoDBから取得して一定時間使い回す
+def get_prompt(scenario, phase):
+    prompt = scenario['prompts'].get(phase)
+    if prompt is not None:
+        return prompt
+
+    now = time.monotonic()
+    cached = scenario['prompt_cache'].get(phase)
+    if cached is not None and now - cached[0] < PROMPT_CACHE_TTL_SECONDS:
+        return cached[1]
+
+    with scenario['prompt_lock']:
+        # 他のスレッドが取得済みならそれを使う
+        cached = scenario['prompt_cache'].get(phase)
+        if cached is not None and now - cached[0] < PROMPT_CACHE_TTL_SECONDS:
+            return cached[1]
+        prompt = lambda_dao.get_prompt_for_phase(scenario['prompt_prefix'] + phase)
+        # 取得できなかった時はキャッシュしない
+        if prompt is not None:
+            scenario['prompt_cache'][phase] = (now, prompt)
+        return prompt
+
+
+# キャッシュを捨てる（シナリオを更新した時用）
+def clear_cache():
+    load_scenario.cache_clear()
@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+
+import lambda_dao
+import lambda_metrics
+
+logger = logging.getLogger()
+
+# ChatGPTを呼ぶ前の連投制限を使うか
+THROTTLE_ENABLED = os.getenv('THROTTLE_ENABLED', 'true').lower() == 'true'
+# 1分あたりにChatGPTへ渡すメッセージ数（フェーズの throttle で上書きできる）
+THROTTLE_RATE_PER_MINUTE = float(os.getenv('THROTTLE_RATE_PER_MINUTE', '10'))
+# 続けて送れるメッセージ数（バケツの大きさ）
+THROTTLE_BURST = int(os.getenv('THROTTLE_BURST', '5'))
+# コンテナをまたいだ1分あたりの上限（DynamoDBで数える。0なら使わない）
+THROTTLE_SHARED_PER_MINUTE = int(os.getenv('THROTTLE_SHARED_PER_MINUTE', '0'))
+# プロセス内で覚えておくユーザー数
+THROTTLE_MAX_USERS = int(os.getenv('THROTTLE_MAX_USERS', '10000'))
+# 次のターンにまとめるメッセージの上限（件数と文字数）
+THROTTLE_MAX_MERGED = int(os.getenv('THROTTLE_MAX_MERGED', '3'))
+THROTTLE_MAX_MERGED_CHARS = int(os.getenv('THROTTLE_MAX_MERGED_CHARS', '500'))
+
+# 判定結果
+ALLOW = 'allow'
+# 同じユーザーの前のターンがまだChatGPTを待っている（前のターンの返答はこのメッセージに答えないので、
+# 受け取ったことだけ1回伝えて保留し、次のターンにまとめて渡す）
+MERGE = 'merge'
+# 送りすぎ（今回はChatGPTを呼ばず、次のターンにまとめる）
+DROP = 'drop'
+
+# ユーザーごとの状態（LRUで古いユーザーから捨てる）
+#   tokens / updated: トークンバケツの残りと最後に補充した時刻
+#   in_flight: ChatGPTを待っているターンがあるか
+#   pending: まだChatGPTに渡していないメッセージ
+#   notified: 制限中であることを伝えたか（伝えるのは1回だけ）
+#   acknowledged: 前のターンを待っている間に、受け取ったことを伝えたか（ターンごとに1回だけ）
+_users = OrderedDict()
+_lock = threading.Lock()
+# このターンでChatGPTの呼び出しを許したユーザー（ターンの終わりにrelease()で戻す）
+_admitted = ContextVar('throttle_admitted', default=None)
+
+
+# フェーズの throttle の設定に既定値を埋める
+# throttle: {rate_per_minute: 1分あたりの数, burst: 続けて送れる数}
+def policy_for(phase):
+    policy = phase.get('throttle') or {}
+    return {
+        'rate_per_minute': float(policy.get('rate_per_minute', THROTTLE_RATE_PER_MINUTE)),
+        'burst': int(policy.get('burst', THROTTLE_BURST))
+    }
+
+
+def _user_state(user_id, burst, now):
+    state = _users.get(user_id)
+    if state is None:
+        state = {'tokens': float(burst), 'updated': now, 'in_flight': False, 'pending': [], 'notified': False, 'acknowledged': False}
+        _users[user_id] = state
+        if len(_users) > THROTTLE_MAX_USERS:
+            _users.popitem(last=False)
+    else:
+        _users.move_to_end(user_id)
+    return state
+
+
+def _hold(state, query):
+    if len(state['pending']) < THROTTLE_MAX_MERGED:
+        state['pending'].append(query)
+
+
+# まとめて渡すメッセージ（古い順、文字数の上限を超えたら古いものから捨てる）
+def _merged_query(pending, query):
+    texts = [*pending, query]
+    while len(texts) > 1 and sum(len(text) for text in texts) > THROTTLE_MAX_MERGED_CHARS:
+        texts.pop(0)
+    return '\n'.join(texts)
+
+
+# ChatGPTを呼んでいいかを決める
+# 返り値:
+#   action: allow / merge / drop
+#   query: ChatGPTに渡すメッセージ（溜まっていたメッセージをまとめたもの）
+#   notify: 制限中であること（mergeでは受け取ったこと）をユーザーに伝えるか
+def admit(user_id, phase, query):
+    if not THROTTLE_ENABLED:
+        return {'action': ALLOW, 'query': query, 'notify': False}
+    policy = policy_for(phase)
+    now = time.monotonic()
+
+    with _lock:
+        state = _user_state(user_id, policy['burst'], now)
+        # 経過時間の分だけトークンを補充
+        refill = (now - state['updated']) * policy['rate_per_minute'] / 60
+        state['tokens'] = min(policy['burst'], state['tokens'] + refill)
+        state['updated'] = now
+
+        if state['in_flight']:
+            _hold(state, query)
+            notify = not state['acknowledged']
+            state['acknowledged'] = True
+            lambda_metrics.record('throttle.merged', 1, 'Count')
+            return {'action': MERGE, 'query': query, 'notify': notify}
+
+        if state['tokens'] < 1:
+            _hold(state, query)
+            notify = not state['notified']
+            state['notified'] = True
+            lambda_metrics.record('throttle.dropped', 1, 'Count')
+            return {'action': DROP, 'query': query, 'notify': notify}
+
+        state['tokens'] -= 1
+        state['in_flight'] = True
+        state['acknowledged'] = False
+        pending, state['pending'] = state['pending'], []
+
+    # 別のコンテナで処理された分もDynamoDBで数える
+    if THROTTLE_SHARED_PER_MINUTE > 0:
+        try:
+            count = lambda_dao.increment_throttle_window(user_id, int(time.time()) // 60)
+        except lambda_dao.DynamoDBError as e:
+            # 数えられなかった時は制限しない
+            logger.warning(f"Failed to count the shared throttle window: {e}")
+            count = None
+        if count is not None and count > THROTTLE_SHARED_PER_MINUTE:
+            with _lock:
+                state['in_flight'] = False
+                state['pending'] = pending + state['pending']
+                _hold(state, query)
+                notify = not state['notified']
+                state['notified'] = True
+            lambda_metrics.record('throttle.dropped', 1, 'Count')
+            return {'action': DROP, 'query': query, 'notify': notify}
+
+    with _lock:
+        state['notified'] = False
+    _admitted.set(user_id)
+    if pending:
+        lambda_metrics.record('throttle.merged_into_turn', len(pending), 'Count')
+    return {'action': ALLOW, 'query': _merged_query(pending, query), 'notify': False}
+
+
+# ターンが終わったら呼ぶ（allowにしたユーザーの次のメッセージを受け付ける）
+def release():
+    user_id = _admitted.get()
+    if user_id is None:
+        return
+    _admitted.set(None)
+    with _lock:
+        state = _users.get(user_id)
+        if state is not None:
+            state['in_flight'] = False
@@ -0,0 +1,177 @@
+import argparse
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+
+import lambda_dao
+import lambda_metrics
+
+logger = logging.getLogger()
+
+# モデルごとの料金（100万トークンあたりのUSD。[プロンプト, 返答]）
+# 100万トークンあたりのUSDは、1トークンあたりのマイクロUSDと同じ値になる
+DEFAULT_MODEL_PRICES = {
+    'gpt-3.5-turbo-16k': [3.0, 4.0],
+    'gpt-3.5-turbo': [1.5, 2.0],
+    'gpt-4': [30.0, 60.0]
+}
+# 料金を上書きする（JSON: {モデル名: [プロンプト, 返答]}）
+MODEL_PRICES = {**DEFAULT_MODEL_PRICES, **json.loads(os.getenv('MODEL_PRICES', '{}'))}
+
+# user_infoに足していく属性（ゲーム全体と、フェーズごと・モデルごとの費用）
+PROMPT_TOKENS = 'PromptTokens'
+COMPLETION_TOKENS = 'CompletionTokens'
+COST = 'CostMicroUSD'
+PHASE_COST_PREFIX = 'CostMicroUSD_'
+MODEL_COST_PREFIX = 'CostMicroUSD_model_'
+
+_turn = contextvars.ContextVar('usage_turn', default=None)
+_warned_models = set()
+
+
+# モデル名から料金を探す（日付付きの名前は長く一致するものを使う）
+def price_for(model):
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    candidates = [name for name in MODEL_PRICES if model and model.startswith(name)]
+    if candidates:
+        return MODEL_PRICES[max(candidates, key=len)]
+    if model not in _warned_models:
+        _warned_models.add(model)
+        logger.warning(f"No price configured for model {model}; its cost is counted as 0.")
+    return [0.0, 0.0]
+
+
+# 費用（マイクロUSD、整数）
+def cost_micro_usd(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = price_for(model)
+    return int(round(prompt_tokens * prompt_price + completion_tokens * completion_price))
+
+
+def start_turn():
+    _turn.set({'prompt_tokens': 0, 'completion_tokens': 0, 'cost': 0, 'models': {}, 'lock': threading.Lock()})
+
+
+# ChatGPTの返答のusageを足す（GPTは別スレッドで呼ぶのでロックを取る）
+def record(response):
+    turn = _turn.get()
+    if turn is None or response is None:
+        return
+    try:
+        usage = response.get('usage') or {}
+        prompt_tokens = int(usage.get('prompt_tokens', 0))
+        completion_tokens = int(usage.get('completion_tokens', 0))
+        model = response.get('model') or 'unknown'
+        cost = cost_micro_usd(model, prompt_tokens, completion_tokens)
+    except Exception as e:
+        logger.error(f"Failed to read token usage: {e}")
+        return
+    with turn['lock']:
+        turn['prompt_tokens'] += prompt_tokens
+        turn['completion_tokens'] += completion_tokens
+        turn['cost'] += cost
+        turn['models'][model] = turn['models'].get(model, 0) + cost
+    lambda_metrics.record('openai.cost_micro_usd', cost, 'Count')
+
+
+# このターンの使用量を、ターンごとの状態の更新に足す形で返す
+def increments(phase):
+    turn = _turn.get()
+    if turn is None or not (turn['prompt_tokens'] or turn['completion_tokens']):
+        return {}
+    return {
+        PROMPT_TOKENS: turn['prompt_tokens'],
+        COMPLETION_TOKENS: turn['completion_tokens'],
+        COST: turn['cost'],
+        PHASE_COST_PREFIX + phase: turn['cost'],
+        **{MODEL_COST_PREFIX + model: cost for model, cost in turn['models'].items()}
+    }
+
+
+# 使用量の属性か（ゲームをやり直す時に0に戻す）
+def is_usage_attribute(name):
+    return name in (PROMPT_TOKENS, COMPLETION_TOKENS, COST) or name.startswith(PHASE_COST_PREFIX)
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+# user_infoを読んで、シナリオごとの1ゲームあたりの費用、フェーズごと・モデルごとの費用、費用の多いユーザーをまとめる
+def build_report(users, top=10):
+    scenarios = {}
+    phases = {}
+    models = {}
+    spenders = []
+    for user in users:
+        cost = int(user.get(COST, 0))
+        if not cost:
+            continue
+        spenders.append({
+            'user_id': user['user_id'],
+            'scenario': user.get('ScenarioId', 'default'),
+            'phase': user.get('CurrentPhase'),
+            'cost_usd': cost / 1_000_000,
+            'prompt_tokens': int(user.get(PROMPT_TOKENS, 0)),
+            'completion_tokens': int(user.get(COMPLETION_TOKENS, 0)),
+            'turns': int(user.get('count', 0))
+        })
+        for name, value in user.items():
+            # モデルごとの属性もフェーズの接頭辞で始まるので先に見る
+            if name.startswith(MODEL_COST_PREFIX):
+                model = name[len(MODEL_COST_PREFIX):]
+                models[model] = models.get(model, 0) + int(value)
+            elif name.startswith(PHASE_COST_PREFIX):
+                phase = name[len(PHASE_COST_PREFIX):]
+                phases[phase] = phases.get(phase, 0) + int(value)
+        if user.get('CurrentPhase') == 'end':
+            scenarios.setdefault(user.get('ScenarioId', 'default'), []).append(cost)
+
+    completed = {}
+    for scenario_id, costs in sorted(scenarios.items()):
+        costs.sort()
+        completed[scenario_id] = {
+            'games': len(costs),
+            'mean_usd': round(sum(costs) / len(costs) / 1_000_000, 6),
+            'p50_usd': _percentile(costs, 0.5) / 1_000_000,
+            'p95_usd': _percentile(costs, 0.95) / 1_000_000,
+            'total_usd': sum(costs) / 1_000_000
+        }
+    spenders.sort(key=lambda row: row['cost_usd'], reverse=True)
+    return {
+        'completed_games': completed,
+        'cost_usd_by_phase': {phase: cost / 1_000_000 for phase, cost in sorted(phases.items())},
+        'cost_usd_by_model': {model: cost / 1_000_000 for model, cost in sorted(models.items())},
+        'total_usd': sum(row['cost_usd'] for row in spenders),
+        'top_spenders': spenders[:top]
+    }
+
+
+# user_infoを全部読む
+def iter_users():
+    start_key = None
+    while True:
+        response = lambda_dao.scan_users_page(0, 1, start_key)
+        yield from response.get('Items', [])
+        start_key = response.get('LastEvaluatedKey')
+        if start_key is None:
+            return
+
+
+# コマンドラインから費用をまとめる
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report OpenAI token usage and estimated cost from user_info.')
+    parser.add_argument('--top', type=int, default=10, help='number of top spenders to list')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    print(json.dumps(build_report(iter_users(), args.top), ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import copy
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import lambda_metrics
+
+logger = logging.getLogger()
+
+# 温まったコンテナでは同じユーザーのメッセージが続けて届くので、user_infoをプロセス内に覚えておく
+# 書き込みは Version（書くたびに+1）を条件にするので、他のコンテナが先に書いていたら条件に合わずに分かる
+# （その時は lambda_dao が今のユーザー情報でここを書き換え、呼び出し元がターンをやり直す）
+
+# キャッシュを使うか
+USER_CACHE_ENABLED = os.getenv('USER_CACHE_ENABLED', 'true').lower() == 'true'
+# 覚えておく秒数（書き込まないターンが古い情報で返答する時間の上限）
+USER_CACHE_TTL_SECONDS = float(os.getenv('USER_CACHE_TTL_SECONDS', '60'))
+# 覚えておくユーザー数（LRUで古いユーザーから捨てる）
+USER_CACHE_MAX_USERS = int(os.getenv('USER_CACHE_MAX_USERS', '10000'))
+
+# user_id -> (期限, ユーザー情報)
+_users = OrderedDict()
+_lock = threading.Lock()
+# プロセスでの累計（ベンチマーク用）
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+    lambda_metrics.record(f'user_cache.{name}', 1, 'Count')
+
+
+# 覚えているユーザー情報を返す（無い・期限切れならNone）
+def get(user_id):
+    if not USER_CACHE_ENABLED:
+        return None
+    now = time.monotonic()
+    with _lock:
+        entry = _users.get(user_id)
+        if entry is not None and entry[0] <= now:
+            del _users[user_id]
+            entry = None
+        if entry is not None:
+            _users.move_to_end(user_id)
+    if entry is None:
+        _count('misses')
+        return None
+    _count('hits')
+    # 呼び出し元が書き換えてもキャッシュは変わらないようにコピーを返す
+    return copy.deepcopy(entry[1])
+
+
+# 読んだ・書いたユーザー情報を覚える
+# （同じユーザーを並行に処理して古い情報で上書きしても、次の書き込みの条件で分かる）
+def put(item):
+    if not USER_CACHE_ENABLED or item is None:
+        return
+    user_id = item['user_id']
+    evicted = False
+    with _lock:
+        _users[user_id] = (time.monotonic() + USER_CACHE_TTL_SECONDS, copy.deepcopy(item))
+        _users.move_to_end(user_id)
+        if len(_users) > USER_CACHE_MAX_USERS:
+            _users.popitem(last=False)
+            evicted = True
+    if evicted:
+        _count('evictions')
+
+
+# 忘れる（書き込みの結果が一部しか分からない時や、ユーザー情報を消した時）
+def invalidate(user_id):
+    with _lock:
+        _users.pop(user_id, None)
+
+
+def clear():
+    with _lock:
+        _users.clear()
+        for name in _stats:
+            _stats[name] = 0
+
+
+# 累計のヒット数・ミス数と、今覚えているユーザー数
+def stats():
+    with _lock:
+        lookups = _stats['hits'] + _stats['misses']
+        return {
+            **_stats,
+            'hit_rate': round(_stats['hits'] / lookups, 4) if lookups else 0.0,
+            'size': len(_users)
+        }
@@ -0,0 +1,368 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import local_stack
+from benchmark import percentile, summarize
+
+# 大勢のプレイヤーが同時にゲームを最初から最後まで遊ぶ負荷をかける
+#   handler: lambda_handler をプロセス内で呼ぶ（代役のLINE、OpenAI、DynamoDB）
+#   asgi:    asgi_server.app をプロセス内で呼ぶ（常駐サーバーのスレッドプールを通る）
+#   URL:     起動済みのサーバーにHTTPで送る（python load_test.py serve で代役付きのサーバーを起動できる）
+#
+#   python load_test.py run --players 2000 --ramp-up 60 --target asgi
+#   python load_test.py serve --port 8080 &
+#   python load_test.py run --players 2000 --target http://127.0.0.1:8080/callback
+
+# プレイヤーが使うメッセージ
+INTRO_QUESTIONS = [
+    'あなたは誰ですか？',
+    '昨日の夜は何をしていましたか？',
+    '被害者とはどんな人でしたか？',
+    'この家には誰が住んでいますか？'
+]
+INVESTIGATION_QUESTIONS = [
+    '被害者とはどういう関係でしたか？',
+    '事件の時、どこにいましたか？',
+    '最後に被害者を見たのはいつですか？',
+    '誰か怪しい人を見ましたか？',
+    '紅茶は誰が入れましたか？'
+]
+LOCATIONS = ['リビング', '書斎', 'キッチン', 'テーブルの下', 'ベランダ', 'ゴミ箱', 'クローゼット', '仕事机', '引き出し', 'トイレ']
+# 既定シナリオの推理の採点（reasoning の concepts と required_groups）で正解になる文章と、ならない文章
+CORRECT_REASONING = '犯人は成田さきです。契約書を破り捨てたことを隠すために、消えるボールペンで書いた字をアイロンで温めて消しました。'
+WRONG_REASONING = '犯人は被害者の兄だと思います。'
+# 推理の文章と、返信に届くはずのエンディング
+EXPECTED_ENDINGS = {CORRECT_REASONING: 'correct', WRONG_REASONING: 'incorrect'}
+START_INVESTIGATION = '先生、では質問しますね'
+ANNOUNCE = '推理を発表したい'
+FINISH = '終了したい'
+# investigation の limit の上限（既定シナリオで reasoning に移るターン数）
+INVESTIGATION_LIMIT = 30
+
+
+# 1人のプレイヤーが送るメッセージを作る
+# exhaust: investigation で時間切れ（limit）まで粘るプレイヤー
+def make_journey(rng, exhaust):
+    journey = [rng.choice(INTRO_QUESTIONS) for _ in range(rng.randint(1, 4))]
+    journey.append(START_INVESTIGATION)
+    turns = INVESTIGATION_LIMIT if exhaust else rng.randint(6, 20)
+    for _ in range(turns):
+        if rng.random() < 0.6:
+            journey.append(f'{rng.choice(LOCATIONS)}を調べたい')
+        else:
+            journey.append(rng.choice(INVESTIGATION_QUESTIONS))
+    if not exhaust:
+        journey.append(ANNOUNCE)
+    journey.append(CORRECT_REASONING if rng.random() < 0.5 else WRONG_REASONING)
+    journey.append(FINISH)
+    return journey
+
+
+# 代役のLINE、OpenAI、DynamoDBを繋いでボットを読み込む
+def install_stack(args, rng):
+    local_stack.prepare_environment(THROTTLE_ENABLED='true' if args.throttle else 'false')
+    # GPTの呼び出しを流すスレッドもプレイヤー数に合わせる（明示されていればそちら）
+    os.environ.setdefault('GPT_EXECUTOR_WORKERS', str(args.workers))
+    os.environ.setdefault('SERVER_EXECUTOR_WORKERS', str(args.workers))
+    stack = local_stack.install(
+        dynamodb=local_stack.LocalDynamoDB(local_stack.Latency.parse(args.dynamodb_latency, rng)),
+        line=local_stack.LocalLineBotApi(local_stack.Latency.parse(args.line_latency, rng)),
+        chat=local_stack.chat_completion(local_stack.Latency.parse(args.openai_latency, rng), rng, args.openai_recording)
+    )
+    logging.getLogger().setLevel(args.log_level)
+    return stack
+
+
+# lambda_handler をスレッドプールで呼ぶ
+class HandlerTarget:
+    def __init__(self, workers):
+        import lambda_function
+
+        self.handler = lambda_function.lambda_handler
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='load')
+
+    async def send(self, event):
+        response = await asyncio.get_running_loop().run_in_executor(self.executor, self.handler, event, None)
+        return response['statusCode']
+
+    async def close(self):
+        self.executor.shutdown(wait=False)
+
+
+# asgi_server.app をプロセス内で呼ぶ
+class AsgiTarget:
+    def __init__(self):
+        import asgi_server
+
+        self.server = asgi_server
+        self.path = asgi_server.WEBHOOK_PATH
+
+    async def send(self, event):
+        body = event['body'].encode('utf-8')
+        scope = {
+            'type': 'http',
+            'method': 'POST',
+            'path': self.path,
+            'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in event['headers'].items()]
+        }
+        sent = {'body': False}
+        status = {}
+
+        async def receive():
+            if sent['body']:
+                return {'type': 'http.disconnect'}
+            sent['body'] = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+
+        await self.server.app(scope, receive, send)
+        return status.get('code', 500)
+
+    async def close(self):
+        executor = self.server._executor
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+# 起動済みのサーバーにHTTPで送る
+class HttpTarget:
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or '/'
+
+    async def send(self, event):
+        body = event['body'].encode('utf-8')
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            head = (
+                f'POST {self.path} HTTP/1.1\r\n'
+                f'Host: {self.host}:{self.port}\r\n'
+                'Content-Type: application/json\r\n'
+                f"x-line-signature: {event['headers']['x-line-signature']}\r\n"
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: close\r\n\r\n'
+            )
+            writer.write(head.encode('latin-1') + body)
+            await writer.drain()
+            status_line = await reader.readline()
+            await reader.read()
+            return int(status_line.split()[1])
+        finally:
+            writer.close()
+
+    async def close(self):
+        pass
+
+
+# 返信に含まれるエンディング（correct / incorrect、無ければNone）
+def ending_of(texts, endings):
+    for name in ('correct', 'incorrect'):
+        if endings.get(name) in texts:
+            return name
+    return None
+
+
+# 1人分のゲームを遊ぶ
+async def play(target, line, player_id, journey, think_time, rng, stats, endings):
+    for text in journey:
+        event, reply_token = local_stack.webhook_event(player_id, text)
+        started = time.perf_counter()
+        error = None
+        try:
+            status = await target.send(event)
+            if status != 200:
+                error = f'status {status}'
+        except Exception as e:
+            error = type(e).__name__
+        finished = time.perf_counter()
+        # プロセス内の代役なら、返信が届いたかと、推理に合ったエンディングかも確かめる
+        if error is None and line is not None:
+            texts = line.sent_for(reply_token, player_id)
+            if not texts:
+                error = 'no reply'
+            elif text in EXPECTED_ENDINGS:
+                ending = ending_of(texts, endings)
+                stats['endings'][ending] = stats['endings'].get(ending, 0) + 1
+                if ending != EXPECTED_ENDINGS[text]:
+                    error = 'wrong ending'
+        stats['latencies'].append((finished - started) * 1000)
+        stats['finish_times'].append(finished)
+        if error is not None:
+            stats['errors'][error] = stats['errors'].get(error, 0) + 1
+            stats['failed_players'].add(player_id)
+        if think_time:
+            await asyncio.sleep(rng.expovariate(1 / think_time))
+
+
+async def run_players(args, target, stack):
+    rng = random.Random(args.seed)
+    stats = {'latencies': [], 'finish_times': [], 'errors': {}, 'failed_players': set(), 'endings': {}}
+    players = []
+    for index in range(args.players):
+        player_id = f'Uload{index:07d}'
+        journey = make_journey(rng, rng.random() < args.exhaust_ratio)
+        players.append((player_id, journey, random.Random(rng.random())))
+
+    started = time.perf_counter()
+    tasks = []
+    line = stack['line'] if stack else None
+    endings = {}
+    if stack:
+        import lambda_scenario
+
+        endings = lambda_scenario.get_scenario()['endings']
+    for index, (player_id, journey, player_rng) in enumerate(players):
+        # プレイヤーは ramp-up の間に少しずつ参加する
+        delay = args.ramp_up * index / max(1, args.players)
+        tasks.append(asyncio.create_task(
+            _delayed(delay, play(target, line, player_id, journey, args.think_time, player_rng, stats, endings))
+        ))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    await target.close()
+    return players, stats, started, elapsed
+
+
+async def _delayed(delay, coroutine):
+    await asyncio.sleep(delay)
+    await coroutine
+
+
+# 1秒ごとに処理できたターン数から、持続できたスループットを出す（最初と最後の立ち上がりを除いた中央値）
+def sustained_throughput(finish_times, started):
+    if not finish_times:
+        return None
+    buckets = {}
+    for finished in finish_times:
+        second = int(finished - started)
+        buckets[second] = buckets.get(second, 0) + 1
+    counts = [buckets.get(second, 0) for second in range(max(buckets) + 1)]
+    trimmed = counts[len(counts) // 10: len(counts) - len(counts) // 10] or counts
+    return percentile(sorted(trimmed), 0.5)
+
+
+def report(args, players, stats, started, elapsed, stack):
+    completed = [player_id for player_id, _, _ in players if player_id not in stats['failed_players']]
+    if stack is not None:
+        # 実際にendまで進んだゲームだけ数える
+        users = stack['dynamodb'].Table('user_info')
+        completed = [
+            player_id for player_id in completed
+            if users.items.get((player_id, None), {}).get('CurrentPhase') == 'end'
+        ]
+    turns = len(stats['latencies'])
+    result = {
+        'target': args.target,
+        'players': args.players,
+        'completed_games': len(completed),
+        'turns': turns,
+        'errors': sum(stats['errors'].values()),
+        'error_rate': round(sum(stats['errors'].values()) / turns, 5) if turns else None,
+        'errors_by_type': stats['errors'],
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_turns_per_second': round(turns / elapsed, 3) if elapsed else None,
+        'sustained_turns_per_second': sustained_throughput(stats['finish_times'], started),
+        'latency_ms': summarize(stats['latencies'])
+    }
+    if stack is not None:
+        # 推理の文章ごとに届くはずのエンディングと、実際に届いたエンディング
+        expected = {}
+        for _, journey, _ in players:
+            for text in journey:
+                if text in EXPECTED_ENDINGS:
+                    expected[EXPECTED_ENDINGS[text]] = expected.get(EXPECTED_ENDINGS[text], 0) + 1
+        result['endings'] = {'expected': expected, 'reached': stats['endings']}
+    if stack is not None and completed:
+        games = len(completed)
+        dynamodb_calls = sum(stack['dynamodb'].calls.values())
+        result['calls_per_completed_game'] = {
+            'dynamodb': round(dynamodb_calls / games, 2),
+            'dynamodb_by_operation': {name: round(count / games, 2) for name, count in sorted(stack['dynamodb'].calls.items())},
+            'openai': round(stack['openai'].calls / games, 2),
+            'line': {name: round(count / games, 2) for name, count in stack['line'].calls.items()}
+        }
+    return result
+
+
+def command_run(args):
+    rng = random.Random(args.seed)
+    stack = None
+    if args.target in ('handler', 'asgi'):
+        stack = install_stack(args, rng)
+        target = HandlerTarget(args.workers) if args.target == 'handler' else AsgiTarget()
+    else:
+        target = HttpTarget(args.target)
+    players, stats, started, elapsed = asyncio.run(run_players(args, target, stack))
+    result = report(args, players, stats, started, elapsed, stack)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+    endings = result.get('endings')
+    if endings is not None and endings['reached'] != endings['expected']:
+        return 1
+    return 1 if result['errors'] else 0
+
+
+# 代役を繋いだ常駐サーバーを起動する（HTTPで負荷をかける時の相手）
+def command_serve(args):
+    import uvicorn
+
+    install_stack(args, random.Random(args.seed))
+    import asgi_server
+
+    uvicorn.run(asgi_server.app, host=args.host, port=args.port, lifespan='on', log_level='warning')
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Drive many concurrent players through whole games.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_stack_options(subparser):
+        subparser.add_argument('--openai-latency', default='800:3000', help='OpenAI latency in ms as median:p99')
+        subparser.add_argument('--dynamodb-latency', default='5:25', help='DynamoDB latency in ms as median:p99')
+        subparser.add_argument('--line-latency', default='40:150', help='LINE API latency in ms as median:p99')
+        subparser.add_argument('--workers', type=int, default=256, help='handler / GPT threads in this process')
+        subparser.add_argument('--throttle', action='store_true', help='keep the per-user throttle enabled')
+        subparser.add_argument('--openai-recording', default=None, help='serve OpenAI responses recorded in this file (others fall back to the rule-based fake)')
+        subparser.add_argument('--seed', type=int, default=1, help='random seed')
+        subparser.add_argument('--log-level', default='WARNING', help='log level of the bot')
+
+    run_parser = subparsers.add_parser('run', help='run the load test')
+    run_parser.add_argument('--target', default='handler', help='handler, asgi or the webhook URL of a running server')
+    run_parser.add_argument('--players', type=int, default=200, help='number of players')
+    run_parser.add_argument('--ramp-up', type=float, default=10.0, help='seconds over which players join')
+    run_parser.add_argument('--think-time', type=float, default=2.0, help='mean seconds a player waits between messages')
+    run_parser.add_argument('--exhaust-ratio', type=float, default=0.2,
+                            help='fraction of players who use up the investigation limit instead of announcing')
+    run_parser.add_argument('--output', default=None, help='file to save the report to as JSON')
+    add_stack_options(run_parser)
+
+    serve_parser = subparsers.add_parser('serve', help='run the ASGI server with the local stand-ins')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    add_stack_options(serve_parser)
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        return command_serve(args)
+    return command_run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
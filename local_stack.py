@@ -0,0 +1,756 @@
+import base64
+import copy
+import gzip
+import hashlib
+import hmac
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
+
+# ローカルでボットを動かすための代役（DynamoDB、LINE、OpenAI）
+# ベンチマークや負荷試験で lambda_handler をそのまま呼ぶために使う
+# lambda_function を読み込む前に prepare_environment() を呼ぶこと
+
+# 署名に使うチャネルシークレット（ローカル専用）
+LOCAL_CHANNEL_SECRET = 'local-channel-secret'
+
+
+# lambda_function の読み込みに必要な環境変数を埋める（設定済みのものはそのまま）
+def prepare_environment(**overrides):
+    defaults = {
+        'CHANNEL_ACCESS_TOKEN': 'local-access-token',
+        'CHANNEL_SECRET': LOCAL_CHANNEL_SECRET,
+        'SECRET_KEY': 'local-openai-key',
+        'AWS_DEFAULT_REGION': 'ap-northeast-1',
+        'AWS_ACCESS_KEY_ID': 'local',
+        'AWS_SECRET_ACCESS_KEY': 'local'
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+    for name, value in overrides.items():
+        os.environ[name] = str(value)
+
+
+# 待ち時間の分布（中央値とp99をミリ秒で指定する対数正規分布）
+class Latency:
+    def __init__(self, median_ms=0.0, p99_ms=None, rng=None):
+        self.median_ms = float(median_ms)
+        self.p99_ms = float(p99_ms if p99_ms is not None else median_ms)
+        self.rng = rng or random.Random()
+        # p99はz=2.326の位置
+        if self.median_ms > 0 and self.p99_ms > self.median_ms:
+            self.sigma = math.log(self.p99_ms / self.median_ms) / 2.326
+        else:
+            self.sigma = 0.0
+
+    # "中央値:p99" または "中央値" の文字列から作る
+    @classmethod
+    def parse(cls, spec, rng=None):
+        median, _, p99 = str(spec).partition(':')
+        return cls(float(median), float(p99) if p99 else None, rng)
+
+    def sample(self):
+        if self.median_ms <= 0:
+            return 0.0
+        if self.sigma == 0:
+            return self.median_ms / 1000
+        return self.rng.lognormvariate(math.log(self.median_ms), self.sigma) / 1000
+
+    def wait(self):
+        delay = self.sample()
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+# ----------------------------------------------------------------------------
+# DynamoDB（メモリ上のテーブル）
+# ----------------------------------------------------------------------------
+
+# テーブルごとのキー（パーティションキー, ソートキー）とGSI
+TABLE_SCHEMAS = {
+    'user_info': {
+        'keys': ('user_id', None),
+        'indexes': {'CurrentPhase-LastActivity-index': ('CurrentPhase', 'LastActivity')}
+    },
+    'talk_history': {'keys': ('user_id', 'date'), 'indexes': {}},
+    'Prompts': {'keys': ('Phase', None), 'indexes': {}},
+    'turn_events': {'keys': ('session_key', 'event_key'), 'indexes': {}}
+}
+
+
+def _client_error(code, message, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+# boto3と同じく数値はDecimalで持つ
+def _to_dynamo(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_dynamo(v) for v in value]
+    return value
+
+
+# boto3.dynamodb.conditions の式（Key / Attr）を評価する
+def _evaluate_condition(condition, item):
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+
+    def operand(value):
+        if hasattr(value, 'name') and not hasattr(value, 'get_expression'):
+            return item.get(value.name)
+        return _to_dynamo(value)
+
+    if operator == 'AND':
+        return _evaluate_condition(values[0], item) and _evaluate_condition(values[1], item)
+    if operator == 'OR':
+        return _evaluate_condition(values[0], item) or _evaluate_condition(values[1], item)
+    if operator == 'NOT':
+        return not _evaluate_condition(values[0], item)
+    if operator == 'attribute_exists':
+        return values[0].name in item
+    if operator == 'attribute_not_exists':
+        return values[0].name not in item
+    left = operand(values[0])
+    if operator == 'begins_with':
+        return isinstance(left, str) and left.startswith(operand(values[1]))
+    if operator == 'contains':
+        return left is not None and operand(values[1]) in left
+    if operator == 'BETWEEN':
+        return left is not None and operand(values[1]) <= left <= operand(values[2])
+    if operator == 'IN':
+        return left in [operand(v) for v in values[1]]
+    return _compare(operator, left, operand(values[1]))
+
+
+# キー条件からパーティションキーの値を取り出す
+def _hash_value(condition, hash_key):
+    expression = condition.get_expression()
+    if expression['operator'] == 'AND':
+        value = _hash_value(expression['values'][0], hash_key)
+        return value if value is not None else _hash_value(expression['values'][1], hash_key)
+    if expression['operator'] == '=' and getattr(expression['values'][0], 'name', None) == hash_key:
+        return expression['values'][1]
+    return None
+
+
+def _compare(operator, left, right):
+    if operator == '=':
+        return left == right
+    if operator == '<>':
+        return left != right
+    if left is None or right is None:
+        return False
+    return {
+        '<': left < right,
+        '<=': left <= right,
+        '>': left > right,
+        '>=': left >= right
+    }[operator]
+
+
+_TOKEN_PATTERN = re.compile(r'\s*(<>|<=|>=|[=<>(),]|[#:]?[A-Za-z_][A-Za-z0-9_]*)')
+
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _TOKEN_PATTERN.match(expression, position)
+        if match is None:
+            raise ValueError(f"Unsupported expression: {expression}")
+        tokens.append(match.group(1))
+        position = match.end()
+        while position < len(expression) and expression[position].isspace():
+            position += 1
+    return tokens
+
+
+# 文字列の ConditionExpression を評価する（DAOが使う範囲: 比較、attribute_exists、AND / OR）
+def _evaluate_condition_string(expression, item, names, values):
+    tokens = _tokenize(expression)
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+
+    def take():
+        token = tokens[position[0]]
+        position[0] += 1
+        return token
+
+    def resolve(token):
+        if token.startswith(':'):
+            return _to_dynamo(values[token])
+        return item.get(names.get(token, token))
+
+    def atom():
+        token = take()
+        if token == '(':
+            result = disjunction()
+            take()
+            return result
+        if token in ('attribute_exists', 'attribute_not_exists'):
+            take()
+            name = take()
+            take()
+            exists = names.get(name, name) in item
+            return exists if token == 'attribute_exists' else not exists
+        operator = take()
+        return _compare(operator, resolve(token), resolve(take()))
+
+    def conjunction():
+        result = atom()
+        while peek() is not None and peek().upper() == 'AND':
+            take()
+            right = atom()
+            result = result and right
+        return result
+
+    def disjunction():
+        result = conjunction()
+        while peek() is not None and peek().upper() == 'OR':
+            take()
+            right = conjunction()
+            result = result or right
+        return result
+
+    return disjunction()
+
+
+# UpdateExpression を当てはめる（SET a = :v / ADD a :v / REMOVE a）
+def _apply_update(expression, item, names, values):
+    sections = re.split(r'\b(SET|ADD|REMOVE)\b', expression)
+    for index in range(1, len(sections), 2):
+        action = sections[index]
+        for clause in sections[index + 1].split(','):
+            clause = clause.strip()
+            if not clause:
+                continue
+            if action == 'SET':
+                name, _, value = clause.partition('=')
+                item[names.get(name.strip(), name.strip())] = _to_dynamo(values[value.strip()])
+            elif action == 'ADD':
+                name, value = clause.split()
+                name = names.get(name, name)
+                item[name] = item.get(name, Decimal(0)) + _to_dynamo(values[value])
+            else:
+                item.pop(names.get(clause, clause), None)
+
+
+class LocalBatchWriter:
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def delete_item(self, Key):
+        self.table.delete_item(Key=Key)
+
+
+class LocalTable:
+    def __init__(self, name, latency=None, calls=None, throttle_rate=0.0):
+        schema = TABLE_SCHEMAS.get(name, {'keys': ('id', None), 'indexes': {}})
+        self.name = name
+        self.hash_key, self.range_key = schema['keys']
+        self.indexes = schema['indexes']
+        self.latency = latency or Latency()
+        self.calls = calls if calls is not None else {}
+        # この割合の呼び出しをスロットリングで失敗させる（再試行の確認用）
+        self.throttle_rate = throttle_rate
+        self.items = {}
+        # パーティションキーごとのキー（クエリで全件を見ないように）
+        self.partitions = {}
+        self.lock = threading.Lock()
+
+    def _key(self, key):
+        return (key[self.hash_key], key.get(self.range_key) if self.range_key else None)
+
+    # アイテムを置く・消す（ロックを取ってから呼ぶ）
+    def store(self, item):
+        key = self._key(item)
+        self.items[key] = _to_dynamo(item)
+        self.partitions.setdefault(key[0], set()).add(key)
+
+    def discard(self, key):
+        key = self._key(key)
+        self.items.pop(key, None)
+        partition = self.partitions.get(key[0])
+        if partition is not None:
+            partition.discard(key)
+
+    # 呼び出しに数えずにアイテムを読む（リプレイで状態を比べる用）
+    def peek(self, key):
+        with self.lock:
+            item = self.items.get(self._key(key))
+            return copy.deepcopy(item) if item is not None else None
+
+    def _count(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        self.latency.wait()
+        if self.throttle_rate and self.latency.rng.random() < self.throttle_rate:
+            with self.lock:
+                self.calls['Throttled'] = self.calls.get('Throttled', 0) + 1
+            raise _client_error('ProvisionedThroughputExceededException', 'The level of configured provisioned throughput for the table was exceeded', operation)
+
+    def _capacity(self, kwargs):
+        if kwargs.get('ReturnConsumedCapacity') in ('TOTAL', 'INDEXES'):
+            return {'ConsumedCapacity': {'TableName': self.name, 'CapacityUnits': 1.0}}
+        return {}
+
+    def _check(self, kwargs, item, operation):
+        condition = kwargs.get('ConditionExpression')
+        if condition is None:
+            return
+        if isinstance(condition, str):
+            passed = _evaluate_condition_string(
+                condition, item or {}, kwargs.get('ExpressionAttributeNames', {}), kwargs.get('ExpressionAttributeValues', {})
+            )
+        else:
+            passed = _evaluate_condition(condition, item or {})
+        if not passed:
+            error = _client_error('ConditionalCheckFailedException', 'The conditional request failed', operation)
+            # boto3と同じく、今のアイテムはDynamoDBの型付きの形で返る
+            if kwargs.get('ReturnValuesOnConditionCheckFailure') == 'ALL_OLD' and item is not None:
+                serializer = TypeSerializer()
+                error.response['Item'] = {name: serializer.serialize(value) for name, value in item.items()}
+            raise error
+
+    def get_item(self, Key, **kwargs):
+        self._count('GetItem')
+        with self.lock:
+            item = self.items.get(self._key(Key))
+            response = self._capacity(kwargs)
+            if item is not None:
+                response['Item'] = copy.deepcopy(item)
+        return response
+
+    def put_item(self, Item, **kwargs):
+        self._count('PutItem')
+        with self.lock:
+            key = self._key(Item)
+            self._check(kwargs, self.items.get(key), 'PutItem')
+            self.store(Item)
+        return self._capacity(kwargs)
+
+    def delete_item(self, Key, **kwargs):
+        self._count('DeleteItem')
+        with self.lock:
+            key = self._key(Key)
+            self._check(kwargs, self.items.get(key), 'DeleteItem')
+            self.discard(Key)
+        return self._capacity(kwargs)
+
+    def update_item(self, Key, UpdateExpression, **kwargs):
+        self._count('UpdateItem')
+        with self.lock:
+            key = self._key(Key)
+            current = self.items.get(key)
+            self._check(kwargs, current, 'UpdateItem')
+            item = copy.deepcopy(current) if current is not None else _to_dynamo(dict(Key))
+            _apply_update(
+                UpdateExpression, item, kwargs.get('ExpressionAttributeNames', {}), kwargs.get('ExpressionAttributeValues', {})
+            )
+            self.store(item)
+            response = self._capacity(kwargs)
+            if kwargs.get('ReturnValues') == 'ALL_NEW':
+                response['Attributes'] = copy.deepcopy(item)
+            elif kwargs.get('ReturnValues') == 'UPDATED_NEW':
+                names = kwargs.get('ExpressionAttributeNames', {}).values()
+                response['Attributes'] = {name: copy.deepcopy(item[name]) for name in names if name in item}
+        return response
+
+    # ページを切り出す（ExclusiveStartKeyの次からLimit件）
+    def _page(self, items, kwargs, key_names):
+        start = kwargs.get('ExclusiveStartKey')
+        if start is not None:
+            start_values = tuple(start.get(name) for name in key_names)
+            for index, item in enumerate(items):
+                if tuple(item.get(name) for name in key_names) == start_values:
+                    items = items[index + 1:]
+                    break
+        limit = kwargs.get('Limit')
+        page = items[:limit] if limit else items
+        response = self._capacity(kwargs)
+        if limit and len(items) > limit:
+            response['LastEvaluatedKey'] = {name: page[-1][name] for name in key_names if name in page[-1]}
+        condition = kwargs.get('FilterExpression')
+        if condition is not None:
+            page = [item for item in page if _evaluate_condition(condition, item)]
+        response['Items'] = [copy.deepcopy(item) for item in page]
+        response['Count'] = len(response['Items'])
+        return response
+
+    def query(self, KeyConditionExpression, **kwargs):
+        self._count('Query')
+        hash_key, range_key = self.hash_key, self.range_key
+        index_name = kwargs.get('IndexName')
+        if index_name is not None:
+            hash_key, range_key = self.indexes[index_name]
+        with self.lock:
+            if index_name is None:
+                candidates = [self.items[key] for key in self.partitions.get(_hash_value(KeyConditionExpression, hash_key), ())]
+            else:
+                candidates = list(self.items.values())
+            items = [
+                item for item in candidates
+                if hash_key in item and (range_key is None or range_key in item)
+                and _evaluate_condition(KeyConditionExpression, item)
+            ]
+        if range_key is not None:
+            items.sort(key=lambda item: item[range_key], reverse=not kwargs.get('ScanIndexForward', True))
+        key_names = [name for name in (hash_key, range_key, self.hash_key, self.range_key) if name]
+        return self._page(items, kwargs, list(dict.fromkeys(key_names)))
+
+    def scan(self, **kwargs):
+        self._count('Scan')
+        with self.lock:
+            items = sorted(self.items.values(), key=lambda item: str(self._key(item)))
+        total = kwargs.get('TotalSegments')
+        if total:
+            segment = kwargs['Segment']
+            items = [
+                item for item in items
+                if int(hashlib.md5(str(item[self.hash_key]).encode('utf-8')).hexdigest(), 16) % total == segment
+            ]
+        return self._page(items, kwargs, [name for name in (self.hash_key, self.range_key) if name])
+
+    def batch_writer(self):
+        return LocalBatchWriter(self)
+
+
+class LocalDynamoDB:
+    def __init__(self, latency=None, throttle_rate=0.0):
+        self.latency = latency or Latency()
+        self.throttle_rate = throttle_rate
+        # 操作ごとの呼び出し回数
+        self.calls = {}
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def Table(self, name):
+        with self.lock:
+            table = self.tables.get(name)
+            if table is None:
+                table = LocalTable(name, self.latency, self.calls, self.throttle_rate)
+                self.tables[name] = table
+            return table
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        for name, requests in RequestItems.items():
+            table = self.Table(name)
+            table._count('BatchWriteItem')
+            for request in requests:
+                if 'PutRequest' in request:
+                    with table.lock:
+                        table.store(request['PutRequest']['Item'])
+                else:
+                    with table.lock:
+                        table.discard(request['DeleteRequest']['Key'])
+        response = {'UnprocessedItems': {}}
+        if kwargs.get('ReturnConsumedCapacity') in ('TOTAL', 'INDEXES'):
+            response['ConsumedCapacity'] = [{'TableName': name, 'CapacityUnits': float(len(requests))} for name, requests in RequestItems.items()]
+        return response
+
+
+# ----------------------------------------------------------------------------
+# LINE Messaging API
+# ----------------------------------------------------------------------------
+
+class LocalLineBotApi:
+    def __init__(self, latency=None):
+        self.latency = latency or Latency()
+        self.lock = threading.Lock()
+        # 送ったメッセージ（reply_token または宛先ごと）
+        self.replies = {}
+        self.pushes = {}
+        self.calls = {'reply_message': 0, 'push_message': 0}
+        # 同じリプライトークンで2回返信しようとした回数（本物ではエラーになる）
+        self.duplicate_replies = 0
+
+    def reply_message(self, reply_token, messages):
+        self.latency.wait()
+        texts = [getattr(message, 'text', None) for message in _as_list(messages)]
+        with self.lock:
+            self.calls['reply_message'] += 1
+            if reply_token in self.replies:
+                self.duplicate_replies += 1
+            self.replies.setdefault(reply_token, []).extend(texts)
+
+    def push_message(self, to, messages):
+        self.latency.wait()
+        texts = [getattr(message, 'text', None) for message in _as_list(messages)]
+        with self.lock:
+            self.calls['push_message'] += 1
+            self.pushes.setdefault(to, []).extend(texts)
+
+    # 1回のWebhookに対して返したメッセージ（返信とpushを合わせる）
+    def sent_for(self, reply_token, to=None):
+        with self.lock:
+            texts = list(self.replies.get(reply_token, []))
+            if to is not None:
+                texts.extend(self.pushes.pop(to, []))
+            return texts
+
+
+def _as_list(messages):
+    return messages if isinstance(messages, (list, tuple)) else [messages]
+
+
+# ----------------------------------------------------------------------------
+# OpenAI（ルールで返答を作る代役）
+# ----------------------------------------------------------------------------
+
+class LocalChatCompletion:
+    def __init__(self, latency=None, locations=(), rng=None):
+        self.latency = latency or Latency()
+        # 関数呼び出しで返す場所の候補（長い名前から探す）
+        self.locations = sorted(locations, key=len, reverse=True)
+        self.rng = rng or random.Random()
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    # 最後のユーザー発言に応じて、関数呼び出しか短い返答を返す
+    def respond(self, messages, functions=None):
+        query = next((m.get('content') or '' for m in reversed(messages) if m.get('role') == 'user'), '')
+        names = {function['name'] for function in functions or []}
+        message = {'role': 'assistant', 'content': None}
+        if 'update_user_phase_investigation' in names and '発表' in query:
+            message['function_call'] = {'name': 'update_user_phase_investigation', 'arguments': '{}'}
+        else:
+            location = next((name for name in self.locations if name in query), None)
+            if 'want_survey_location' in names and (location or '調べ' in query):
+                arguments = {'location_name': location or query[:10]}
+                message['function_call'] = {'name': 'want_survey_location', 'arguments': json.dumps(arguments, ensure_ascii=False)}
+            else:
+                message['content'] = f'ふむ、「{query[:20]}」についてか。少し思い出してみよう。'
+        return message
+
+    def create(self, model=None, messages=(), functions=None, request_timeout=None, **kwargs):
+        delay = self.latency.sample()
+        if request_timeout is not None and delay > request_timeout:
+            time.sleep(request_timeout)
+            raise TimeoutError(f'Request timed out after {request_timeout:.1f}s')
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            self.calls += 1
+        message = self.respond(messages, functions)
+        prompt_tokens = sum(len(m.get('content') or '') for m in messages)
+        completion_tokens = len(message.get('content') or '') or 10
+        return {
+            'id': f'chatcmpl-local-{uuid.uuid4().hex[:12]}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': message,
+                'finish_reason': 'function_call' if message.get('function_call') else 'stop'
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens
+            }
+        }
+
+
+# 応答を決める引数（request_timeout などの通信の設定は含めない）
+FINGERPRINT_ARGUMENTS = (
+    'model', 'messages', 'functions', 'function_call', 'temperature', 'max_tokens',
+    'top_p', 'frequency_penalty', 'presence_penalty', 'stop'
+)
+
+
+# ChatGPTへのリクエストの指紋（同じ引数なら同じ値）
+def fingerprint(kwargs):
+    request = {name: kwargs[name] for name in FINGERPRINT_ARGUMENTS if kwargs.get(name) is not None}
+    text = json.dumps(request, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:32]
+
+
+# ChatGPTの応答を記録して、後で同じリクエストに同じ応答を返す代役
+# record: upstream（本物の openai.ChatCompletion.create など）を呼んで、応答を path に追記する
+# replay: 記録した応答を返す（待ち時間は latency から）。記録に無いリクエストは fallback（LocalChatCompletion）に任せる
+# 記録は gzip の JSON Lines（1行が {"fingerprint", "response"}）。追記ごとに gzip のメンバーが増えるが、そのまま読める
+class RecordedChatCompletion:
+    def __init__(self, path, mode='replay', upstream=None, latency=None, fallback=None):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown recording mode: {mode}")
+        if mode == 'record' and upstream is None:
+            raise ValueError('record mode needs an upstream create function')
+        self.path = path
+        self.mode = mode
+        self.upstream = upstream
+        self.latency = latency or Latency()
+        self.fallback = fallback or LocalChatCompletion(rng=self.latency.rng)
+        self.lock = threading.Lock()
+        self.responses = self._load(path)
+        self.stats = {'hits': 0, 'misses': 0, 'recorded': 0}
+
+    @staticmethod
+    def _load(path):
+        responses = {}
+        if not path or not os.path.exists(path):
+            return responses
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    responses[record['fingerprint']] = record['response']
+        return responses
+
+    # install() がシナリオの場所を渡す先（記録に無い時の代役）
+    @property
+    def locations(self):
+        return self.fallback.locations
+
+    @locations.setter
+    def locations(self, value):
+        self.fallback.locations = value
+
+    @property
+    def calls(self):
+        return self.stats['hits'] + self.stats['misses'] + self.stats['recorded']
+
+    def _append(self, key, response):
+        line = json.dumps({'fingerprint': key, 'response': response}, ensure_ascii=False, separators=(',', ':'))
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+    def create(self, **kwargs):
+        key = fingerprint(kwargs)
+        if self.mode == 'record':
+            response = self.upstream(**kwargs)
+            # OpenAIObject も辞書に直して保存する
+            stored = json.loads(json.dumps(response))
+            with self.lock:
+                self.stats['recorded'] += 1
+                if key not in self.responses:
+                    self.responses[key] = stored
+                    self._append(key, stored)
+            return response
+
+        with self.lock:
+            stored = self.responses.get(key)
+            self.stats['hits' if stored is not None else 'misses'] += 1
+        if stored is None:
+            return self.fallback.create(**kwargs)
+        delay = self.latency.sample()
+        request_timeout = kwargs.get('request_timeout')
+        if request_timeout is not None and delay > request_timeout:
+            time.sleep(request_timeout)
+            raise TimeoutError(f'Request timed out after {request_timeout:.1f}s')
+        if delay > 0:
+            time.sleep(delay)
+        return copy.deepcopy(stored)
+
+
+# OpenAIの代役を作る
+# recording があればその記録から返し（記録に無ければ規則で返す）、record なら本物を呼んで記録する
+def chat_completion(latency=None, rng=None, recording=None, record=False):
+    fallback = LocalChatCompletion(latency, rng=rng)
+    if not recording:
+        return fallback
+    if record:
+        import openai
+
+        return RecordedChatCompletion(recording, 'record', upstream=openai.ChatCompletion.create)
+    return RecordedChatCompletion(recording, 'replay', latency=latency, fallback=fallback)
+
+
+# ----------------------------------------------------------------------------
+# 組み立て
+# ----------------------------------------------------------------------------
+
+# 代役をボットのモジュールに差し込む
+# 返り値: {'dynamodb', 'line', 'openai'} の代役
+def install(dynamodb=None, line=None, chat=None, scenario_id=None):
+    import openai
+
+    import lambda_dao
+    import lambda_function
+    import lambda_scenario
+    import lambda_user_cache
+
+    scenario = lambda_scenario.get_scenario(scenario_id)
+    dynamodb = dynamodb or LocalDynamoDB()
+    line = line or LocalLineBotApi()
+    chat = chat or LocalChatCompletion()
+    if not chat.locations:
+        # 関数呼び出しで返す場所はシナリオから
+        chat.locations = sorted(scenario['location_index']['urls'], key=len, reverse=True)
+
+    lambda_dao.dynamodb = dynamodb
+    # 前に入れ替えたテーブルのユーザー情報を覚えていないように
+    lambda_user_cache.clear()
+    lambda_dao.user_table = dynamodb.Table('user_info')
+    lambda_dao.talk_history = dynamodb.Table('talk_history')
+    lambda_dao.turn_events = dynamodb.Table(lambda_dao.TURN_EVENTS_TABLE)
+    lambda_function.line_bot_api = line
+    openai.ChatCompletion.create = chat.create
+
+    # パックに書かれていないプロンプトを入れておく
+    prompts = dynamodb.Table('Prompts')
+    for name, phase in scenario['machine']['phases'].items():
+        if phase['gpt'] and name not in scenario['prompts']:
+            prompts.store({
+                'Phase': scenario['prompt_prefix'] + name,
+                'Prompt': f'あなたはマーダーミステリーの登場人物です。（{name}）'
+            })
+    return {'dynamodb': dynamodb, 'line': line, 'openai': chat}
+
+
+# Webhookの署名を作る
+def sign(body, secret=None):
+    secret = secret or os.getenv('CHANNEL_SECRET', LOCAL_CHANNEL_SECRET)
+    digest = hmac.new(secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+# テキストメッセージ1件のWebhookイベントを作る（lambda_handlerにそのまま渡せる形）
+# group_idを渡すとグループでの発言になる
+def webhook_event(user_id, text, group_id=None, reply_token=None, timestamp_ms=None):
+    source = {'type': 'user', 'userId': user_id}
+    if group_id is not None:
+        source = {'type': 'group', 'groupId': group_id, 'userId': user_id}
+    reply_token = reply_token or uuid.uuid4().hex
+    body = json.dumps({
+        'destination': 'Ulocal',
+        'events': [{
+            'type': 'message',
+            'mode': 'active',
+            'timestamp': timestamp_ms or int(time.time() * 1000),
+            'source': source,
+            'webhookEventId': uuid.uuid4().hex.upper(),
+            'deliveryContext': {'isRedelivery': False},
+            'replyToken': reply_token,
+            'message': {'type': 'text', 'id': str(random.randint(10 ** 13, 10 ** 14)), 'text': text}
+        }]
+    }, ensure_ascii=False)
+    return {'headers': {'x-line-signature': sign(body)}, 'body': body}, reply_token
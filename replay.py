@@ -0,0 +1,304 @@
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import local_stack
+from benchmark import summarize
+
+# 本番のWebhookを、ローカルの代役（DynamoDB、LINE、OpenAI）に対してもう一度流す
+# 遅いセッションや壊れたセッションを手元で再現して、直した後に同じ流れで確かめるために使う
+# 流せるもの:
+#   ログ: lambda_handler が INFO で出す Webhook の body（CloudWatch Logs のテキストやJSON Linesの書き出し）
+#   書き出した会話: lambda_export の Parquet（--export。ゲームの始めのフェーズを user_info に入れてから流す）
+#   python replay.py logs/*.txt --speed 10 --output replay/after.json --compare replay/before.json
+#   python replay.py --export s3://bucket/turns --since 2024-01-01 --user-id Uxxxx
+
+
+# ログの1行からWebhookのbodyを取り出す（見つからなければNone）
+def extract_body(line):
+    start = line.find('{')
+    if start < 0:
+        return None
+    try:
+        value = json.loads(line[start:])
+    except ValueError:
+        return None
+    # CloudWatch Logs の書き出し（{"timestamp": ..., "message": "..."}）
+    if 'events' not in value and isinstance(value.get('message'), str):
+        return extract_body(value['message'])
+    if not isinstance(value.get('events'), list):
+        return None
+    return line[start:].strip()
+
+
+# Webhookの送り主（user_infoのキー）
+def _session_key(source):
+    return source.get('groupId') or source.get('roomId') or source.get('userId')
+
+
+# ログからリプレイするターンを作る（Webhookの時刻順）
+def read_logs(paths):
+    turns = []
+    seen = set()
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                body = extract_body(line)
+                if body is None:
+                    continue
+                events = json.loads(body)['events']
+                # 同じWebhookが複数のログに出ていたら1回だけ
+                ids = tuple(event.get('webhookEventId') or event.get('replyToken') for event in events)
+                if not events or ids in seen:
+                    continue
+                seen.add(ids)
+                turns.append({
+                    'body': body,
+                    'timestamp': min(event.get('timestamp', 0) for event in events),
+                    'key': _session_key(events[0].get('source', {})),
+                    'text': ' / '.join(event.get('message', {}).get('text', '') for event in events),
+                    'reply_tokens': [event['replyToken'] for event in events if event.get('replyToken')]
+                })
+    turns.sort(key=lambda turn: turn['timestamp'])
+    return turns
+
+
+# 書き出した会話からリプレイするターンを作る
+# 会話履歴に残るのはChatGPTに渡したターンだけなので、ゲームごとに最初のターンの前に user_info を作り直す
+# 期待する値として、元の返答とターンの始めのフェーズを持たせる
+def read_export(path, since=None, until=None, user_ids=None):
+    import lambda_analytics
+
+    columns = ['user_id', 'session_id', 'ts', 'phase', 'speaker', 'message', 'reply']
+    table = lambda_analytics._dataset(path).to_table(columns=columns, filter=lambda_analytics._date_filter(since, until))
+    rows = sorted(table.to_pylist(), key=lambda row: row['ts'].timestamp())
+    turns = []
+    started = set()
+    for row in rows:
+        if user_ids and row['user_id'] not in user_ids:
+            continue
+        timestamp = int(row['ts'].timestamp() * 1000)
+        if row['speaker']:
+            event, reply_token = local_stack.webhook_event(row['speaker'], row['message'], group_id=row['user_id'], timestamp_ms=timestamp)
+        else:
+            event, reply_token = local_stack.webhook_event(row['user_id'], row['message'], timestamp_ms=timestamp)
+        turn = {
+            'body': event['body'],
+            'timestamp': timestamp,
+            'key': row['user_id'],
+            'text': row['message'],
+            'reply_tokens': [reply_token],
+            'expected': {'phase': row['phase'], 'reply': row['reply']}
+        }
+        game = (row['user_id'], row['session_id'])
+        if game not in started:
+            started.add(game)
+            turn['seed'] = {'user_id': row['user_id'], 'CurrentPhase': row['phase'], 'count': 0, 'limit': 0}
+            if row['session_id']:
+                turn['seed']['SessionId'] = row['session_id']
+        turns.append(turn)
+    return turns
+
+
+# 1ターンを流して、返答と状態の変化を記録する
+def replay_turn(lambda_function, stack, index, turn):
+    users = stack['dynamodb'].Table('user_info')
+    if 'seed' in turn:
+        with users.lock:
+            users.store(turn['seed'])
+    before = users.peek({'user_id': turn['key']}) or {}
+    # 本番の署名はローカルのチャネルシークレットで付け直す
+    event = {'headers': {'x-line-signature': local_stack.sign(turn['body'])}, 'body': turn['body']}
+    started = time.perf_counter()
+    error = None
+    try:
+        response = lambda_function.lambda_handler(event, None)
+        if response['statusCode'] != 200:
+            error = f"status {response['statusCode']}"
+    except Exception as e:
+        error = repr(e)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    after = users.peek({'user_id': turn['key']}) or {}
+
+    replies = []
+    for position, reply_token in enumerate(turn['reply_tokens']):
+        # pushは送り先ごとなので最後のイベントにまとめる
+        last = position == len(turn['reply_tokens']) - 1
+        replies.extend(stack['line'].sent_for(reply_token, turn['key'] if last else None))
+    result = {
+        'index': index,
+        'key': turn['key'],
+        'text': turn['text'],
+        'ms': round(elapsed_ms, 2),
+        'phase_before': before.get('CurrentPhase'),
+        'phase_after': after.get('CurrentPhase'),
+        'replies': replies,
+        'error': error
+    }
+    if 'expected' in turn:
+        result['expected'] = turn['expected']
+    return result
+
+
+# ターンを流す
+# speed が0なら待たずに1つずつ順に（毎回同じ結果になる）
+# それ以外は元の間隔を speed で割った時刻に、送り主ごとに順番を守りながら並行に流す
+def replay(lambda_function, stack, turns, speed):
+    results = [None] * len(turns)
+    if not speed:
+        for index, turn in enumerate(turns):
+            results[index] = replay_turn(lambda_function, stack, index, turn)
+        return results
+
+    by_key = {}
+    for index, turn in enumerate(turns):
+        by_key.setdefault(turn['key'], []).append(index)
+    origin = turns[0]['timestamp'] if turns else 0
+    started = time.monotonic()
+
+    def play(indexes):
+        for index in indexes:
+            delay = started + (turns[index]['timestamp'] - origin) / 1000 / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            results[index] = replay_turn(lambda_function, stack, index, turns[index])
+
+    threads = [threading.Thread(target=play, args=(indexes,)) for indexes in by_key.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# 2つの結果の違い（返答、フェーズの移り変わり、エラー）
+# 書き出した会話から流した時は、元の返答と始めのフェーズとも比べる
+def diff(previous, current):
+    differences = []
+    for before, after in zip(previous, current):
+        for field in ('phase_before', 'phase_after', 'replies', 'error'):
+            if before.get(field) != after.get(field):
+                differences.append({'index': after['index'], 'key': after['key'], 'text': after['text'], 'field': field, 'before': before.get(field), 'after': after.get(field)})
+    if len(previous) != len(current):
+        differences.append({'field': 'turns', 'before': len(previous), 'after': len(current)})
+    return differences
+
+
+def diff_expected(results):
+    differences = []
+    for result in results:
+        expected = result.get('expected')
+        if expected is None:
+            continue
+        if expected['phase'] != result['phase_before']:
+            differences.append({'index': result['index'], 'key': result['key'], 'text': result['text'], 'field': 'phase_before', 'before': expected['phase'], 'after': result['phase_before']})
+        if expected['reply'] not in result['replies']:
+            differences.append({'index': result['index'], 'key': result['key'], 'text': result['text'], 'field': 'replies', 'before': [expected['reply']], 'after': result['replies']})
+    return differences
+
+
+def run(args):
+    local_stack.prepare_environment(THROTTLE_ENABLED='true' if args.throttle else 'false')
+    import lambda_function
+
+    if args.export:
+        turns = read_export(args.export, args.since, args.until, set(args.user_id or ()))
+    else:
+        turns = read_logs(args.logs)
+    if args.user_id and not args.export:
+        turns = [turn for turn in turns if turn['key'] in args.user_id]
+    if args.limit:
+        turns = turns[:args.limit]
+
+    rng = random.Random(args.seed)
+    stack = local_stack.install(
+        dynamodb=local_stack.LocalDynamoDB(local_stack.Latency.parse(args.dynamodb_latency, rng)),
+        line=local_stack.LocalLineBotApi(local_stack.Latency.parse(args.line_latency, rng)),
+        chat=local_stack.chat_completion(local_stack.Latency.parse(args.openai_latency, rng), rng, args.openai_recording, args.record),
+        scenario_id=args.scenario
+    )
+    # lambda_function は読み込み時にINFOにするので、読み込んだ後に合わせる
+    logging.getLogger().setLevel(args.log_level)
+
+    started = time.perf_counter()
+    results = replay(lambda_function, stack, turns, args.speed)
+    elapsed = time.perf_counter() - started
+
+    by_phase = {}
+    for result in results:
+        by_phase.setdefault(result['phase_before'] or 'new', []).append(result['ms'])
+    errors = [result for result in results if result['error']]
+    return {
+        'config': {
+            'source': args.export or args.logs,
+            'speed': args.speed,
+            'openai_latency': args.openai_latency,
+            'dynamodb_latency': args.dynamodb_latency,
+            'line_latency': args.line_latency,
+            'throttle': args.throttle,
+            'openai_recording': args.openai_recording,
+            'seed': args.seed
+        },
+        'turns': len(results),
+        'errors': len(errors),
+        'elapsed_seconds': round(elapsed, 3),
+        'latency_ms': summarize([result['ms'] for result in results]),
+        'latency_ms_by_phase': {phase: summarize(values) for phase, values in sorted(by_phase.items())},
+        'openai_recording': getattr(stack['openai'], 'stats', None),
+        'transitions': sum(1 for result in results if result['phase_before'] != result['phase_after']),
+        'expected_differences': diff_expected(results),
+        'results': results
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay logged LINE webhooks or exported sessions against local stand-ins and diff the outcome.')
+    parser.add_argument('logs', nargs='*', help='log files containing the webhook bodies lambda_handler logs')
+    parser.add_argument('--export', default=None, help='replay exported turns from this lambda_export target instead of logs')
+    parser.add_argument('--since', default=None, help='first date of exported turns to replay (YYYY-MM-DD)')
+    parser.add_argument('--until', default=None, help='last date of exported turns to replay (YYYY-MM-DD)')
+    parser.add_argument('--user-id', action='append', default=None, help='only replay this user (or group); repeatable')
+    parser.add_argument('--limit', type=int, default=None, help='replay at most this many webhooks')
+    parser.add_argument('--speed', type=float, default=0.0, help='0: one after another; N: original timing compressed N times')
+    parser.add_argument('--scenario', default=None, help='scenario pack to seed prompts for (default: DEFAULT_SCENARIO_ID)')
+    parser.add_argument('--openai-latency', default='0', help='OpenAI latency in ms as median:p99')
+    parser.add_argument('--dynamodb-latency', default='0', help='DynamoDB latency in ms as median:p99')
+    parser.add_argument('--line-latency', default='0', help='LINE API latency in ms as median:p99')
+    parser.add_argument('--throttle', action='store_true', help='keep the per-user throttle enabled')
+    parser.add_argument('--openai-recording', default=None, help='serve OpenAI responses recorded in this file (others fall back to the rule-based fake)')
+    parser.add_argument('--record', action='store_true', help='call the real OpenAI API and add its responses to --openai-recording')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the stand-ins')
+    parser.add_argument('--output', default=None, help='file to save the results to as JSON')
+    parser.add_argument('--compare', default=None, help='previous replay results JSON to diff against')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the bot while replaying')
+    args = parser.parse_args(argv)
+    if not args.logs and not args.export:
+        parser.error('give log files or --export')
+    if args.record and not args.openai_recording:
+        parser.error('--record needs --openai-recording')
+
+    result = run(args)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            result['differences'] = diff(json.load(f)['results'], result['results'])
+
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    summary = {name: value for name, value in result.items() if name != 'results'}
+    summary['expected_differences'] = len(result['expected_differences'])
+    if 'differences' in result:
+        summary['differences'] = result['differences'][:20]
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 1 if result['errors'] or result.get('differences') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
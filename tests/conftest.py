@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import local_stack  # noqa: E402
+
+# lambda_dao などは読み込み時に boto3 や LINE のクライアントを作るので、ローカルの設定を入れておく（通信はしない）
+local_stack.prepare_environment(THROTTLE_ENABLED='false')
+
+
+# メモリ上のDynamoDB・LINE・OpenAIに差し替える
+@pytest.fixture
+def stack():
+    return local_stack.install()
+
+
+# メッセージを1件送って、返信とpushの文章を返す
+@pytest.fixture
+def say(stack):
+    import lambda_function
+
+    def send(user_id, text):
+        event, reply_token = local_stack.webhook_event(user_id, text)
+        lambda_function.lambda_handler(event, None)
+        return stack['line'].sent_for(reply_token, user_id)
+    return send
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+import admin_tool
+import lambda_dao
+
+USER_IDS = [f'U{number}' for number in range(6)]
+
+
+@pytest.fixture
+def users(stack):
+    table = stack['dynamodb'].Table('user_info')
+    for user_id in USER_IDS:
+        table.store({'user_id': user_id, 'CurrentPhase': 'investigation', 'count': 3, 'limit': 1, 'SessionId': 'S1', 'Version': 5})
+    return table
+
+
+def snapshot(table):
+    return {user_id: table.peek({'user_id': user_id}) for user_id in USER_IDS}
+
+
+# --dry-run は読むだけで、ユーザーもチェックポイントも書かない
+def test_reset_dry_run_does_not_write(stack, users, tmp_path):
+    before = snapshot(users)
+    checkpoint = tmp_path / 'reset.json'
+    assert admin_tool.main(['reset', '--segments', '2', '--checkpoint', str(checkpoint), '--dry-run']) == 0
+
+    assert snapshot(users) == before
+    assert stack['dynamodb'].calls['Scan'] >= 2
+    assert not {'PutItem', 'UpdateItem', 'BatchWriteItem'} & set(stack['dynamodb'].calls)
+    assert not checkpoint.exists()
+
+
+# 途中で止まったセグメントは、保存した読み込み位置の次のページから続ける
+def test_interrupted_segment_resumes_from_the_checkpoint(stack, users, tmp_path, monkeypatch):
+    checkpoint = tmp_path / 'zero.json'
+    command = ['zero-counters', '--segments', '1', '--page-size', '1', '--checkpoint', str(checkpoint)]
+    update = lambda_dao.update_user_attributes
+    updated = []
+
+    def interrupted(user_id, values):
+        if updated:
+            raise RuntimeError('connection lost')
+        updated.append(user_id)
+        return update(user_id, values)
+    monkeypatch.setattr(lambda_dao, 'update_user_attributes', interrupted)
+    assert admin_tool.main(command) == 1
+    first = updated[0]
+    with open(checkpoint, encoding='utf-8') as f:
+        assert json.load(f) == {'segments': 1, '0': {'user_id': first}}
+
+    resumed = []
+
+    def recording(user_id, values):
+        resumed.append(user_id)
+        return update(user_id, values)
+    monkeypatch.setattr(lambda_dao, 'update_user_attributes', recording)
+    assert admin_tool.main(command) == 0
+
+    # 前の実行で書き終えたページは読み直さない
+    assert sorted(resumed) == sorted(set(USER_IDS) - {first})
+    assert all((user['count'], user['limit']) == (0, 0) for user in snapshot(users).values())
+    with open(checkpoint, encoding='utf-8') as f:
+        assert json.load(f)['0'] == 'done'
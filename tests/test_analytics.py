@@ -0,0 +1,73 @@
+import pytest
+
+import lambda_analytics
+import lambda_export
+import lambda_scenario
+
+CORRECT = '成田さきが契約書を破り捨てたので、消えるボールペンの字をアイロンで消した'
+WRONG = '成田さんが犯人'
+START = 1_700_000_000_000
+
+
+def rows():
+    # (user_id, session_id, phase, location, message)
+    turns = [
+        # U1/S1: 3ターン調べて正解
+        ('U1', 'S1', 'investigation', 'リビング', 'リビングを調べたい'),
+        ('U1', 'S1', 'investigation', 'キッチン', 'キッチンを調べたい'),
+        ('U1', 'S1', 'investigation', None, '被害者とはどういう関係でしたか？'),
+        ('U1', 'S1', 'reasoning', None, CORRECT),
+        # U2/S1: 2ターン調べて不正解
+        ('U2', 'S1', 'investigation', 'リビング', 'リビングを調べたい'),
+        ('U2', 'S1', 'investigation', '書斎', '書斎を調べたい'),
+        ('U2', 'S1', 'reasoning', None, WRONG),
+        # U3/S1: 調査で止まった
+        ('U3', 'S1', 'investigation', '書斎', '書斎を調べたい'),
+        # U1/S0: 同じユーザーの前のゲーム（別のゲームとして数える）
+        ('U1', 'S0', 'investigation', 'キッチン', 'キッチンを調べたい'),
+    ]
+    return [
+        {'user_id': user_id, 'session_id': session_id, 'ts': START + offset * 1000, 'phase': phase,
+         'location': location, 'speaker': None, 'message': message, 'reply': 'r', 'dt': '2023-11-15'}
+        for offset, (user_id, session_id, phase, location, message) in enumerate(turns)
+    ]
+
+
+# lambda_export と同じ書式のParquetを書いて、集計を通す
+@pytest.fixture
+def report(tmp_path):
+    writer = lambda_export.PartitionWriter(str(tmp_path), 'run')
+    for row in rows():
+        writer.add(row)
+    writer.flush()
+    return lambda_analytics.build_report(str(tmp_path), lambda_scenario.get_scenario(None))
+
+
+def test_phase_funnel_counts_reached_and_stopped_games(report):
+    funnel = report['funnel']
+    assert (funnel['games'], funnel['ended']) == (4, 2)
+    assert [(phase['phase'], phase['reached'], phase['stopped']) for phase in funnel['phases']] == [
+        ('investigation', 4, 2),
+        ('reasoning', 2, 0)
+    ]
+
+
+# before_ending は推理まで進んだゲームだけの、推理の前のターン数
+def test_turn_counts_include_turns_before_the_ending(report):
+    investigation = report['turn_counts']['investigation']
+    assert (investigation['games'], investigation['max']) == (4, 3)
+    assert investigation['before_ending'] == {'games': 2, 'mean': 2.5, 'p50': 2.5, 'p90': 2.9, 'p99': 2.99, 'max': 3}
+    assert 'before_ending' not in report['turn_counts']['reasoning']
+
+
+# lift は調べたゲームの正解率と全体の正解率（1/2）との差
+def test_location_report_lift(report):
+    assert report['endings']['games'] == 2
+    assert report['endings']['correct'] == 1
+    assert report['locations']['overall_correct_rate'] == 0.5
+    by_name = {row['location']: row for row in report['locations']['locations']}
+    assert by_name['キッチン'] == {'location': 'キッチン', 'games': 2, 'ended_games': 1, 'correct_rate': 1.0, 'lift': 0.5}
+    assert by_name['リビング']['lift'] == 0.0
+    assert by_name['書斎']['lift'] == -0.5
+    assert [row['location'] for row in report['locations']['locations']][0] == 'キッチン'
+    assert report['co_visits']['リビング'] == {'リビング': 2, 'キッチン': 1, '書斎': 1}
@@ -0,0 +1,49 @@
+import gzip
+import json
+from decimal import Decimal
+
+import lambda_archive
+
+
+class RecordingLambda:
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, **kwargs):
+        self.invocations.append(kwargs)
+        return {'StatusCode': 202}
+
+
+# endに移ったターンでは、アーカイブを非同期に頼むだけで、履歴は読まず・消さない
+def test_archive_on_end_only_requests_archiving(stack, monkeypatch):
+    client = RecordingLambda()
+    monkeypatch.setattr(lambda_archive, 'ARCHIVE_ON_END', True)
+    monkeypatch.setattr(lambda_archive, 'ARCHIVE_FUNCTION_NAME', 'archive')
+    monkeypatch.setattr(lambda_archive, '_lambda_client', client)
+    history = stack['dynamodb'].Table('talk_history')
+    history.store({'user_id': 'Uend', 'date': 'S1#2024-01-01T10:00:00+09:00', 'message': 'm', 'reply': 'r'})
+    calls = dict(stack['dynamodb'].calls)
+
+    lambda_archive.archive_on_end({'user_id': 'Uend', 'SessionId': 'S1', 'CurrentPhase': 'end', 'count': Decimal(3)})
+
+    [invocation] = client.invocations
+    assert invocation['FunctionName'] == 'archive'
+    assert invocation['InvocationType'] == 'Event'
+    assert json.loads(invocation['Payload'])['user'] == {'user_id': 'Uend', 'SessionId': 'S1', 'CurrentPhase': 'end', 'count': 3}
+    assert stack['dynamodb'].calls == calls
+
+
+# 頼まれた archive_handler は、そのゲームの履歴だけを保存して消す
+def test_archive_handler_archives_the_requested_session(stack, tmp_path):
+    history = stack['dynamodb'].Table('talk_history')
+    history.store({'user_id': 'Uend', 'date': 'S1#2024-01-01T10:00:00+09:00', 'message': 'm1', 'reply': 'r1'})
+    history.store({'user_id': 'Uend', 'date': 'S2#2024-01-02T10:00:00+09:00', 'message': 'm2', 'reply': 'r2'})
+
+    result = lambda_archive.archive_handler({'user': {'user_id': 'Uend', 'SessionId': 'S1'}, 'target': str(tmp_path)}, None)
+
+    assert result['turns'] == 1 and result['deleted'] == 1
+    with gzip.open(result['location'], 'rt', encoding='utf-8') as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['type'] for line in lines] == ['user', 'turn']
+    assert lines[1]['message'] == 'm1'
+    assert [key[1] for key in history.partitions['Uend']] == ['S2#2024-01-02T10:00:00+09:00']
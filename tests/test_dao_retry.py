@@ -0,0 +1,115 @@
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+import lambda_dao
+import lambda_deadline
+
+
+def throttled():
+    return ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'slow down'}}, 'UpdateItem')
+
+
+def unavailable():
+    return ClientError({'Error': {'Code': 'InternalServerError', 'Message': 'try again'}}, 'UpdateItem')
+
+
+# 最初の failures 回だけ errors を投げて、その後は 'ok' を返す
+class Flaky:
+    def __init__(self, failures, error=throttled):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error()
+        return 'ok'
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(lambda_dao, 'DYNAMODB_BACKOFF_BASE_MS', 1)
+    monkeypatch.setattr(lambda_dao, 'DYNAMODB_BACKOFF_MAX_MS', 2)
+    monkeypatch.setattr(lambda_dao, 'DYNAMODB_MAX_ATTEMPTS', 4)
+    monkeypatch.setattr(lambda_dao, 'DYNAMODB_RETRY_BUDGET_MS', 1500)
+
+
+def test_throttling_is_retried_until_it_succeeds():
+    func = Flaky(3)
+    assert lambda_dao.call_with_retry('op', func) == 'ok'
+    assert func.calls == 4
+
+
+def test_attempts_are_capped():
+    func = Flaky(10)
+    with pytest.raises(lambda_dao.DynamoDBThrottledError) as raised:
+        lambda_dao.call_with_retry('op', func)
+    assert func.calls == 4
+    assert raised.value.attempts == 4
+    assert raised.value.code == 'ProvisionedThroughputExceededException'
+
+
+def test_retry_budget_stops_retrying(monkeypatch):
+    monkeypatch.setattr(lambda_dao, 'DYNAMODB_MAX_ATTEMPTS', 100)
+    monkeypatch.setattr(lambda_dao, 'DYNAMODB_BACKOFF_BASE_MS', 20)
+    monkeypatch.setattr(lambda_dao, 'DYNAMODB_BACKOFF_MAX_MS', 20)
+    monkeypatch.setattr(lambda_dao, 'DYNAMODB_RETRY_BUDGET_MS', 100)
+    func = Flaky(1000)
+    started = time.monotonic()
+    with pytest.raises(lambda_dao.DynamoDBThrottledError):
+        lambda_dao.call_with_retry('op', func)
+    assert time.monotonic() - started < 0.5
+    assert 1 < func.calls < 100
+
+
+def test_transient_errors_are_retried_only_when_idempotent():
+    func = Flaky(1, unavailable)
+    assert lambda_dao.call_with_retry('op', func) == 'ok'
+
+    func = Flaky(1, unavailable)
+    with pytest.raises(lambda_dao.DynamoDBUnavailableError):
+        lambda_dao.call_with_retry('op', func, idempotent=False)
+    assert func.calls == 1
+
+
+def test_throttling_is_retried_even_when_not_idempotent():
+    func = Flaky(2)
+    assert lambda_dao.call_with_retry('op', func, idempotent=False) == 'ok'
+
+
+def test_condition_failures_are_not_retried():
+    def failing():
+        raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'no'}}, 'UpdateItem')
+
+    with pytest.raises(lambda_dao.DynamoDBConditionError):
+        lambda_dao.call_with_retry('op', failing)
+
+
+# バッチやコマンドライン（lambda_handler の外）では、プロセスが長く動いた後も再試行する
+def test_retries_outside_a_turn_do_not_use_up_a_process_wide_deadline(monkeypatch):
+    monkeypatch.setattr(lambda_deadline, 'TURN_HARD_BUDGET_MS', 50)
+    token = lambda_deadline._turn.set(None)
+    try:
+        assert lambda_dao.call_with_retry('op', Flaky(2)) == 'ok'
+        time.sleep(0.1)
+        assert lambda_deadline.hard_remaining() > 0
+        assert lambda_dao.call_with_retry('op', Flaky(2)) == 'ok'
+    finally:
+        lambda_deadline._turn.reset(token)
+
+
+# ターンの中では、ターンの締め切りを過ぎたら再試行しない
+def test_retries_inside_a_turn_stop_at_the_turn_deadline(monkeypatch):
+    monkeypatch.setattr(lambda_deadline, 'TURN_HARD_BUDGET_MS', 0)
+    token = lambda_deadline._turn.set(None)
+    try:
+        lambda_deadline.start_turn()
+        func = Flaky(2)
+        with pytest.raises(lambda_dao.DynamoDBThrottledError):
+            lambda_dao.call_with_retry('op', func)
+        assert func.calls == 1
+    finally:
+        lambda_deadline._turn.reset(token)
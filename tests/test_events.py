@@ -0,0 +1,114 @@
+import pytest
+
+import lambda_dao
+import lambda_events
+
+USER = {'CurrentPhase': 'investigation', 'count': 2, 'limit': 10, 'Version': 3}
+
+
+def turn(increments, next_phase=None):
+    return {'increments': increments, 'next_phase': next_phase}
+
+
+# 発言・カウンター・フェーズ変更・返信の順に並ぶ
+def test_describe_turn_lists_events_in_order():
+    events = lambda_events.describe_turn(USER, turn({'count': 1}, 'reasoning'), '調べる', 'U1', ['r1', 'r2'])
+    assert events == [
+        {'type': lambda_events.TURN_RECEIVED, 'phase': 'investigation', 'query': '調べる', 'speaker': 'U1'},
+        {'type': lambda_events.COUNTER_CHANGED, 'counter': 'count', 'delta': 1},
+        {'type': lambda_events.PHASE_CHANGED, 'from': 'investigation', 'to': 'reasoning'},
+        {'type': lambda_events.REPLY_SENT, 'replies': ['r1', 'r2']}
+    ]
+
+
+# フェーズが変わらなければフェーズ変更のイベントは無い
+def test_describe_turn_without_phase_change():
+    events = lambda_events.describe_turn(USER, turn({}, 'investigation'), 'a', 'U1', [])
+    assert [event['type'] for event in events] == [lambda_events.TURN_RECEIVED, lambda_events.REPLY_SENT]
+
+
+# 番号はターンの最後の番号から逆算し、区切りをまたいだターンだけスナップショットを足す
+def test_build_items_adds_a_snapshot_at_the_boundary(monkeypatch):
+    monkeypatch.setattr(lambda_events, 'SNAPSHOT_INTERVAL', 4)
+    events = [{'type': lambda_events.TURN_RECEIVED, 'phase': 'intro', 'query': 'a', 'speaker': 'U1'},
+              {'type': lambda_events.REPLY_SENT, 'replies': []}]
+
+    items = lambda_events.build_items('U1', 'S1', events, 3, USER)
+    assert [item['event_key'] for item in items] == ['0000000002', '0000000003']
+
+    items = lambda_events.build_items('U1', 'S1', events, 5, USER)
+    assert [item['event_key'] for item in items] == ['0000000004', '0000000005', '0000000005#snapshot']
+    assert items[-1]['state'] == {'CurrentPhase': 'investigation', 'count': 2, 'limit': 10}
+    assert {item['session_key'] for item in items} == {'U1#S1'}
+
+
+def test_project_applies_events_in_order():
+    events = [
+        {'type': lambda_events.TURN_RECEIVED, 'phase': 'intro'},
+        {'type': lambda_events.COUNTER_CHANGED, 'counter': 'count', 'delta': 1},
+        {'type': lambda_events.PHASE_CHANGED, 'from': 'intro', 'to': 'investigation'},
+        {'type': lambda_events.TURN_RECEIVED, 'phase': 'investigation'},
+        {'type': lambda_events.COUNTER_CHANGED, 'counter': 'count', 'delta': 2},
+        {'type': lambda_events.REPLY_SENT, 'replies': []}
+    ]
+    assert lambda_events.project(events) == {'CurrentPhase': 'investigation', 'count': 3}
+
+
+# 直近のスナップショットから始め、その後のイベントを当てはめる
+def test_rebuild_replays_events_after_the_last_snapshot(stack, monkeypatch):
+    monkeypatch.setattr(lambda_events, 'SNAPSHOT_INTERVAL', 4)
+
+    def commit(last_seq, before, increments, next_phase, after):
+        events = lambda_events.describe_turn(before, turn(increments, next_phase), 'q', 'U1', [])
+        lambda_dao.put_turn_events(lambda_events.build_items('U1', 'S1', events, last_seq, after))
+
+    # 1〜3: intro で count +1
+    commit(3, {'CurrentPhase': 'intro'}, {'count': 1}, None, {'CurrentPhase': 'intro', 'count': 1})
+    # 4〜7: 区切りをまたぐのでスナップショット（書き込み後の状態）が残る
+    commit(7, {'CurrentPhase': 'intro'}, {'count': 1}, 'investigation', {'CurrentPhase': 'investigation', 'count': 2})
+    # 8〜10: スナップショットの後のイベント
+    commit(10, {'CurrentPhase': 'investigation'}, {'count': 3}, None, {'CurrentPhase': 'investigation', 'count': 5})
+
+    table = stack['dynamodb'].Table('turn_events')
+    assert table.peek({'session_key': 'U1#S1', 'event_key': '0000000007#snapshot'})['state']['count'] == 2
+    # スナップショットより前のカウンターは捨てられていても結果は同じ
+    table.discard({'session_key': 'U1#S1', 'event_key': '0000000002'})
+    assert lambda_events.rebuild('U1', 'S1') == {'CurrentPhase': 'investigation', 'count': 5}
+
+
+@pytest.fixture
+def fast_retry(monkeypatch):
+    monkeypatch.setattr(lambda_dao, 'DYNAMODB_BACKOFF_BASE_MS', 0)
+    monkeypatch.setattr(lambda_dao, 'DYNAMODB_BACKOFF_MAX_MS', 0)
+
+
+# 書けなかった分だけを call_with_retry の再試行で送り直す
+def test_put_turn_events_resends_only_unprocessed_items(stack, fast_retry, monkeypatch):
+    items = [{'session_key': 'U1#S1', 'event_key': f'{seq:010d}', 'seq': seq, 'type': 'reply_sent'} for seq in range(1, 4)]
+    sent = []
+
+    def batch_write_item(RequestItems, **kwargs):
+        requests = RequestItems[lambda_dao.TURN_EVENTS_TABLE]
+        sent.append([request['PutRequest']['Item']['seq'] for request in requests])
+        if len(sent) == 1:
+            return {'UnprocessedItems': {lambda_dao.TURN_EVENTS_TABLE: requests[1:]}}
+        return {'UnprocessedItems': {}}
+    monkeypatch.setattr(lambda_dao.dynamodb, 'batch_write_item', batch_write_item)
+
+    assert lambda_dao.put_turn_events(items) == 3
+    assert sent == [[1, 2, 3], [2, 3]]
+
+
+# 再試行しきれずに残った分は捨てずに例外にする
+def test_put_turn_events_raises_on_leftover_items(stack, fast_retry, monkeypatch):
+    items = [{'session_key': 'U1#S1', 'event_key': '0000000001', 'seq': 1, 'type': 'reply_sent'}]
+    attempts = []
+
+    def batch_write_item(RequestItems, **kwargs):
+        attempts.append(1)
+        return {'UnprocessedItems': RequestItems}
+    monkeypatch.setattr(lambda_dao.dynamodb, 'batch_write_item', batch_write_item)
+
+    with pytest.raises(lambda_dao.DynamoDBThrottledError):
+        lambda_dao.put_turn_events(items)
+    assert len(attempts) == lambda_dao.DYNAMODB_MAX_ATTEMPTS
@@ -0,0 +1,54 @@
+import argparse
+import time
+from datetime import datetime, timedelta, timezone
+
+import pyarrow.parquet as pq
+
+import lambda_export
+
+JST = timezone(timedelta(hours=9))
+NOW = 1_700_000_000
+
+
+def turn(user_id, seconds_ago, message):
+    moment = datetime.fromtimestamp(NOW - seconds_ago, JST).isoformat()
+    return {'user_id': user_id, 'date': f'S1#{moment}', 'message': message, 'reply': 'r'}
+
+
+def export(tmp_path, now, monkeypatch):
+    monkeypatch.setattr(time, 'time', lambda: now)
+    args = argparse.Namespace(
+        target=str(tmp_path / 'out'), checkpoint=str(tmp_path / 'export.json'),
+        segments=2, workers=None, page_size=None, rows_per_file=100
+    )
+    summary = lambda_export.export_scan(args)
+    assert summary['errors'] == 0
+    return summary
+
+
+def exported_messages(tmp_path):
+    return sorted(
+        message
+        for path in (tmp_path / 'out').rglob('*.parquet')
+        for message in pq.read_table(path).column('message').to_pylist()
+    )
+
+
+# ターンの始まりの時刻が前回の範囲より前でも、後から書き込まれた会話は次の実行で書き出す
+def test_late_written_turn_is_exported_by_the_next_run(stack, tmp_path, monkeypatch):
+    monkeypatch.setattr(lambda_export, 'EXPORT_WATERMARK_MARGIN_SECONDS', 60)
+    history = stack['dynamodb'].Table('talk_history')
+    history.store(turn('U1', 3600, 'old'))
+    # 返答がすぐ書き込まれた、スキャンの直前のターン
+    history.store(turn('U2', 10, 'quick'))
+
+    assert export(tmp_path, NOW, monkeypatch)['rows'] == 1
+    assert exported_messages(tmp_path) == ['old']
+
+    # 1回目のスキャンの後に書き込まれた、quick より前に始まったターン
+    history.store(turn('U3', 30, 'late'))
+    assert export(tmp_path, NOW + 120, monkeypatch)['rows'] == 2
+    assert exported_messages(tmp_path) == ['late', 'old', 'quick']
+
+    # 書き出した会話は次の実行で書き出し直さない
+    assert export(tmp_path, NOW + 240, monkeypatch)['rows'] == 0
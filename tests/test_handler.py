@@ -0,0 +1,146 @@
+import benchmark
+import lambda_scenario
+
+
+def test_failed_second_completion_still_replies(stack, say, monkeypatch):
+    user_id = 'Utest-second-gpt'
+    for text in benchmark.JOURNEY[:3]:
+        assert say(user_id, text)
+
+    create = stack['openai'].create
+
+    # 関数呼び出しの後の2回目（functions を渡さない呼び出し）だけ失敗させる
+    def failing_second_call(**kwargs):
+        if not kwargs.get('functions'):
+            raise RuntimeError('upstream error')
+        return create(**kwargs)
+
+    monkeypatch.setattr('openai.ChatCompletion.create', failing_second_call)
+    replies = say(user_id, 'リビングを調べたい')
+    assert lambda_scenario.get_scenario()['fallback_reply'] in replies
+    # 調べた場所のURLも一緒に返る
+    assert any(reply.startswith('http') for reply in replies)
+
+
+# SessionId の無い以前からのユーザーは、途中のゲームの履歴を読み続ける
+def test_legacy_user_keeps_reading_the_current_game(stack, say, monkeypatch):
+    user_id = 'Ulegacy'
+    stack['dynamodb'].Table('user_info').store({'user_id': user_id, 'CurrentPhase': 'investigation', 'count': 3, 'limit': 3})
+    history = stack['dynamodb'].Table('talk_history')
+    history.store({'user_id': user_id, 'date': '2024-01-01T10:00:00+09:00', 'message': '昨日は？', 'reply': '書斎にいた。'})
+
+    seen = []
+    create = stack['openai'].create
+
+    def recording(**kwargs):
+        seen.append(kwargs['messages'])
+        return create(**kwargs)
+
+    monkeypatch.setattr('openai.ChatCompletion.create', recording)
+    assert say(user_id, '被害者とはどういう関係でしたか？')
+
+    assert any(message.get('content') == '書斎にいた。' for message in seen[0])
+    assert 'SessionId' not in stack['dynamodb'].Table('user_info').peek({'user_id': user_id})
+    dates = sorted(key[1] for key in history.partitions[user_id])
+    assert all('#' not in date for date in dates) and len(dates) == 2
+
+
+# ベンチマークと負荷試験の推理の文章で、それぞれのエンディングに届く
+def test_journey_reasoning_reaches_both_endings(stack, say):
+    import load_test
+
+    endings = lambda_scenario.get_scenario()['endings']
+    reasoning_index = benchmark.JOURNEY.index('推理を発表したい') + 1
+    for user_id, reasoning, ending in (
+        ('Ucorrect', benchmark.JOURNEY[reasoning_index], 'correct'),
+        ('Ucorrect-load', load_test.CORRECT_REASONING, 'correct'),
+        ('Uincorrect-load', load_test.WRONG_REASONING, 'incorrect')
+    ):
+        for text in benchmark.JOURNEY[:reasoning_index]:
+            assert say(user_id, text)
+        assert load_test.ending_of(say(user_id, reasoning), endings) == ending
+
+
+# 読み込めないシナリオのユーザーは、既定のシナリオの最初のフェーズから新しいゲームを始める
+def test_unknown_scenario_restarts_in_the_default_scenario(stack, say):
+    user_id = 'Uunknown-scenario'
+    users = stack['dynamodb'].Table('user_info')
+    users.store({'user_id': user_id, 'ScenarioId': 'missing', 'CurrentPhase': 'interrogation', 'count': 7, 'limit': 7, 'CostMicroUSD': 500})
+
+    assert say(user_id, 'あなたは誰ですか？')
+
+    user = users.peek({'user_id': user_id})
+    scenario = lambda_scenario.get_scenario()
+    assert user['ScenarioId'] == scenario['id']
+    assert user['CurrentPhase'] == scenario['machine']['initial_phase']
+    assert user['count'] < 7 and user['limit'] < 7
+    assert user['SessionId']
+
+
+# 1回のWebhookに複数のイベントがあっても、締め切りと定型文の有無はイベントごと
+def test_each_event_in_a_webhook_gets_its_own_deadline(stack, monkeypatch):
+    import json
+    import time
+
+    import lambda_deadline
+    import lambda_function
+    import local_stack
+
+    monkeypatch.setattr(lambda_deadline, 'TURN_REPLY_BUDGET_MS', 100)
+    create = stack['openai'].create
+
+    def slow_for_first_user(**kwargs):
+        if any('遅い' in (message.get('content') or '') for message in kwargs['messages']):
+            time.sleep(0.3)
+        return create(**kwargs)
+
+    monkeypatch.setattr('openai.ChatCompletion.create', slow_for_first_user)
+    slow, slow_token = local_stack.webhook_event('Uslow', '遅い質問です')
+    fast, fast_token = local_stack.webhook_event('Ufast', 'あなたは誰ですか？')
+    body = json.loads(slow['body'])
+    body['events'] += json.loads(fast['body'])['events']
+    body = json.dumps(body, ensure_ascii=False)
+    lambda_function.lambda_handler({'headers': {'x-line-signature': local_stack.sign(body)}, 'body': body}, None)
+
+    line = stack['line']
+    # 遅かったイベントは定型文を先に返し、本回答をpushで送る
+    assert line.replies[slow_token] and line.pushes.get('Uslow')
+    # 次のイベントは自分の締め切りの中で返信する
+    assert line.replies[fast_token]
+    assert 'Ufast' not in line.pushes
+
+
+# グループではメンバー全員で1つのゲームを遊び、ChatGPTに渡す履歴には発言したメンバーの名前が付く
+def test_group_members_share_one_game(stack, monkeypatch):
+    import lambda_function
+    import local_stack
+
+    group_id, alice, bob = 'Cgroup000001', 'Ualice000001', 'Ubob000002'
+    seen = []
+    create = stack['openai'].create
+
+    def recording(**kwargs):
+        seen.append(kwargs['messages'])
+        return create(**kwargs)
+
+    monkeypatch.setattr('openai.ChatCompletion.create', recording)
+
+    def say(speaker_id, text):
+        event, reply_token = local_stack.webhook_event(speaker_id, text, group_id=group_id)
+        lambda_function.lambda_handler(event, None)
+        return stack['line'].sent_for(reply_token, group_id)
+
+    for speaker_id, text in zip([alice, bob, alice, bob], benchmark.JOURNEY[:4]):
+        assert say(speaker_id, text)
+    assert say(alice, '被害者とはどういう関係でしたか？')
+
+    users = stack['dynamodb'].Table('user_info')
+    assert users.peek({'user_id': group_id})['CurrentPhase'] == 'investigation'
+    assert users.peek({'user_id': alice}) is None and users.peek({'user_id': bob}) is None
+
+    assert (lambda_function.get_speaker_name(alice), lambda_function.get_speaker_name(bob)) == ('player_000001', 'player_000002')
+    # 最後のターンの履歴には、それぞれの発言者の名前が付いている
+    spoken = [(message.get('name'), message['content']) for message in seen[-1] if message['role'] == 'user']
+    assert ('player_000002', benchmark.JOURNEY[3]) in spoken
+    assert spoken[-1] == ('player_000001', '被害者とはどういう関係でしたか？')
+    assert all(name in ('player_000001', 'player_000002') for name, _ in spoken)
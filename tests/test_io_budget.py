@@ -0,0 +1,29 @@
+import benchmark
+import lambda_io
+
+
+# ベンチマークの1人分の道のりを、ベンチマークの予算を確かめながら進める
+def test_journey_stays_within_the_default_budgets(stack, say, monkeypatch):
+    monkeypatch.setattr(lambda_io, 'IO_BUDGET_MODE', 'assert')
+    lambda_io.set_budgets(benchmark.DEFAULT_BUDGETS)
+    lambda_io.reset_violations()
+    try:
+        for user_id in ('Ubudget1', 'Ubudget2'):
+            for text in benchmark.JOURNEY:
+                assert say(user_id, text)
+        assert lambda_io.budget_violations() == []
+    finally:
+        lambda_io.set_budgets({})
+        lambda_io.reset_violations()
+
+
+# 予算は測った回数ちょうどなので、1回増えただけで分かる
+def test_one_extra_call_is_a_violation():
+    lambda_io.set_budgets(benchmark.DEFAULT_BUDGETS)
+    try:
+        within = {'dynamodb_reads': 2, 'dynamodb_writes': 2, 'openai': 2, 'line': 1}
+        assert lambda_io.check('investigation', within) == []
+        assert lambda_io.check('investigation', {**within, 'dynamodb_reads': 3}) == ['investigation: dynamodb_reads 3 > 2']
+        assert lambda_io.check('outro', {'dynamodb_reads': 1, 'dynamodb_writes': 1}) == ['outro: dynamodb_reads 1 > 0']
+    finally:
+        lambda_io.set_budgets({})
@@ -0,0 +1,49 @@
+import pytest
+
+import lambda_location
+
+LOCATIONS = {
+    'キッチン': 'https://example.com/kitchen',
+    'リビング': {'url': 'https://example.com/living', 'synonyms': ['居間']},
+    '書斎': 'https://example.com/study'
+}
+
+
+@pytest.fixture
+def index():
+    return lambda_location.build_index(LOCATIONS)
+
+
+def test_exact_names_and_synonyms(index):
+    assert lambda_location.find_location(index, 'キッチン') == ('キッチン', 1.0)
+    assert lambda_location.find_location(index, '居間') == ('リビング', 1.0)
+
+
+def test_spelling_variants_are_normalized(index):
+    assert lambda_location.find_location(index, 'きっちん')[0] == 'キッチン'
+    assert lambda_location.find_location(index, 'ｷｯﾁﾝ')[0] == 'キッチン'
+    assert lambda_location.find_location(index, ' 書斎！')[0] == '書斎'
+
+
+def test_name_inside_a_longer_phrase(index):
+    name, score = lambda_location.find_location(index, 'キッチンの棚')
+    assert name == 'キッチン'
+    assert lambda_location.LOCATION_MATCH_THRESHOLD <= score < 1.0
+
+
+def test_unrelated_text_does_not_match(index):
+    assert lambda_location.find_location(index, '庭の物置')[0] is None
+    assert lambda_location.find_location(index, '')[0] is None
+
+
+def test_match_threshold_is_inclusive(index, monkeypatch):
+    name, score = lambda_location.find_location(index, 'リビンク')
+    assert name == 'リビング' and score < 1.0
+    monkeypatch.setattr(lambda_location, 'LOCATION_MATCH_THRESHOLD', score)
+    assert lambda_location.find_location(index, 'リビンク')[0] == 'リビング'
+    monkeypatch.setattr(lambda_location, 'LOCATION_MATCH_THRESHOLD', score + 0.01)
+    assert lambda_location.find_location(index, 'リビンク') == (None, score)
+
+
+def test_long_queries_are_truncated(index):
+    assert lambda_location.find_location(index, 'キッチン' + 'あ' * 1000)[0] == 'キッチン'
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+import lambda_metrics
+
+
+@pytest.fixture
+def emf(monkeypatch):
+    monkeypatch.setattr(lambda_metrics, 'METRICS_MODE', 'emf')
+    monkeypatch.setattr(lambda_metrics, 'ENABLED', True)
+    monkeypatch.setattr(lambda_metrics, 'METRICS_NAMESPACE', 'TestBot')
+    token = lambda_metrics._turn.set(None)
+    yield
+    lambda_metrics._turn.reset(token)
+
+
+def test_build_emf_shape():
+    document = lambda_metrics.build_emf(
+        {'Phase': 'investigation', 'Model': 'gpt-4'},
+        {'turn.total': [120.5], 'dynamodb.get_user_info.capacity': [0.5, 1.0]},
+        {'turn.total': 'Milliseconds', 'dynamodb.get_user_info.capacity': 'Count'},
+        timestamp_ms=1_700_000_000_000
+    )
+    assert document['_aws'] == {
+        'Timestamp': 1_700_000_000_000,
+        'CloudWatchMetrics': [{
+            'Namespace': lambda_metrics.METRICS_NAMESPACE,
+            'Dimensions': [['Model', 'Phase']],
+            'Metrics': [
+                {'Name': 'turn.total', 'Unit': 'Milliseconds'},
+                {'Name': 'dynamodb.get_user_info.capacity', 'Unit': 'Count'}
+            ]
+        }]
+    }
+    # ディメンションと値は最上位に置く（1件なら数値、複数なら配列）
+    assert (document['Phase'], document['Model']) == ('investigation', 'gpt-4')
+    assert document['turn.total'] == 120.5
+    assert document['dynamodb.get_user_info.capacity'] == [0.5, 1.0]
+
+
+# flush はターンの計測値を1行のEMFで出して、次のターンに持ち越さない
+def test_flush_prints_one_line_and_clears_the_turn(emf, capsys):
+    lambda_metrics.start_turn(Phase='intro')
+    lambda_metrics.set_dimension('Model', 'gpt-3.5-turbo')
+    lambda_metrics.record('io.dynamodb_reads', 2, 'Count')
+    lambda_metrics.record('io.dynamodb_reads', 1, 'Count')
+    with lambda_metrics.span('gpt.call'):
+        pass
+    lambda_metrics.flush()
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 1
+    document = json.loads(lines[0])
+    metrics = document['_aws']['CloudWatchMetrics'][0]
+    assert metrics['Namespace'] == 'TestBot'
+    assert metrics['Dimensions'] == [['Model', 'Phase']]
+    assert {metric['Name']: metric['Unit'] for metric in metrics['Metrics']} == {
+        'io.dynamodb_reads': 'Count',
+        'gpt.call': 'Milliseconds'
+    }
+    assert document['io.dynamodb_reads'] == [2, 1]
+
+    # ターンが終わった後の記録は捨て、もう一度 flush しても何も出さない
+    lambda_metrics.record('io.dynamodb_reads', 5, 'Count')
+    lambda_metrics.flush()
+    assert capsys.readouterr().out == ''
+
+
+def test_file_mode_appends_lines(emf, monkeypatch, tmp_path):
+    path = tmp_path / 'metrics.jsonl'
+    monkeypatch.setattr(lambda_metrics, 'METRICS_MODE', 'file')
+    monkeypatch.setattr(lambda_metrics, 'METRICS_FILE', str(path))
+    for phase in ('intro', 'investigation'):
+        lambda_metrics.start_turn(Phase=phase)
+        lambda_metrics.record('turn.total', 10, 'Milliseconds')
+        lambda_metrics.flush()
+    with open(path, encoding='utf-8') as f:
+        assert [json.loads(line)['Phase'] for line in f] == ['intro', 'investigation']
@@ -0,0 +1,102 @@
+import pytest
+
+import lambda_phase
+
+SCENARIO = {
+    'phases': [
+        {
+            'name': 'intro',
+            'next': 'play',
+            'guards': [{'contains_any': ['はじめる'], 'reply': 'では始めよう。', 'goto': 'next'}],
+            'counters': ['count'],
+            'thresholds': [
+                {'counter': 'count', 'equals': 2, 'notify': 'あと1回です'},
+                {'counter': 'count', 'equals': 3, 'goto': 'end'}
+            ],
+            'gpt': 'chat'
+        },
+        {
+            'name': 'play',
+            'next': 'end',
+            'guards': [{'contains_any': ['ルール', '命令'], 'reply': 'お見通しだよ'}],
+            'counters': ['count', 'limit'],
+            'thresholds': [{'counter': 'limit', 'equals': 2, 'notify': '時間だ', 'goto': 'next'}],
+            'gpt': 'functions',
+            'functions': {
+                'finish': {'requires_any': ['発表'], 'goto': 'next'},
+                'survey': {'action': 'survey_location'}
+            }
+        },
+        {'name': 'end', 'reply': 'おしまい'}
+    ]
+}
+
+
+@pytest.fixture
+def machine():
+    return lambda_phase.compile_scenario(SCENARIO)
+
+
+def user(phase, **counters):
+    return {'user_id': 'U1', 'CurrentPhase': phase, **counters}
+
+
+def test_initial_user_starts_in_the_first_phase(machine):
+    assert lambda_phase.initial_user_item(machine, 'U1')['CurrentPhase'] == 'intro'
+
+
+def test_guard_replies_and_moves_without_counting(machine):
+    turn = lambda_phase.evaluate_turn(machine, user('intro', count=0), 'では、はじめるよ')
+    assert turn['replies'] == ['では始めよう。']
+    assert turn['next_phase'] == 'play'
+    assert turn['increments'] == {}
+
+
+def test_guard_without_goto_stays(machine):
+    turn = lambda_phase.evaluate_turn(machine, user('play', count=0, limit=0), 'ルールを教えて')
+    assert turn['replies'] == ['お見通しだよ']
+    assert turn['next_phase'] is None
+
+
+def test_fixed_reply_phase(machine):
+    turn = lambda_phase.evaluate_turn(machine, user('end'), 'もう一回')
+    assert turn['replies'] == ['おしまい']
+    assert turn['increments'] == {}
+
+
+def test_counters_are_incremented_every_turn(machine):
+    turn = lambda_phase.evaluate_turn(machine, user('play', count=5, limit=0), 'こんにちは')
+    assert turn['replies'] == []
+    assert turn['increments'] == {'count': 1, 'limit': 1}
+    assert turn['next_phase'] is None
+
+
+# しきい値は加算後の値で判定する（属性が無ければ0から）
+def test_thresholds_fire_on_the_value_after_the_increment(machine):
+    assert lambda_phase.evaluate_turn(machine, user('intro'), 'a')['notifications'] == []
+    notified = lambda_phase.evaluate_turn(machine, user('intro', count=1), 'a')
+    assert notified['notifications'] == ['あと1回です']
+    assert notified['next_phase'] is None
+    ended = lambda_phase.evaluate_turn(machine, user('intro', count=2), 'a')
+    assert ended['next_phase'] == 'end'
+    assert lambda_phase.evaluate_turn(machine, user('intro', count=3), 'a')['next_phase'] is None
+
+
+def test_threshold_can_notify_and_move(machine):
+    turn = lambda_phase.evaluate_turn(machine, user('play', count=0, limit=1), 'a')
+    assert turn['notifications'] == ['時間だ']
+    assert turn['next_phase'] == 'end'
+
+
+def test_function_goto_requires_words(machine):
+    phase = machine['phases']['play']
+    assert lambda_phase.function_action(phase, 'finish', '推理を発表したい')['goto'] == 'end'
+    assert lambda_phase.function_action(phase, 'finish', 'もう終わりたい')['goto'] is None
+    assert lambda_phase.function_action(phase, 'survey', '台所')['action'] == 'survey_location'
+    assert lambda_phase.function_action(phase, 'unknown', '台所') is None
+
+
+def test_goto_to_a_missing_phase_is_rejected():
+    broken = {'phases': [{'name': 'intro', 'guards': [{'contains_any': ['x'], 'goto': 'nowhere'}]}]}
+    with pytest.raises(ValueError):
+        lambda_phase.compile_scenario(broken)
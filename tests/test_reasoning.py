@@ -0,0 +1,80 @@
+import pytest
+
+import lambda_reasoning
+import lambda_scenario
+
+REASONING = {
+    'concepts': [
+        {'name': '契約', 'synonyms': ['契約書']},
+        {'name': '破棄', 'weight': 2, 'synonyms': ['破り捨て', '破った']},
+        {'name': '成田', 'synonyms': ['なりた']},
+        {'name': 'さき', 'synonyms': ['早紀']}
+    ],
+    'threshold': 4,
+    'required_groups': [['成田'], ['さき']]
+}
+
+
+@pytest.fixture
+def compiled():
+    return lambda_reasoning.compile_reasoning(REASONING)
+
+
+def test_score_at_the_threshold_passes(compiled):
+    result = lambda_reasoning.score(compiled, '成田早紀が契約書を破った')
+    assert result['score'] == 5
+    assert result['passed']
+    assert result['missing_groups'] == []
+
+
+def test_score_below_the_threshold_fails(compiled):
+    result = lambda_reasoning.score(compiled, '成田早紀が契約書を書いた')
+    assert result['score'] == 3
+    assert not result['passed']
+
+
+# 点数が足りていても、required_groups を満たしていなければ不正解
+def test_missing_required_group_fails(compiled):
+    result = lambda_reasoning.score(compiled, '成田が契約書を破り捨てた')
+    assert result['score'] == 4
+    assert not result['passed']
+    assert result['missing_groups'] == [['さき']]
+
+
+# 同じ要素は何回書いても1回だけ数える
+def test_each_concept_counts_once(compiled):
+    result = lambda_reasoning.score(compiled, '契約、契約書、契約書')
+    assert result['score'] == 1
+    assert result['concepts']['契約']['matched'] == ['契約', '契約書']
+
+
+# ひらがな・カタカナや全角・半角の違いは normalize で吸収される
+def test_synonyms_are_normalized(compiled):
+    result = lambda_reasoning.score(compiled, 'ナリタ サキ')
+    assert set(result['concepts']) == {'成田', 'さき'}
+
+
+def test_empty_text_scores_zero(compiled):
+    result = lambda_reasoning.score(compiled, None)
+    assert result['score'] == 0
+    assert not result['passed']
+
+
+# 旧書式（keywords / required）はキーワードの数で判定する
+def test_legacy_keywords_format():
+    compiled = lambda_reasoning.compile_reasoning({'keywords': ['契約', '成田', 'アイロン'], 'required': 2})
+    assert lambda_reasoning.score(compiled, '成田さんがアイロンを使った')['passed']
+    assert not lambda_reasoning.score(compiled, '成田さんが犯人')['passed']
+
+
+def test_unknown_concept_in_required_groups_is_rejected():
+    with pytest.raises(ValueError):
+        lambda_reasoning.compile_reasoning({**REASONING, 'required_groups': [['成田'], ['犯人']]})
+
+
+# 既定のシナリオでは、犯人の姓と名の両方がないと正解にならない
+def test_default_scenario_requires_the_full_name():
+    compiled = lambda_scenario.get_scenario(None)['reasoning']
+    answer = '契約書を破り捨てたので、消えるボールペンの字をアイロンで消した'
+    assert not lambda_reasoning.score(compiled, '成田さんが' + answer)['passed']
+    assert lambda_reasoning.score(compiled, '成田さきが' + answer)['passed']
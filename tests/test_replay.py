@@ -0,0 +1,78 @@
+import json
+
+import openai
+
+import benchmark
+import local_stack
+import replay
+
+RECORDED = '（記録した返答）'
+
+
+# 本物のOpenAIの代わり（返答の本文に印を付けて、規則の代役の返答と見分ける）
+def upstream():
+    fake = local_stack.LocalChatCompletion(locations=['リビング', 'キッチン'])
+
+    def create(**kwargs):
+        response = fake.create(**kwargs)
+        message = response['choices'][0]['message']
+        if message['content']:
+            message['content'] = RECORDED + message['content']
+        return response
+    return create
+
+
+def request(text):
+    return {'model': 'gpt-3.5-turbo', 'messages': [{'role': 'user', 'content': text}], 'request_timeout': 5}
+
+
+# 記録に有るリクエストは記録した応答を返し、無いリクエストは規則の代役に任せる
+def test_recorded_completion_hits_and_falls_back(tmp_path):
+    path = str(tmp_path / 'openai.jsonl.gz')
+    recorder = local_stack.RecordedChatCompletion(path, 'record', upstream=upstream())
+    recorded = recorder.create(**request('あなたは誰ですか？'))
+
+    player = local_stack.RecordedChatCompletion(path, 'replay')
+    # 通信の設定（request_timeout）は指紋に含めない
+    assert player.create(**{**request('あなたは誰ですか？'), 'request_timeout': 1}) == recorded
+    missed = player.create(**request('昨日の夜は何をしていましたか？'))
+    assert not missed['choices'][0]['message']['content'].startswith(RECORDED)
+    assert player.stats == {'hits': 1, 'misses': 1, 'recorded': 0}
+
+
+def replay_logs(tmp_path, log, recording, *options):
+    output = tmp_path / 'result.json'
+    replay.main([str(log), '--openai-recording', str(recording), '--output', str(output), *options])
+    with open(output, encoding='utf-8') as f:
+        return json.load(f)
+
+
+# replay.py --record で記録したセッションを、記録から流し直すと同じ返答になる
+def test_record_then_replay_a_session(tmp_path, monkeypatch):
+    log = tmp_path / 'webhooks.txt'
+    with open(log, 'w', encoding='utf-8') as f:
+        for offset, text in enumerate(benchmark.JOURNEY[:5]):
+            event, _ = local_stack.webhook_event('U1', text, timestamp_ms=1_700_000_000_000 + offset * 1000)
+            f.write(f"INFO Request body: {event['body']}\n")
+    recording = tmp_path / 'openai.jsonl.gz'
+
+    # --record は openai.ChatCompletion.create（ここでは印を付ける代役）を呼んで記録する
+    monkeypatch.setattr(openai.ChatCompletion, 'create', upstream())
+    recorded = replay_logs(tmp_path, log, recording, '--record')
+    assert recorded['errors'] == 0
+    assert recorded['openai_recording']['recorded'] > 0
+    assert any(reply.startswith(RECORDED) for result in recorded['results'] for reply in result['replies'])
+
+    replayed = replay_logs(tmp_path, log, recording)
+    assert replayed['openai_recording']['misses'] == 0
+    assert replayed['openai_recording']['hits'] == recorded['openai_recording']['recorded']
+    assert [result['replies'] for result in replayed['results']] == [result['replies'] for result in recorded['results']]
+
+    # 記録に無い発言は規則の代役が答える
+    with open(log, 'a', encoding='utf-8') as f:
+        event, _ = local_stack.webhook_event('U1', '被害者とはどういう関係でしたか？', timestamp_ms=1_700_000_010_000)
+        f.write(f"INFO Request body: {event['body']}\n")
+    extended = replay_logs(tmp_path, log, recording)
+    assert extended['openai_recording']['misses'] > 0
+    assert extended['results'][-1]['replies']
+    assert not any(reply.startswith(RECORDED) for reply in extended['results'][-1]['replies'])
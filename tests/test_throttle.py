@@ -0,0 +1,127 @@
+import pytest
+
+import benchmark
+import lambda_dao
+import lambda_scenario
+import lambda_throttle
+
+# 1分に1回、続けて2回まで
+PHASE = {'throttle': {'rate_per_minute': 1, 'burst': 2}}
+
+
+@pytest.fixture(autouse=True)
+def throttle(monkeypatch):
+    monkeypatch.setattr(lambda_throttle, 'THROTTLE_ENABLED', True)
+    monkeypatch.setattr(lambda_throttle, '_users', type(lambda_throttle._users)())
+    token = lambda_throttle._admitted.set(None)
+    yield
+    lambda_throttle._admitted.reset(token)
+
+
+def admit(query, user_id='U1', phase=PHASE):
+    return lambda_throttle.admit(user_id, phase, query)
+
+
+def test_disabled_always_allows(monkeypatch):
+    monkeypatch.setattr(lambda_throttle, 'THROTTLE_ENABLED', False)
+    for _ in range(10):
+        assert admit('hi')['action'] == lambda_throttle.ALLOW
+
+
+def test_policy_defaults_and_phase_override(monkeypatch):
+    monkeypatch.setattr(lambda_throttle, 'THROTTLE_RATE_PER_MINUTE', 10)
+    monkeypatch.setattr(lambda_throttle, 'THROTTLE_BURST', 5)
+    assert lambda_throttle.policy_for({}) == {'rate_per_minute': 10.0, 'burst': 5}
+    assert lambda_throttle.policy_for(PHASE) == {'rate_per_minute': 1.0, 'burst': 2}
+
+
+# 前のターンがChatGPTを待っている間のメッセージは保留し（受け取ったことはターンごとに1回だけ伝える）、次のターンで一緒に渡す
+def test_messages_during_a_turn_are_merged_into_the_next_one():
+    assert admit('first')['action'] == lambda_throttle.ALLOW
+    merged = admit('second')
+    assert merged == {'action': lambda_throttle.MERGE, 'query': 'second', 'notify': True}
+    assert admit('again')['notify'] is False
+    lambda_throttle.release()
+
+    decision = admit('third')
+    assert decision['action'] == lambda_throttle.ALLOW
+    assert decision['query'] == 'second\nagain\nthird'
+    assert admit('fourth')['notify'] is True
+
+
+# トークンが尽きたらDROPし、制限中であることは1回だけ伝える
+def test_drop_when_tokens_run_out_and_notify_once():
+    for query in ('a', 'b'):
+        assert admit(query)['action'] == lambda_throttle.ALLOW
+        lambda_throttle.release()
+
+    first = admit('c')
+    second = admit('d')
+    assert (first['action'], first['notify']) == (lambda_throttle.DROP, True)
+    assert (second['action'], second['notify']) == (lambda_throttle.DROP, False)
+
+
+def test_users_are_throttled_separately():
+    for query in ('a', 'b'):
+        admit(query)
+        lambda_throttle.release()
+    assert admit('c')['action'] == lambda_throttle.DROP
+    assert admit('c', user_id='U2')['action'] == lambda_throttle.ALLOW
+
+
+# 溜めるメッセージは件数と文字数に上限がある（文字数を超えたら古いものから捨てる）
+def test_merged_query_is_bounded(monkeypatch):
+    monkeypatch.setattr(lambda_throttle, 'THROTTLE_MAX_MERGED', 2)
+    monkeypatch.setattr(lambda_throttle, 'THROTTLE_MAX_MERGED_CHARS', 8)
+    admit('start')
+    for query in ('aaa', 'bbb', 'ccc'):
+        admit(query)
+    lambda_throttle.release()
+    assert admit('ddd')['query'] == 'bbb\nddd'
+
+
+# release はこのターンで許したユーザーだけを戻す（呼ばれなければ次もMERGE）
+def test_release_only_frees_the_admitted_user():
+    admit('a')
+    lambda_throttle.release()
+    lambda_throttle.release()
+    assert admit('b')['action'] == lambda_throttle.ALLOW
+    assert admit('c')['action'] == lambda_throttle.MERGE
+
+
+# コンテナをまたいだ上限を超えたら、溜めたメッセージを戻してDROPする
+def test_shared_window_limit_drops_and_keeps_pending(monkeypatch):
+    monkeypatch.setattr(lambda_throttle, 'THROTTLE_SHARED_PER_MINUTE', 1)
+    counts = iter([1, 2, 1])
+    monkeypatch.setattr(lambda_dao, 'increment_throttle_window', lambda user_id, window: next(counts))
+    phase = {'throttle': {'rate_per_minute': 60, 'burst': 10}}
+
+    assert admit('a', phase=phase)['action'] == lambda_throttle.ALLOW
+    lambda_throttle.release()
+    decision = admit('b', phase=phase)
+    assert (decision['action'], decision['notify']) == (lambda_throttle.DROP, True)
+    decision = admit('c', phase=phase)
+    assert decision['action'] == lambda_throttle.ALLOW
+    assert decision['query'] == 'b\nc'
+
+
+# DynamoDBで数えられなかった時は制限しない
+def test_shared_window_failure_allows(monkeypatch):
+    monkeypatch.setattr(lambda_throttle, 'THROTTLE_SHARED_PER_MINUTE', 1)
+
+    def failing(user_id, window):
+        raise lambda_dao.DynamoDBUnavailableError('UpdateItem', 'InternalServerError', 'down', 1)
+    monkeypatch.setattr(lambda_dao, 'increment_throttle_window', failing)
+    assert admit('a')['action'] == lambda_throttle.ALLOW
+
+
+# 前のターンを待っている間のメッセージには、前のターンの返答ではなく受け取ったことを返す
+def test_handler_acknowledges_a_message_held_during_a_turn(say):
+    for text in benchmark.JOURNEY[:4]:
+        assert say('U1', text)
+    # 同じユーザーの前のターンがまだChatGPTを待っている
+    lambda_throttle._users['U1']['in_flight'] = True
+    scenario = lambda_scenario.get_scenario()
+    assert say('U1', '被害者とはどういう関係でしたか？') == [scenario['merge_reply']]
+    assert say('U1', 'キッチンを調べたい') == []
+    assert lambda_throttle._users['U1']['pending'] == ['被害者とはどういう関係でしたか？', 'キッチンを調べたい']
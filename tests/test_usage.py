@@ -0,0 +1,39 @@
+import lambda_usage
+
+
+def response(model, prompt_tokens, completion_tokens):
+    return {'model': model, 'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens}}
+
+
+# モデルごとの費用も、ゲーム全体・フェーズごとの費用と同じ更新に足す
+def test_increments_break_cost_down_by_model():
+    lambda_usage.start_turn()
+    lambda_usage.record(response('gpt-3.5-turbo-16k-0613', 1000, 100))
+    lambda_usage.record(response('gpt-4', 100, 10))
+    increments = lambda_usage.increments('investigation')
+    assert increments == {
+        'PromptTokens': 1100,
+        'CompletionTokens': 110,
+        'CostMicroUSD': 3400 + 3600,
+        'CostMicroUSD_investigation': 3400 + 3600,
+        'CostMicroUSD_model_gpt-3.5-turbo-16k-0613': 3400,
+        'CostMicroUSD_model_gpt-4': 3600
+    }
+    assert all(lambda_usage.is_usage_attribute(name) for name in increments)
+
+
+def test_report_separates_phases_and_models():
+    users = [
+        {'user_id': 'U1', 'CurrentPhase': 'end', 'CostMicroUSD': 3000,
+         'CostMicroUSD_intro': 1000, 'CostMicroUSD_investigation': 2000,
+         'CostMicroUSD_model_gpt-3.5-turbo': 1000, 'CostMicroUSD_model_gpt-4': 2000},
+        {'user_id': 'U2', 'CurrentPhase': 'intro', 'CostMicroUSD': 500,
+         'CostMicroUSD_intro': 500, 'CostMicroUSD_model_gpt-3.5-turbo': 500},
+        # モデルごとの属性が無い以前のユーザー
+        {'user_id': 'U3', 'CurrentPhase': 'intro', 'CostMicroUSD': 100, 'CostMicroUSD_intro': 100}
+    ]
+    report = lambda_usage.build_report(users)
+    assert report['cost_usd_by_phase'] == {'intro': 0.0016, 'investigation': 0.002}
+    assert report['cost_usd_by_model'] == {'gpt-3.5-turbo': 0.0015, 'gpt-4': 0.002}
+    assert report['completed_games']['default']['games'] == 1
+    assert [row['user_id'] for row in report['top_spenders']] == ['U1', 'U2', 'U3']
@@ -0,0 +1,112 @@
+import benchmark
+import lambda_dao
+import lambda_phase
+import lambda_scenario
+import lambda_user_cache
+
+
+def test_cache_is_bounded_and_expires(monkeypatch):
+    monkeypatch.setattr(lambda_user_cache, 'USER_CACHE_MAX_USERS', 2)
+    monkeypatch.setattr(lambda_user_cache, 'USER_CACHE_TTL_SECONDS', 60)
+    lambda_user_cache.clear()
+    for user_id in ('U1', 'U2', 'U3'):
+        lambda_user_cache.put({'user_id': user_id, 'Version': 1})
+    assert lambda_user_cache.get('U1') is None
+    assert lambda_user_cache.get('U3')['Version'] == 1
+    assert lambda_user_cache.stats()['evictions'] == 1
+
+    monkeypatch.setattr(lambda_user_cache, 'USER_CACHE_TTL_SECONDS', -1)
+    lambda_user_cache.put({'user_id': 'U4', 'Version': 1})
+    assert lambda_user_cache.get('U4') is None
+    stats = lambda_user_cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 2)
+
+
+def test_cached_item_is_a_copy():
+    lambda_user_cache.clear()
+    lambda_user_cache.put({'user_id': 'U1', 'count': 1})
+    lambda_user_cache.get('U1')['count'] = 5
+    assert lambda_user_cache.get('U1')['count'] == 1
+
+
+def test_warm_turns_do_not_read_user_info(stack, say):
+    say('Uwarm', benchmark.JOURNEY[0])
+    table = stack['dynamodb'].Table('user_info')
+    reads = stack['dynamodb'].calls.get('GetItem', 0)
+    say('Uwarm', benchmark.JOURNEY[1])
+    assert stack['dynamodb'].calls.get('GetItem', 0) == reads
+    assert table.peek({'user_id': 'Uwarm'})['Version'] == 3
+
+
+# 他のコンテナが先に書いていたら、書き込みだけを今の状態で決め直す（ChatGPTは呼び直さない）
+def test_stale_cache_recomputes_only_the_state_change(stack, say):
+    user_id = 'Ustale'
+    for text in benchmark.JOURNEY[:3]:
+        say(user_id, text)
+    table = stack['dynamodb'].Table('user_info')
+    cached = table.peek({'user_id': user_id})
+    assert cached['CurrentPhase'] == 'investigation'
+    # 他のコンテナで 29 ターン進んでいた（次のターンで limit が 30 になり推理へ移る）
+    with table.lock:
+        table.store({**cached, 'limit': 29, 'count': cached['count'] + 29, 'Version': cached['Version'] + 29})
+
+    completions = stack['openai'].calls
+    updates = stack['dynamodb'].calls.get('UpdateItem', 0)
+    replies = say(user_id, 'リビングを調べたい')
+
+    assert replies
+    assert stack['openai'].calls - completions == 2
+    assert stack['dynamodb'].calls['UpdateItem'] - updates == 2
+    state = table.peek({'user_id': user_id})
+    assert state['limit'] == 30
+    assert state['count'] == cached['count'] + 30
+    assert state['CurrentPhase'] == 'reasoning'
+    assert lambda_user_cache.get(user_id)['Version'] == state['Version']
+
+
+# フェーズが変わっていたら、返答も前のフェーズのものなので、送る前に今のフェーズでターンをやり直す
+def test_stale_phase_reruns_the_turn_before_replying(stack, say):
+    user_id = 'Ustale-phase'
+    for text in benchmark.JOURNEY[:3]:
+        say(user_id, text)
+    table = stack['dynamodb'].Table('user_info')
+    cached = table.peek({'user_id': user_id})
+    assert cached['CurrentPhase'] == 'investigation'
+    # 他のコンテナで推理の発表に進んでいた
+    with table.lock:
+        table.store({**cached, 'CurrentPhase': 'reasoning', 'Version': cached['Version'] + 1})
+
+    reasoning = benchmark.JOURNEY[benchmark.JOURNEY.index('推理を発表したい') + 1]
+    replies = say(user_id, reasoning)
+
+    assert lambda_scenario.get_scenario()['endings']['correct'] in replies
+    assert table.peek({'user_id': user_id})['CurrentPhase'] == 'outro'
+
+
+def test_concurrent_first_message_reuses_the_registered_user(stack, say, monkeypatch):
+    table = stack['dynamodb'].Table('user_info')
+    say('Unew', benchmark.JOURNEY[0])
+    lambda_user_cache.clear()
+    original = table.peek({'user_id': 'Unew'})
+    # 読んだ時にはまだ無かった（同時に届いたメッセージの方が先に登録した）
+    monkeypatch.setattr(lambda_dao, '_read_user_info', lambda user_id: None)
+    assert say('Unew', benchmark.JOURNEY[1])
+    state = table.peek({'user_id': 'Unew'})
+    assert state['SessionId'] == original['SessionId']
+    assert state['count'] == original['count'] + 1
+
+
+def test_reconcile_keeps_function_goto_only_in_the_same_phase():
+    machine = lambda_scenario.get_scenario()['machine']
+    user = {'CurrentPhase': 'investigation', 'count': 3, 'limit': 3}
+    turn = lambda_phase.evaluate_turn(machine, user, '推理を発表したい')
+    turn['next_phase'] = 'reasoning'
+    turn['increments']['TokensIn_investigation'] = 100
+
+    same = lambda_phase.reconcile_turn(machine, user, {**user, 'count': 9, 'limit': 9}, turn, '推理を発表したい')
+    assert same['next_phase'] == 'reasoning'
+    assert same['increments'] == {'count': 1, 'limit': 1, 'TokensIn_investigation': 100}
+
+    moved = lambda_phase.reconcile_turn(machine, user, {**user, 'CurrentPhase': 'reasoning'}, turn, '推理を発表したい')
+    assert moved['next_phase'] is None
+    assert moved['increments'] == {'count': 1, 'TokensIn_investigation': 100}